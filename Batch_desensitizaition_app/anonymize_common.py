@@ -1,6 +1,28 @@
 import os
 import pydicom
+from concurrent.futures import (
+    ThreadPoolExecutor,
+    ProcessPoolExecutor,
+    FIRST_COMPLETED,
+    wait,
+)
 from pydicom.errors import InvalidDicomError
+from scan_manifest import NON_DICOM_EXTENSIONS, KIND_DICOM, build_manifest
+from dicom_stream import (
+    read_header,
+    write_header_with_tail,
+    clone_file,
+    HeaderOnlyUnsupported,
+)
+from atomic_output import FSYNC_NONE, AtomicOutput
+from deid_profile import get_profile
+from dicom_scrub import (
+    SCRUB_PYDICOM,
+    SCRUB_SAME_LENGTH,
+    ScrubUnsupported,
+    needs_scrub,
+    scrub_file,
+)
 
 
 def is_dicom(path):
@@ -13,161 +35,104 @@ def is_dicom(path):
         return False
 
 
-def find_dicom_files(base_dir, log=None):
-    """
-    递归查找目录中的所有DICOM文件
-    """
-    dicom_files = []
-    total_files = 0
-
-    for root, dirs, files in os.walk(base_dir):
-        for filename in files:
-            total_files += 1
-            filepath = os.path.join(root, filename)
-
-            # 跳过明显的非DICOM文件
-            if filename.lower().endswith(
-                (
-                    ".txt",
-                    ".pdf",
-                    ".jpg",
-                    ".jpeg",
-                    ".png",
-                    ".gif",
-                    ".bmp",
-                    ".doc",
-                    ".docx",
-                    ".xls",
-                    ".xlsx",
-                    ".py",
-                    ".log",
-                    ".ini",
-                    ".cfg",
-                    ".config",
-                    ".bat",
-                    ".sh",
-                )
-            ):
-                continue
-
-            # 检查文件大小
+def is_dicom_quick(filepath):
+    """快速检查是否为DICOM文件（优化版）"""
+    try:
+        if not os.path.isfile(filepath):
+            return False
+
+        # 检查文件大小
+        file_size = os.path.getsize(filepath)
+        if file_size < 132:  # DICOM文件最小大小
+            return False
+
+        # 方法1：快速检查DICOM前缀（128字节后）
+        with open(filepath, "rb") as f:
+            f.seek(128)
+            prefix = f.read(4)
+            if prefix == b"DICM":
+                return True
+
+        # 方法2：检查文件扩展名（如果有）
+        filename_lower = filepath.lower()
+        if filename_lower.endswith((".dcm", ".dic", ".dicom")):
+            # 有DICOM扩展名，尝试用pydicom验证
             try:
-                if os.path.getsize(filepath) < 128:  # 太小不可能是DICOM
-                    continue
+                pydicom.dcmread(filepath, stop_before_pixels=True, force=True)
+                return True
             except:
-                continue
+                return False
 
-            # 检查是否为DICOM
-            if is_dicom(filepath):
-                relative_path = os.path.relpath(filepath, base_dir)
-                dicom_files.append(filepath)
+        # 方法3：对于没有明显标识的文件，跳过常见非DICOM文件
+        if filename_lower.endswith(NON_DICOM_EXTENSIONS):
+            return False
 
-                # if log:
-                #     log(
-                #         f"Found DICOM: {relative_path} ({os.path.getsize(filepath):,} bytes)"
-                #     )
+        # 对于其他文件，检查文件大小范围
+        # 典型的DICOM文件大小在几十KB到几百MB之间
+        if file_size < 1024 or file_size > 2 * 1024 * 1024 * 1024:  # 小于1KB或大于2GB
+            return False
 
-    if log:
-        log(f"Scanned {total_files} files, found {len(dicom_files)} DICOM files")
+        # 方法4：作为最后手段，尝试pydicom解析
+        try:
+            pydicom.dcmread(filepath, stop_before_pixels=True, force=True)
+            return True
+        except (InvalidDicomError, Exception):
+            return False
 
-    return dicom_files
+    except Exception:
+        return False
 
 
-def anonymize_dicom_file(dicom_path, modality="MRI", log=None):
+def find_dicom_files(base_dir, log=None, manifest=None):
     """
-    通用DICOM匿名化函数
+    递归查找目录中的所有DICOM文件
+    已有扫描清单（scan_manifest）时直接复用，不再重新遍历
     """
-    try:
-        # if log:
-        #     log(f"Processing: {os.path.basename(dicom_path)}")
-
-        # 读取DICOM文件
-        ds = pydicom.dcmread(dicom_path, force=True)
-
-        # 通用匿名化字段（适用于所有模态）
-        if hasattr(ds, "PatientName"):
-            ds.PatientName = "ANON"
-
-        if hasattr(ds, "PatientID"):
-            ds.PatientID = "ANON_ID"
-
-        if hasattr(ds, "PatientBirthDate"):
-            ds.PatientBirthDate = ""
-
-        if hasattr(ds, "PatientSex"):
-            ds.PatientSex = ""
-
-        if hasattr(ds, "InstitutionName"):
-            ds.InstitutionName = ""
-
-        if hasattr(ds, "ReferringPhysicianName"):
-            ds.ReferringPhysicianName = ""
-
-        if hasattr(ds, "PerformingPhysicianName"):
-            ds.PerformingPhysicianName = ""
-
-        if hasattr(ds, "OperatorsName"):
-            ds.OperatorsName = ""
-
-        # 特定于模态的匿名化
-        if modality.upper() == "MRI":
-            # MRI特定字段
-            if hasattr(ds, "PatientAge"):
-                ds.PatientAge = ""
+    if manifest is None:
+        manifest = build_manifest(base_dir)
 
-            if hasattr(ds, "PatientSize"):
-                ds.PatientSize = ""
+    dicom_files = manifest.paths(KIND_DICOM)
 
-            if hasattr(ds, "AdditionalPatientHistory"):
-                ds.AdditionalPatientHistory = ""
-
-            if hasattr(ds, "PatientComments"):
-                ds.PatientComments = ""
-
-            if hasattr(ds, "StationName"):
-                ds.StationName = ""
-
-            if hasattr(ds, "ProtocolName"):
-                ds.ProtocolName = ""
-
-            if hasattr(ds, "StudyID"):
-                ds.StudyID = ""
-
-            ds.DeidentificationMethod = "De-identified"
-            ds.PatientIdentityRemoved = "YES"
-
-        elif modality.upper() == "CT":
-            # CT特定字段（通常较少）
-            if hasattr(ds, "StudyID"):
-                ds.StudyID = ""
-
-            if hasattr(ds, "SeriesNumber"):
-                # 保持序列号不变
-                pass
-
-        # 额外的通用匿名化
-        extra_fields = [
-            "PatientAddress",
-            "PatientTelephoneNumbers",
-            "OtherPatientIDs",
-            "OtherPatientNames",
-            "InstitutionAddress",
-            "InstitutionalDepartmentName",
-            "PhysicianOfRecord",
-            "StudyDescription",
-            "SeriesDescription",
-        ]
-
-        for field in extra_fields:
-            if hasattr(ds, field):
-                setattr(ds, field, "")
+    if log:
+        log(f"Scanned {len(manifest)} files, found {len(dicom_files)} DICOM files")
 
-        # 保存文件
-        ds.save_as(dicom_path)
+    return dicom_files
 
-        # if log:
-        #     log(f"  ✓ Anonymized successfully")
 
+def anonymize_dicom_file(
+    dicom_path,
+    modality="MRI",
+    log=None,
+    header_only=True,
+    dst_path=None,
+    profile=None,
+    scrub=SCRUB_PYDICOM,
+    pseudonym_db=None,
+    link_unchanged=False,
+    fsync=FSYNC_NONE,
+):
+    """
+    通用DICOM匿名化函数
+    header_only=True 时只重写头部，像素数据原样拷贝（见 dicom_stream）
+    dst_path 不为 None 时直接写到目标路径（保留原始数据模式），否则原地覆盖
+    profile 为去标识规则 JSON 文件路径（见 deid_profile），None 时使用默认规则
+    scrub 为 "raw" / "same-length" 时只写头部的处理不经过 pydicom（见 dicom_scrub）
+    pseudonym_db 为假名映射库路径（见 pseudonym_store），UID 与 PatientID 映射为稳定的替代值
+    没有需要修改的元素时不重写文件（输出目录中用 reflink / 复制，link_unchanged=True 时可用硬链接）
+    输出先写临时文件再 os.replace（见 atomic_output），fsync 为刷盘策略
+    """
+    try:
+        _anonymize_dicom(
+            dicom_path,
+            modality,
+            header_only,
+            dst_path,
+            profile,
+            scrub,
+            pseudonym_db,
+            link_unchanged,
+            fsync,
+        )
         return True
 
     except Exception as e:
@@ -177,3 +142,230 @@ def anonymize_dicom_file(dicom_path, modality="MRI", log=None):
 
             log(f"  Traceback: {traceback.format_exc()}")
         return False
+
+
+def _anonymize_dicom(
+    dicom_path,
+    modality,
+    header_only=True,
+    dst_path=None,
+    profile=None,
+    scrub=SCRUB_PYDICOM,
+    pseudonym_db=None,
+    link_unchanged=False,
+    fsync=FSYNC_NONE,
+):
+    """匿名化单个DICOM文件，失败时抛出异常"""
+    dst_path = dst_path or dicom_path
+    if dst_path != dicom_path:
+        os.makedirs(os.path.dirname(dst_path), exist_ok=True)
+    rules = get_profile(profile, modality, pseudonym_db)
+
+    if header_only and scrub != SCRUB_PYDICOM:
+        try:
+            # 直接按字节处理头部，不构建 Dataset
+            scrub_file(
+                dicom_path,
+                rules,
+                dst_path,
+                same_length=scrub == SCRUB_SAME_LENGTH,
+                hardlink=link_unchanged,
+                fsync=fsync,
+            )
+            return
+        except ScrubUnsupported:
+            pass
+    else:
+        try:
+            # 先按字节扫描一遍头部：没有需要修改的元素（例如已经去标识过）时不解析也不重写
+            if not needs_scrub(dicom_path, rules):
+                if dst_path != dicom_path:
+                    clone_file(dicom_path, dst_path, link_unchanged)
+                return
+        except ScrubUnsupported:
+            pass
+
+    if header_only:
+        try:
+            # 只解析到像素数据之前
+            ds, pixel_offset = read_header(dicom_path)
+        except HeaderOnlyUnsupported:
+            header_only = False
+
+    if header_only:
+        _deidentify_dataset(ds, modality, profile, pseudonym_db)
+        write_header_with_tail(ds, dicom_path, pixel_offset, dst_path, fsync=fsync)
+        return
+
+    # 读取DICOM文件
+    ds = pydicom.dcmread(dicom_path, force=True)
+    _deidentify_dataset(ds, modality, profile, pseudonym_db)
+
+    # 保存文件（临时文件写完后替换）
+    with AtomicOutput(dst_path, dicom_path, fsync) as output:
+        ds.save_as(output.path)
+
+
+def _deidentify_dataset(ds, modality, profile=None, pseudonym_db=None):
+    """
+    按模态应用去标识规则（profile 为 JSON 规则文件路径，None 时使用默认规则）
+    同一序列的实例复用第一个实例的处理结果（见 deid_profile.SeriesTemplate）
+    """
+    return get_profile(profile, modality, pseudonym_db).apply_series(ds)
+
+
+def anonymize_dicom_files(
+    dicom_files,
+    modality="MRI",
+    log=None,
+    workers=1,
+    executor="thread",
+    chunk_size=32,
+    should_stop=None,
+    header_only=True,
+    dst_files=None,
+    report=None,
+    profile=None,
+    scrub=SCRUB_PYDICOM,
+    pseudonym_db=None,
+    link_unchanged=False,
+    fsync=FSYNC_NONE,
+):
+    """
+    批量匿名化DICOM文件
+
+    workers > 1 时按 chunk_size 分块提交到线程池/进程池（executor="thread"/"process"），
+    同时在途的分块数不超过 workers * 2。
+    dst_files 与 dicom_files 一一对应时，从源文件读取并直接写出到目标路径。
+    report(path, ok, error) 在每个分块完成后按文件调用。
+    profile 为去标识规则文件路径，在各个工作线程/进程中各自编译一次。
+    scrub、pseudonym_db、link_unchanged、fsync 见 anonymize_dicom_file（映射库可由多个线程/进程共享）。
+    返回 (成功数, 错误列表)，错误列表按文件顺序为 [(path, message), ...]。
+    """
+    pairs = list(zip(dicom_files, dst_files or dicom_files))
+    chunks = [pairs[i : i + chunk_size] for i in range(0, len(pairs), chunk_size)]
+    results = [None] * len(chunks)
+
+    if workers <= 1 or len(chunks) <= 1:
+        for i, chunk in enumerate(chunks):
+            if should_stop and should_stop():
+                break
+            results[i] = _anonymize_chunk(
+                chunk,
+                modality,
+                header_only,
+                profile,
+                scrub,
+                pseudonym_db,
+                link_unchanged,
+                fsync,
+            )
+            _report_chunk(chunk, results[i], report)
+    else:
+        pool_cls = ProcessPoolExecutor if executor == "process" else ThreadPoolExecutor
+        max_in_flight = workers * 2
+
+        with pool_cls(max_workers=workers) as pool:
+            in_flight = {}
+            next_chunk = 0
+
+            while next_chunk < len(chunks) or in_flight:
+                # 补充任务，限制在途数量
+                while next_chunk < len(chunks) and len(in_flight) < max_in_flight:
+                    if should_stop and should_stop():
+                        next_chunk = len(chunks)
+                        break
+                    future = pool.submit(
+                        _anonymize_chunk,
+                        chunks[next_chunk],
+                        modality,
+                        header_only,
+                        profile,
+                        scrub,
+                        pseudonym_db,
+                        link_unchanged,
+                        fsync,
+                    )
+                    in_flight[future] = next_chunk
+                    next_chunk += 1
+
+                if not in_flight:
+                    break
+
+                done, _ = wait(in_flight, return_when=FIRST_COMPLETED)
+                for future in done:
+                    i = in_flight.pop(future)
+                    try:
+                        results[i] = future.result()
+                    except Exception as e:
+                        # 整个分块失败（例如子进程崩溃）
+                        results[i] = [str(e)] * len(chunks[i])
+                    _report_chunk(chunks[i], results[i], report)
+
+    count = 0
+    errors = []
+    for chunk, chunk_results in zip(chunks, results):
+        if chunk_results is None:
+            continue
+        for (path, _), error in zip(chunk, chunk_results):
+            if error is None:
+                count += 1
+            else:
+                errors.append((path, error))
+
+    if log and errors:
+        log_dicom_errors(errors, log)
+
+    return count, errors
+
+
+def _report_chunk(chunk, chunk_results, report):
+    if report is None:
+        return
+    for (path, _), error in zip(chunk, chunk_results):
+        report(path, error is None, error)
+
+
+def _anonymize_chunk(
+    pairs,
+    modality,
+    header_only=True,
+    profile=None,
+    scrub=SCRUB_PYDICOM,
+    pseudonym_db=None,
+    link_unchanged=False,
+    fsync=FSYNC_NONE,
+):
+    """处理一个分块 [(src, dst), ...]，返回对应的错误信息列表（成功为 None）"""
+    results = []
+    for path, dst_path in pairs:
+        try:
+            _anonymize_dicom(
+                path,
+                modality,
+                header_only,
+                dst_path,
+                profile,
+                scrub,
+                pseudonym_db,
+                link_unchanged,
+                fsync,
+            )
+            results.append(None)
+        except Exception as e:
+            results.append(f"{type(e).__name__}: {e}")
+    return results
+
+
+def log_dicom_errors(errors, log, max_examples=5):
+    """按错误信息分组汇总输出，避免逐文件输出 traceback"""
+    grouped = {}
+    for path, error in errors:
+        grouped.setdefault(error, []).append(path)
+
+    log(f"  ❌ {len(errors)} files failed ({len(grouped)} distinct errors)")
+    for error, paths in list(grouped.items())[:max_examples]:
+        log(f"    {len(paths)} x {error}")
+        log(f"      e.g. {paths[0]}")
+    if len(grouped) > max_examples:
+        log(f"    ... {len(grouped) - max_examples} more distinct errors")
@@ -1,157 +1,169 @@
 import os
 import pydicom
-from pydicom.tag import Tag
+from dicom_stream import (
+    read_header,
+    write_header_with_tail,
+    clone_file,
+    HeaderOnlyUnsupported,
+)
+from atomic_output import FSYNC_NONE, AtomicOutput
+from dicom_scrub import ScrubUnsupported, needs_scrub
+from dicom_pixel_mask import (
+    PixelMaskUnsupported,
+    is_encapsulated,
+    mask_dataset,
+    pixel_mask_patch,
+)
+from deid_profile import get_profile
 import traceback
 
 
-def anonymize_ultrasound_dicom_complete(case_dir, log=None):
+def anonymize_ultrasound_dicom_complete(
+    case_dir,
+    log=None,
+    dicom_files=None,
+    header_only=True,
+    dst_files=None,
+    report=None,
+    pixel_mask_cfg=None,
+    mask_regions=None,
+    frame_workers=1,
+    profile=None,
+    pseudonym_db=None,
+    link_unchanged=False,
+    fsync=FSYNC_NONE,
+):
     """
     完全去匿名化 - 包括Weasis中显示的所有信息
     简化log输出，不显示具体PHI值
+    dicom_files 不为 None 时直接使用（来自扫描清单），不再遍历目录
+    header_only=True 时只解析/重写头部，多帧像素数据原样拷贝
+    dst_files 与 dicom_files 一一对应时，结果直接写到目标路径，源文件不变
+    report(path, ok, error) 在每个文件处理后调用
+    pixel_mask_cfg（视频遮罩配置 direction / size）或 mask_regions 不为空时，
+    同时遮罩所有帧中烧录的患者信息（见 dicom_pixel_mask）；无法遮罩的文件记为失败，不写出
+    （只写头部时像素数据经 np.memmap 在输出文件中原地遮罩）
+    JPEG Baseline 封装的文件用 frame_workers 个线程逐帧遮罩
+    profile 为去标识规则文件路径（None 时使用默认规则）
+    pseudonym_db 不为 None 时 UID 与 PatientID 映射为稳定的替代值，而不是删除
+    不需要修改的文件不解析，输出目录中用 clone_file 放置（link_unchanged=True 时可用硬链接）
+    输出先写临时文件再 os.replace（见 atomic_output），fsync 为刷盘策略
     """
-    # 扩展PHI标签列表，确保覆盖所有时间相关标签
-    PHI_TAGS = [
-        # Patient Information
-        (0x0010, 0x0010),  # PatientName
-        (0x0010, 0x0020),  # PatientID
-        (0x0010, 0x0030),  # PatientBirthDate
-        (0x0010, 0x0040),  # PatientSex
-        (0x0010, 0x1010),  # PatientAge
-        # Study Information - 所有时间相关标签
-        (0x0008, 0x0020),  # StudyDate
-        (0x0008, 0x0021),  # SeriesDate
-        (0x0008, 0x0022),  # AcquisitionDate  # ✅ Acq日期
-        (0x0008, 0x0023),  # ContentDate
-        (0x0008, 0x0030),  # StudyTime
-        (0x0008, 0x0031),  # SeriesTime
-        (0x0008, 0x0032),  # AcquisitionTime  # ✅ Acq时间
-        (0x0008, 0x0033),  # ContentTime
-        # 其他重要PHI
-        (0x0008, 0x0080),  # InstitutionName
-        (0x0008, 0x0090),  # ReferringPhysicianName
-        (0x0008, 0x1070),  # OperatorsName
-        (0x0008, 0x0081),  # InstitutionAddress
-        (0x0008, 0x1040),  # InstitutionalDepartmentName
-        (0x0008, 0x1048),  # PhysicianReadingStudy
-        (0x0008, 0x1050),  # PerformingPhysicianName
-        # Study/Series/Image Identifiers
-        (0x0020, 0x000D),  # StudyInstanceUID
-        (0x0020, 0x000E),  # SeriesInstanceUID
-        (0x0020, 0x0010),  # StudyID
-        (0x0020, 0x0011),  # SeriesNumber
-        (0x0008, 0x0018),  # SOPInstanceUID
-        # 设备信息（可能包含序列号）
-        (0x0008, 0x0070),  # Manufacturer
-        (0x0008, 0x1090),  # ManufacturerModelName
-        (0x0018, 0x1000),  # DeviceSerialNumber
-    ]
-
-    # 定义标签名称映射（用于日志）
-    TAG_NAMES = {
-        (0x0008, 0x0022): "AcquisitionDate",
-        (0x0008, 0x0032): "AcquisitionTime",
-        (0x0008, 0x0080): "InstitutionName",
-        (0x0010, 0x0010): "PatientName",
-        (0x0010, 0x0020): "PatientID",
-        (0x0010, 0x0030): "PatientBirthDate",
-        (0x0010, 0x0040): "PatientSex",
-        (0x0008, 0x0020): "StudyDate",
-        (0x0008, 0x0030): "StudyTime",
-        (0x0020, 0x0010): "StudyID",
-    }
+    # 去标识规则（默认规则见 deid_profile.DEFAULT_PROFILE 中的 "Ultrasound DICOM"）
+    rules = get_profile(profile, "Ultrasound DICOM", pseudonym_db)
 
     files_processed = 0
-    total_files = sum(
-        1
-        for root, _, files in os.walk(case_dir)
-        for f in files
-        if f.lower().endswith(".dcm")
-    )
+    if dicom_files is None:
+        dicom_files = [
+            os.path.join(root, f)
+            for root, _, files in os.walk(case_dir)
+            for f in files
+            if f.lower().endswith(".dcm")
+        ]
+    total_files = len(dicom_files)
 
     if log:
         log(f"开始处理目录: {case_dir}")
         log(f"发现 {total_files} 个DICOM文件")
 
-    for root, _, files in os.walk(case_dir):
-        for f in files:
-            if not f.lower().endswith(".dcm"):
-                continue
+    mask_pixels = bool(pixel_mask_cfg or mask_regions)
 
-            path = os.path.join(root, f)
-            file_has_phi = False
-            deleted_tags = []
+    for path, dst_path in zip(dicom_files, dst_files or dicom_files):
+        f = os.path.basename(path)
+        file_has_phi = False
+        deleted_tags = []
+        pixels_masked = False
+        patch = None
 
-            try:
-                # ==================== 读取文件 ====================
-                ds = pydicom.dcmread(path, force=True)
+        try:
+            if dst_path != path:
+                os.makedirs(os.path.dirname(dst_path), exist_ok=True)
 
-                # ==================== 检查并删除PHI ====================
-                for tag_tuple in PHI_TAGS:
-                    tag = Tag(tag_tuple)
-                    if tag in ds:
-                        tag_name = TAG_NAMES.get(tag_tuple, f"Tag{tag_tuple}")
-                        deleted_tags.append(tag_name)
-
-                        try:
-                            del ds[tag]
-                        except Exception:
-                            # 如果删除失败，尝试设置为空或默认值
-                            try:
-                                if tag_tuple in [
-                                    (0x0008, 0x0020),
-                                    (0x0008, 0x0021),
-                                    (0x0008, 0x0022),
-                                    (0x0008, 0x0023),
-                                ]:
-                                    ds[tag].value = "19000101"  # 日期默认值
-                                elif tag_tuple in [
-                                    (0x0008, 0x0030),
-                                    (0x0008, 0x0031),
-                                    (0x0008, 0x0032),
-                                    (0x0008, 0x0033),
-                                ]:
-                                    ds[tag].value = "000000"  # 时间默认值
-                                elif tag_tuple == (0x0010, 0x0030):  # 出生日期
-                                    ds[tag].value = "19000101"
-                                elif tag_tuple == (0x0010, 0x0040):  # 性别
-                                    ds[tag].value = "O"  # Other
-                                elif tag_tuple == (0x0008, 0x0080):  # 机构名称
-                                    ds[tag].value = "ANONYMIZED"
-                                else:
-                                    ds[tag].value = ""  # 其他设为空
-                            except Exception:
-                                pass  # 如果设置也失败，继续
-
-                # ==================== 保存文件 ====================
-                if deleted_tags:
-                    file_has_phi = True
-                    # 创建备份（可选）
-                    backup_path = path + ".backup"
-                    import shutil
-
-                    shutil.copy2(path, backup_path)
-
-                    # 保存修改后的文件
-                    ds.save_as(path, write_like_original=True)
-
-                    # 删除备份（如果需要保留备份，注释掉这行）
-                    if os.path.exists(backup_path):
-                        os.remove(backup_path)
-
-                    files_processed += 1
-
-                # ==================== 简化日志输出 ====================
-                if log and file_has_phi:
-                    log(f"✅ {f}: 已删除 {len(deleted_tags)} 个PHI标签")
-                    # 如果需要详细标签信息（但不显示具体值）
-                    if len(deleted_tags) <= 5:  # 标签少时显示
-                        log(f"   删除的标签: {', '.join(deleted_tags)}")
-                elif log and not file_has_phi:
+            # ==================== 快速检查 ====================
+            if not mask_pixels and _nothing_to_scrub(path, rules):
+                # 头部没有需要修改的元素（例如已经去标识过）：不解析也不重写
+                if dst_path != path:
+                    clone_file(path, dst_path, link_unchanged)
+                if log:
                     log(f"ℹ️  {f}: 未发现PHI标签")
+                if report:
+                    report(path, True, None)
+                continue
 
-            except Exception as e:
-                if log:
-                    log(f"❌ {f}: 处理失败 - {str(e)[:100]}")  # 只显示前100字符
+            # ==================== 读取文件 ====================
+            ds = None
+            pixel_offset = None
+            if header_only:
+                try:
+                    ds, pixel_offset = read_header(path)
+                except HeaderOnlyUnsupported:
+                    ds = None
+                if ds is not None and mask_pixels and is_encapsulated(ds):
+                    # 封装的 JPEG 帧需要完整读取后逐帧处理
+                    ds, pixel_offset = None, None
+            if ds is None:
+                ds = pydicom.dcmread(path, force=True)
+
+            # ==================== 检查并删除PHI ====================
+            deleted_tags = rules.apply(ds)
+
+            # ==================== 遮罩烧录的信息 ====================
+            if mask_pixels and pixel_offset is not None:
+                patch = pixel_mask_patch(
+                    ds, path, pixel_offset, pixel_mask_cfg, mask_regions or ()
+                )
+                pixels_masked = patch is not None
+            elif mask_pixels:
+                pixels_masked = mask_dataset(
+                    ds, pixel_mask_cfg, mask_regions or (), frame_workers
+                )
+
+            # ==================== 保存文件 ====================
+            modified = bool(deleted_tags) or pixels_masked
+            if modified and pixel_offset is not None:
+                file_has_phi = True
+                # 写临时文件后替换，无需备份
+                write_header_with_tail(
+                    ds, path, pixel_offset, dst_path, patch=patch, fsync=fsync
+                )
+                files_processed += 1
+
+            elif modified:
+                file_has_phi = True
+                # 写临时文件后替换（原地或输出目录），无需备份
+                with AtomicOutput(dst_path, path, fsync) as output:
+                    ds.save_as(output.path, write_like_original=True)
+                files_processed += 1
+
+            if not modified and dst_path != path:
+                # 无需修改的文件原样放到输出目录
+                clone_file(path, dst_path, link_unchanged)
+
+            # ==================== 简化日志输出 ====================
+            if log and file_has_phi:
+                log(f"✅ {f}: 已删除 {len(deleted_tags)} 个PHI标签")
+                if pixels_masked:
+                    log("   已遮罩所有帧中的烧录信息")
+                # 如果需要详细标签信息（但不显示具体值）
+                if len(deleted_tags) <= 5:  # 标签少时显示
+                    log(f"   删除的标签: {', '.join(deleted_tags)}")
+            elif log and not file_has_phi:
+                log(f"ℹ️  {f}: 未发现PHI标签")
+
+            if report:
+                report(path, True, None)
+
+        except PixelMaskUnsupported as e:
+            if log:
+                log(f"❌ {f}: 无法遮罩像素，未写出 - {e}")
+            if report:
+                report(path, False, str(e))
+
+        except Exception as e:
+            if log:
+                log(f"❌ {f}: 处理失败 - {str(e)[:100]}")  # 只显示前100字符
+            if report:
+                report(path, False, str(e))
 
     # 总结报告
     if log:
@@ -162,3 +174,11 @@ def anonymize_ultrasound_dicom_complete(case_dir, log=None):
         log(f"未发现PHI的文件: {total_files - files_processed}")
 
     return files_processed
+
+
+def _nothing_to_scrub(path, rules):
+    """按字节扫描头部；无法扫描时按需要处理"""
+    try:
+        return not needs_scrub(path, rules)
+    except ScrubUnsupported:
+        return False
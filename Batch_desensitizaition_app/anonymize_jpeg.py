@@ -0,0 +1,170 @@
+import os
+from functools import lru_cache
+import cv2
+import numpy as np
+from mask_plan import region_plan
+from dicom_stream import clone_file
+from atomic_output import FSYNC_NONE, AtomicOutput
+
+
+# cv2.inpaint 的邻域半径
+INPAINT_RADIUS = 3
+
+# 裁剪区域在遮罩外扩展的像素数，需大于 INPAINT_RADIUS，保证与整图修复结果一致
+INPAINT_PADDING = 2 * INPAINT_RADIUS + 2
+
+
+def find_jpeg_files(case_dir):
+    """
+    递归查找目录中的所有JPEG文件
+    """
+    jpeg_files = []
+    for root, dirs, files in os.walk(case_dir):
+        for f in files:
+            if f.lower().endswith((".jpg", ".jpeg")):
+                jpeg_files.append(os.path.join(root, f))
+    return jpeg_files
+
+
+def process_jpeg_files(
+    case_dir,
+    mask_cfg,
+    log=None,
+    should_stop=None,
+    jpeg_files=None,
+    dst_files=None,
+    report=None,
+    fsync=FSYNC_NONE,
+):
+    """
+    处理目录中的所有JPEG文件（按 mask_cfg 中的区域遮罩）
+    jpeg_files 不为 None 时直接使用（来自扫描清单），不再遍历目录
+    dst_files 与 jpeg_files 一一对应时，结果直接写到目标路径，源文件不变
+    report(path, ok, error) 在每个文件处理后调用
+    结果先写临时文件再 os.replace（见 atomic_output），fsync 为刷盘策略
+    """
+    jpeg_count = 0
+
+    # 查找所有JPEG文件
+    if jpeg_files is None:
+        jpeg_files = find_jpeg_files(case_dir)
+
+    if not jpeg_files:
+        return 0
+
+    if log:
+        log(f"Found {len(jpeg_files)} JPEG files to process")
+
+    regions = mask_cfg.get("regions", [])
+    method = mask_cfg.get("method", "black")
+
+    for jpeg_path, dst_path in zip(jpeg_files, dst_files or jpeg_files):
+        if should_stop and should_stop():
+            break
+
+        try:
+            if dst_path != jpeg_path:
+                os.makedirs(os.path.dirname(dst_path), exist_ok=True)
+
+            # 读取图片
+            img = cv2.imread(jpeg_path)
+            if img is None:
+                # 无法解码的文件原样保留
+                if dst_path != jpeg_path:
+                    clone_file(jpeg_path, dst_path)
+                if report:
+                    report(jpeg_path, True, None)
+                continue
+
+            height, width = img.shape[:2]
+            result = img.copy()
+            plan = region_plan(regions, width, height)
+
+            # 应用所有遮罩区域
+            if method == "black":
+                plan.apply(result)
+            elif method == "blur":
+                for x1, y1, x2, y2 in plan.rects:
+                    roi = result[y1:y2, x1:x2]
+                    if roi.size > 0:
+                        blurred = cv2.GaussianBlur(roi, (51, 51), 0)
+                        result[y1:y2, x1:x2] = blurred
+            elif method == "inpaint":
+                inpaint_regions(result, plan)
+
+            # 保存结果（cv2.imwrite 失败时只返回 False）
+            with AtomicOutput(dst_path, jpeg_path, fsync) as output:
+                if not cv2.imwrite(output.path, result):
+                    raise RuntimeError("Cannot write JPEG")
+            jpeg_count += 1
+            if report:
+                report(jpeg_path, True, None)
+
+        except Exception as e:
+            if log:
+                log(f"  ❌ Error processing {os.path.basename(jpeg_path)}: {str(e)}")
+            if report:
+                report(jpeg_path, False, str(e))
+
+    return jpeg_count
+
+
+def inpaint_regions(img, plan):
+    """
+    遮罩计划 plan 中的所有区域合并成一个遮罩，只在各区域外扩 INPAINT_PADDING 后的裁剪块上修复，
+    结果原地写回 img
+    """
+    for (ys, xs), mask in inpaint_plan(plan):
+        img[ys, xs] = cv2.inpaint(img[ys, xs], mask, INPAINT_RADIUS, cv2.INPAINT_TELEA)
+    return img
+
+
+@lru_cache(maxsize=16)
+def inpaint_plan(plan):
+    """
+    返回 [((行切片, 列切片), 裁剪块遮罩), ...]，按遮罩计划缓存（计划本身按图像尺寸和区域缓存）
+    外扩后相互重叠的区域合并到同一个裁剪块中
+    """
+    width, height = plan.width, plan.height
+    mask = plan.apply(np.zeros((height, width), dtype=np.uint8), 255)
+    boxes = []
+    for ys, xs in plan.slices:
+        boxes.append(
+            [
+                max(0, xs.start - INPAINT_PADDING),
+                max(0, ys.start - INPAINT_PADDING),
+                min(width, xs.stop + INPAINT_PADDING),
+                min(height, ys.stop + INPAINT_PADDING),
+            ]
+        )
+
+    # 合并重叠的裁剪块，直到互不相交
+    merged = []
+    for box in boxes:
+        i = 0
+        while i < len(merged):
+            other = merged[i]
+            if (
+                box[0] < other[2]
+                and other[0] < box[2]
+                and box[1] < other[3]
+                and other[1] < box[3]
+            ):
+                box = [
+                    min(box[0], other[0]),
+                    min(box[1], other[1]),
+                    max(box[2], other[2]),
+                    max(box[3], other[3]),
+                ]
+                del merged[i]
+                i = 0  # 扩大后可能与之前检查过的块重叠
+            else:
+                i += 1
+        merged.append(box)
+
+    crops = []
+    for x1, y1, x2, y2 in merged:
+        crop = (slice(y1, y2), slice(x1, x2))
+        if mask[crop].any():
+            crops.append((crop, mask[crop].copy()))
+    return crops
@@ -1,16 +1,38 @@
 import os
-from anonymize_common import find_dicom_files, anonymize_dicom_file
+from anonymize_common import find_dicom_files, anonymize_dicom_files
 
 
-def anonymize_mri_case(case_dir, log):
+def anonymize_mri_case(
+    case_dir,
+    log,
+    workers=1,
+    executor="thread",
+    should_stop=None,
+    dicom_files=None,
+    header_only=True,
+    dst_files=None,
+    report=None,
+    profile=None,
+    scrub="pydicom",
+    pseudonym_db=None,
+    link_unchanged=False,
+    fsync="none",
+):
     """
     MRI DICOM匿名化 - 自动搜索所有DICOM文件
+    dst_files 与 dicom_files 一一对应时，结果直接写到输出目录，源文件不变
+    profile 为去标识规则文件路径（None 时使用默认规则）
+    scrub 为头部去标识的方式（pydicom / raw / same-length，见 dicom_scrub）
+    pseudonym_db 为假名映射库路径（None 时不做假名映射）
+    link_unchanged=True 时不需要修改的文件可以硬链接到输出目录
+    fsync 为输出文件的刷盘策略（none / file / full，见 atomic_output）
     """
     log(f"\n=== Processing MRI case ===")
     log(f"Directory: {case_dir}")
 
-    # 查找所有DICOM文件
-    dicom_files = find_dicom_files(case_dir, log)
+    # 查找所有DICOM文件（引擎已扫描时直接使用清单中的文件）
+    if dicom_files is None:
+        dicom_files = find_dicom_files(case_dir, log)
 
     if not dicom_files:
         log(f"[WARN] No DICOM files found in {case_dir}")
@@ -18,13 +40,23 @@ def anonymize_mri_case(case_dir, log):
 
     log(f"Found {len(dicom_files)} DICOM files to process")
 
-    # 处理每个DICOM文件
-    count = 0
-    for i, dicom_path in enumerate(dicom_files, 1):
-        # log(f"\n[{i}/{len(dicom_files)}] Processing {os.path.basename(dicom_path)}...")
-
-        if anonymize_dicom_file(dicom_path, "MRI", log):
-            count += 1
+    # 处理每个DICOM文件（workers > 1 时分块并行）
+    count, errors = anonymize_dicom_files(
+        dicom_files,
+        "MRI",
+        log,
+        workers=workers,
+        executor=executor,
+        should_stop=should_stop,
+        header_only=header_only,
+        dst_files=dst_files,
+        report=report,
+        profile=profile,
+        scrub=scrub,
+        pseudonym_db=pseudonym_db,
+        link_unchanged=link_unchanged,
+        fsync=fsync,
+    )
 
     log(f"\n=== MRI Processing Complete ===")
     log(f"Successfully anonymized {count}/{len(dicom_files)} files")
@@ -0,0 +1,340 @@
+import os
+import time
+import queue
+import tempfile
+import threading
+import numpy as np
+import cv2
+from mask_plan import video_plan
+
+
+# 流水线中每个队列的最大长度；预分配的帧缓冲数量为 2 * PIPELINE_DEPTH + 2
+PIPELINE_DEPTH = 4
+
+# 候选编码器：MJPG 是 macOS QuickTime 最兼容的 AVI 编码器，XVID 作为备用
+CODECS = ("MJPG", "XVID")
+
+# 编码器探测结果缓存（每个进程一份）：(codec, width, height, fps) -> bool
+_probe_cache = {}
+
+
+class CodecFailed(RuntimeError):
+    """探测通过的编码器在实际写出时失败（可以换下一个候选重试）"""
+
+
+def anonymize_video(src, dst, direction, size, modality=None, stats=None):
+    """
+    使用 OpenCV 处理视频遮罩，专门为 macOS 生成可播放的 AVI
+    编码器和输出尺寸在解码任何帧之前由探测确定（见 writer_candidates）；
+    实际写出失败或输出校验不通过时，把该组合标记为不可用，换下一个候选重新处理
+    stats 为字典时写入各阶段耗时（见 run_pipeline）
+    """
+    print(f"[DEBUG] Processing {os.path.basename(src)}")
+
+    # 读取视频信息
+    cap = cv2.VideoCapture(src)
+    if not cap.isOpened():
+        raise RuntimeError(f"Cannot open video: {src}")
+    try:
+        fps = cap.get(cv2.CAP_PROP_FPS)
+        if fps <= 1:
+            fps = 30  # 默认帧率
+
+        width = int(cap.get(cv2.CAP_PROP_FRAME_WIDTH))
+        height = int(cap.get(cv2.CAP_PROP_FRAME_HEIGHT))
+    finally:
+        cap.release()
+
+    print(f"[DEBUG] Input video: {width}x{height}, {fps}fps")
+
+    error = None
+    for codec, frame_size in writer_candidates(width, height, fps):
+        print(f"[DEBUG] Writer: {codec}, {frame_size[0]}x{frame_size[1]}")
+        try:
+            frame_count = encode_video(
+                src, dst, codec, frame_size, fps, direction, size, stats
+            )
+        except CodecFailed as e:
+            print(f"[DEBUG] {codec} failed: {e}, trying the next codec")
+            mark_writer_failed(codec, frame_size, fps)
+            error = e
+            continue
+
+        file_size = os.path.getsize(dst)
+        print(
+            f"[DEBUG] Created {codec} AVI: {dst} ({file_size:,} bytes, {frame_count} frames)"
+        )
+        return frame_count
+
+    raise RuntimeError(
+        f"No working video codec for {width}x{height} @ {fps}fps (tried {', '.join(CODECS)})"
+    ) from error
+
+
+def encode_video(src, dst, codec, frame_size, fps, direction, size, stats=None):
+    """
+    用指定的编码器和输出尺寸处理整个视频，返回帧数
+    编码器无法创建、写入出错或输出校验不通过时抛出 CodecFailed
+    """
+    cap = cv2.VideoCapture(src)
+    if not cap.isOpened():
+        raise RuntimeError(f"Cannot open video: {src}")
+
+    try:
+        plan = video_plan(direction, size, frame_size[0], frame_size[1])
+        print(f"[DEBUG] Mask: {direction}, {plan.rects[0]}")
+
+        writer = cv2.VideoWriter(
+            dst, cv2.VideoWriter_fourcc(*codec), fps, frame_size, True
+        )
+        if not writer.isOpened():
+            raise CodecFailed(f"Cannot create video writer with {codec} codec")
+
+        try:
+            frame_count = run_pipeline(cap, writer, plan, stats, out_size=frame_size)
+        except cv2.error as e:
+            raise CodecFailed(str(e)) from e
+        finally:
+            writer.release()
+    finally:
+        cap.release()
+
+    # 验证输出文件
+    if frame_count == 0:
+        raise RuntimeError("No frames processed")
+
+    try:
+        verify_output(dst, frame_count)
+    except RuntimeError as e:
+        raise CodecFailed(str(e)) from e
+    return frame_count
+
+
+# ================= 编码器探测 =================
+
+
+def writer_candidates(width, height, fps):
+    """
+    按优先顺序逐个返回探测可用的 (codec, (width, height))
+    依次尝试：MJPG 原尺寸、MJPG 偶数尺寸、XVID 偶数尺寸
+    """
+    even = (width - width % 2, height - height % 2)
+    candidates = [("MJPG", (width, height)), ("MJPG", even), ("XVID", even)]
+
+    for codec, frame_size in dict.fromkeys(candidates):
+        if probe_writer(codec, frame_size, fps):
+            yield codec, frame_size
+
+
+def _probe_key(codec, frame_size, fps):
+    return (codec, frame_size[0], frame_size[1], float(fps))
+
+
+def mark_writer_failed(codec, frame_size, fps):
+    """探测通过但实际写出失败：本进程内不再使用该组合"""
+    _probe_cache[_probe_key(codec, frame_size, fps)] = False
+
+
+def probe_writer(codec, frame_size, fps):
+    """
+    用几帧合成画面测试某个 (codec, 尺寸, 帧率) 组合能否写出可读的 AVI
+    结果在当前进程内缓存
+    """
+    key = _probe_key(codec, frame_size, fps)
+    if key in _probe_cache:
+        return _probe_cache[key]
+
+    fd, path = tempfile.mkstemp(prefix=".probe_", suffix=".avi")
+    os.close(fd)
+    ok = False
+    try:
+        writer = cv2.VideoWriter(
+            path, cv2.VideoWriter_fourcc(*codec), fps, frame_size, True
+        )
+        if writer.isOpened():
+            frame = np.zeros((frame_size[1], frame_size[0], 3), dtype=np.uint8)
+            for _ in range(2):
+                writer.write(frame)
+            writer.release()
+            try:
+                verify_output(path, 2)
+                ok = True
+            except RuntimeError:
+                ok = False
+        else:
+            writer.release()
+    except cv2.error:
+        ok = False
+    finally:
+        try:
+            os.remove(path)
+        except OSError:
+            pass
+
+    _probe_cache[key] = ok
+    return ok
+
+
+def verify_output(path, frame_count):
+    """
+    只检查容器头部和帧数，不重新解码画面
+    """
+    if not os.path.exists(path):
+        raise RuntimeError(f"Output file not created: {path}")
+
+    with open(path, "rb") as f:
+        header = f.read(12)
+    if len(header) < 12 or header[:4] != b"RIFF" or header[8:12] != b"AVI ":
+        raise RuntimeError("Output video has no valid AVI header")
+
+    cap = cv2.VideoCapture(path)
+    try:
+        if not cap.isOpened():
+            raise RuntimeError("Output video cannot be opened")
+        written = int(cap.get(cv2.CAP_PROP_FRAME_COUNT))
+    finally:
+        cap.release()
+
+    # 部分后端无法从头部得到帧数（返回 0 或负数），此时只做头部检查
+    if written > 0 and written != frame_count:
+        raise RuntimeError(
+            f"Output video has {written} frames, expected {frame_count}"
+        )
+
+
+# ================= 处理流水线 =================
+
+
+def run_pipeline(cap, writer, plan, stats=None, out_size=None):
+    """
+    解码 / 遮罩 / 编码 三段流水线
+    解码线程把帧读入预分配的缓冲区，当前线程按遮罩计划 plan 原地遮罩，编码线程写出后把缓冲区归还。
+    cap.read() 与 writer.write() 都会释放 GIL，因此解码与编码可以重叠执行。
+    out_size=(width, height) 与输入帧尺寸不同时先缩放（编码器要求偶数尺寸时）
+    stats 为字典时写入 frames、decode、mask、encode（各阶段累计秒数）和 wall（总耗时）
+    返回处理的帧数
+    """
+    decoded = queue.Queue(maxsize=PIPELINE_DEPTH)
+    encoded = queue.Queue(maxsize=PIPELINE_DEPTH)
+    free = queue.Queue()
+    width = int(cap.get(cv2.CAP_PROP_FRAME_WIDTH))
+    height = int(cap.get(cv2.CAP_PROP_FRAME_HEIGHT))
+    for _ in range(2 * PIPELINE_DEPTH + 2):
+        # 尺寸不符时 OpenCV 会自行重新分配，之后复用新的缓冲区
+        free.put(np.empty((height, width, 3), dtype=np.uint8))
+
+    abort = threading.Event()
+    errors = []
+    timing = {"decode": 0.0, "mask": 0.0, "encode": 0.0}
+    started = time.perf_counter()
+
+    def put(q, item):
+        # 下游出错时不再阻塞
+        while not abort.is_set():
+            try:
+                q.put(item, timeout=0.1)
+                return True
+            except queue.Full:
+                continue
+        return False
+
+    def end_stream(q):
+        # 出错后必须送达结束标记：队列已满时丢弃未处理的帧腾出位置
+        while True:
+            try:
+                q.put_nowait(None)
+                return
+            except queue.Full:
+                try:
+                    q.get_nowait()
+                except queue.Empty:
+                    pass
+
+    def decode():
+        try:
+            while not abort.is_set():
+                buf = free.get()
+                t0 = time.perf_counter()
+                ok, frame = cap.read(buf) if buf is not None else (False, None)
+                timing["decode"] += time.perf_counter() - t0
+                if not ok:
+                    break
+                if not put(decoded, frame):
+                    return
+        except Exception as e:
+            errors.append(e)
+            abort.set()
+        finally:
+            if not put(decoded, None):
+                end_stream(decoded)
+
+    def encode():
+        try:
+            while True:
+                frame = encoded.get()
+                if frame is None:
+                    break
+                t0 = time.perf_counter()
+                writer.write(frame)
+                timing["encode"] += time.perf_counter() - t0
+                free.put(frame)
+        except Exception as e:
+            errors.append(e)
+            abort.set()
+            free.put(None)  # 解除解码线程的等待
+
+    decoder = threading.Thread(target=decode, daemon=True)
+    encoder = threading.Thread(target=encode, daemon=True)
+    decoder.start()
+    encoder.start()
+
+    frame_count = 0
+    try:
+        while True:
+            try:
+                frame = decoded.get(timeout=0.1)
+            except queue.Empty:
+                if abort.is_set():
+                    break
+                continue
+            if frame is None:
+                break
+            t0 = time.perf_counter()
+            if out_size and (frame.shape[1], frame.shape[0]) != out_size:
+                frame = cv2.resize(frame, out_size)
+            plan.apply(frame)
+            timing["mask"] += time.perf_counter() - t0
+            frame_count += 1
+            if not put(encoded, frame):
+                break
+    except BaseException:
+        abort.set()
+        raise
+    finally:
+        if abort.is_set() or not put(encoded, None):
+            free.put(None)  # 解除解码线程的等待
+            end_stream(encoded)
+        decoder.join()
+        encoder.join()
+
+    if errors:
+        raise errors[0]
+
+    if stats is not None:
+        stats.update(timing)
+        stats["frames"] = frame_count
+        stats["wall"] = time.perf_counter() - started
+    return frame_count
+
+
+def format_stats(stats):
+    """把 run_pipeline 的统计格式化为一行日志"""
+    frames = stats.get("frames", 0)
+    wall = stats.get("wall", 0.0)
+    fps = frames / wall if wall > 0 else 0.0
+    return (
+        f"{frames} frames in {wall:.2f}s ({fps:.1f} fps; "
+        f"decode {stats.get('decode', 0.0):.2f}s, "
+        f"mask {stats.get('mask', 0.0):.2f}s, "
+        f"encode {stats.get('encode', 0.0):.2f}s)"
+    )
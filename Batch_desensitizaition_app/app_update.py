@@ -1,17 +1,19 @@
 import os
-import shutil
+import time
 import threading
 import tkinter as tk
 from tkinter import ttk, filedialog, messagebox
 import queue
+import multiprocessing
 import cv2
 from PIL import Image, ImageTk
-from anonymize_mri import anonymize_mri_case
-from anonymize_ct import anonymize_ct_case
-from anonymize_dicom import anonymize_ultrasound_dicom_complete
+from batch_engine import BatchEngine
+from preview_index import PreviewIndexer
+from scan_manifest import KIND_AVI, KIND_JPEG
+from progress_meter import format_progress, format_stages
+from ui_log import LOG_VIEW_LINES, UI_BUSY_DELAY, UI_DRAIN_BUDGET, LogFile, log_path
+from mask_plan import MAX_VIDEO_RATIO, region_plan, video_plan
 import sys
-import pydicom
-from pydicom.errors import InvalidDicomError
 import numpy as np
 
 
@@ -24,241 +26,9 @@ def resource_path(relative_path):
     return os.path.join(base_path, relative_path)
 
 
-# ================= DICOM anonymizer =================
-
-""" Import from anonymize_dicom """
-
-# ================= Video anonymizer =================
-
-
-def anonymize_video(src, dst, direction, size, modality=None):
-    """
-    使用 OpenCV 处理视频遮罩，专门为 macOS 生成可播放的 AVI
-    """
-    # macOS 上生成可播放 AVI 的最佳编码器设置
-    # 使用 MJPG 编码器，这是 macOS QuickTime 最兼容的 AVI 编码器
-    codec = "MJPG"  # macOS 上最兼容的 AVI 编码器
-
-    print(f"[DEBUG] Processing {os.path.basename(src)} with MJPG codec for macOS")
-
-    try:
-        # 读取视频
-        cap = cv2.VideoCapture(src)
-        if not cap.isOpened():
-            raise RuntimeError(f"Cannot open video: {src}")
-
-        # 获取视频信息
-        fps = cap.get(cv2.CAP_PROP_FPS)
-        if fps <= 1:
-            fps = 30  # 默认帧率
-
-        width = int(cap.get(cv2.CAP_PROP_FRAME_WIDTH))
-        height = int(cap.get(cv2.CAP_PROP_FRAME_HEIGHT))
-
-        print(f"[DEBUG] Input video: {width}x{height}, {fps}fps")
-
-        size_value = int(size)
-
-        # 根据 modality 设置最大比例
-        max_ratio = 0.75
-
-        if direction == "top":
-            mask_px = min(size_value, int(height * max_ratio))
-            mask_px = max(10, min(mask_px, height - 10))
-        elif direction == "right":  # 右侧
-            mask_px = min(size_value, int(width * max_ratio))
-            mask_px = max(10, min(mask_px, width - 10))
-        else:  # left - 新增左侧遮罩
-            mask_px = min(size_value, int(width * max_ratio))
-            mask_px = max(10, min(mask_px, width - 10))
-
-        print(f"[DEBUG] Mask: {direction}, {mask_px}px")
-
-        # 创建视频写入器 - 使用 MJPG 编码器和高质量设置
-        fourcc = cv2.VideoWriter_fourcc(*codec)
-
-        # macOS 上使用 .avi 扩展名，MJPG 编码器
-        writer = cv2.VideoWriter(dst, fourcc, fps, (width, height), True)
-
-        if not writer.isOpened():
-            cap.release()
-            # 如果默认设置失败，尝试其他兼容设置
-            print(f"[DEBUG] First attempt failed, trying alternative settings...")
-            writer = cv2.VideoWriter(dst, fourcc, fps, (width, height), isColor=True)
-
-            if not writer.isOpened():
-                # 最后尝试：如果宽度不是偶数，调整为偶数（MJPG要求）
-                if width % 2 != 0:
-                    width = width - 1
-                if height % 2 != 0:
-                    height = height - 1
-
-                writer = cv2.VideoWriter(
-                    dst, fourcc, fps, (width, height), isColor=True
-                )
-
-                if not writer.isOpened():
-                    raise RuntimeError(f"Cannot create video writer with MJPG codec")
-
-        frame_count = 0
-        success = True
-
-        while success:
-            success, frame = cap.read()
-            if not success:
-                break
-
-            frame_count += 1
-
-            # 应用遮罩
-            masked = frame.copy()
-            if direction == "top":
-                cv2.rectangle(masked, (0, 0), (width, mask_px), (0, 0, 0), -1)
-            elif direction == "right":  # 右侧
-                cv2.rectangle(
-                    masked, (width - mask_px, 0), (width, height), (0, 0, 0), -1
-                )
-            else:  # left - 左侧
-                cv2.rectangle(
-                    masked,
-                    (0, 0),
-                    (mask_px, height),
-                    (0, 0, 0),
-                    -1,  # 这里需要添加left的处理
-                )
-
-            writer.write(masked)
-
-        writer.release()
-        cap.release()
-
-        # 验证输出文件
-        if frame_count == 0:
-            raise RuntimeError("No frames processed")
-
-        if not os.path.exists(dst):
-            raise RuntimeError(f"Output file not created: {dst}")
-
-        file_size = os.path.getsize(dst)
-        print(
-            f"[DEBUG] Created AVI file: {dst} ({file_size:,} bytes, {frame_count} frames)"
-        )
-
-        # 测试视频是否可以读取
-        test_cap = cv2.VideoCapture(dst)
-        if not test_cap.isOpened():
-            raise RuntimeError("Output video cannot be opened")
-
-        ret, test_frame = test_cap.read()
-        test_cap.release()
-
-        if not ret:
-            raise RuntimeError("Output video is corrupted or unreadable")
-
-        print(f"[DEBUG] ✓ Successfully created macOS-compatible AVI")
-        return frame_count
-
-    except Exception as e:
-        print(f"[DEBUG] MJPG codec failed: {e}")
-
-        # 如果 MJPG 失败，尝试 XVID 作为备用
-        try:
-            print(f"[DEBUG] Trying XVID as fallback...")
-            return anonymize_video_fallback(src, dst, direction, size, modality)
-        except Exception as e2:
-            raise RuntimeError(
-                f"Video processing failed. MJPG error: {e}, Fallback error: {e2}"
-            )
-
-
-def anonymize_video_fallback(src, dst, direction, size, modality=None):
-    """
-    XVID 备用方案
-    """
-    cap = cv2.VideoCapture(src)
-    if not cap.isOpened():
-        raise RuntimeError(f"Cannot open video: {src}")
-
-    fps = cap.get(cv2.CAP_PROP_FPS)
-    if fps <= 1:
-        fps = 30
-
-    width = int(cap.get(cv2.CAP_PROP_FRAME_WIDTH))
-    height = int(cap.get(cv2.CAP_PROP_FRAME_HEIGHT))
-
-    # 确保尺寸是偶数（XVID要求）
-    if width % 2 != 0:
-        width = width - 1
-    if height % 2 != 0:
-        height = height - 1
-
-    # # 计算遮罩
-    # if modality == "Intracardiac Echo (ICE)":
-    #     max_ratio = 0.75
-    # elif modality == "Transthoracic Echo (TTE)":
-    #     max_ratio = 0.75
-    # else:
-    #     max_ratio = 0.75
-    max_ratio = 0.75
-
-    size_value = int(size)
-    if direction == "top":
-        mask_px = min(size_value, int(height * max_ratio))
-        mask_px = max(10, min(mask_px, height - 10))
-    else:
-        mask_px = min(size_value, int(width * max_ratio))
-        mask_px = max(10, min(mask_px, width - 10))
-
-    # 使用 XVID 编码器
-    fourcc = cv2.VideoWriter_fourcc(*"XVID")
-    writer = cv2.VideoWriter(dst, fourcc, fps, (width, height), True)
-
-    if not writer.isOpened():
-        cap.release()
-        raise RuntimeError("Cannot create video writer with XVID codec")
-
-    frame_count = 0
-    success = True
-
-    while success:
-        success, frame = cap.read()
-        if not success:
-            break
-
-        frame_count += 1
-
-        # 调整帧尺寸
-        frame = cv2.resize(frame, (width, height))
-
-        # 应用遮罩
-        masked = frame.copy()
-        if direction == "top":
-            cv2.rectangle(masked, (0, 0), (width, mask_px), (0, 0, 0), -1)
-        elif direction == "right":  # 右侧
-            cv2.rectangle(masked, (width - mask_px, 0), (width, height), (0, 0, 0), -1)
-        else:  # left - 左侧
-            cv2.rectangle(
-                masked, (0, 0), (mask_px, height), (0, 0, 0), -1
-            )  # 这里需要添加left的处理
-
-        writer.write(masked)
-
-    writer.release()
-    cap.release()
-
-    if frame_count == 0:
-        raise RuntimeError("No frames processed")
-
-    if not os.path.exists(dst):
-        raise RuntimeError(f"Output file not created: {dst}")
-
-    file_size = os.path.getsize(dst)
-    print(
-        f"[DEBUG] Created XVID AVI: {dst} ({file_size:,} bytes, {frame_count} frames)"
-    )
-
-    return frame_count
+# ================= Anonymizers =================
 
+""" Batch logic lives in batch_engine (shared with the command line) """
 
 # ================= Video Preview Window =================
 
@@ -394,7 +164,7 @@ class VideoPreviewWindow(tk.Toplevel):
         direction = self.mask_direction.get()
 
         if self.modality in ("Intracardiac Echo (ICE)", "Transthoracic Echo (TTE)"):
-            max_ratio = 0.75  # 最大75%
+            max_ratio = MAX_VIDEO_RATIO  # 最大75%
 
             if direction == "top":
                 # 上方遮罩：最大为高度的75%
@@ -458,31 +228,11 @@ class VideoPreviewWindow(tk.Toplevel):
 
         frame = cv2.resize(self.base_frame, (disp_w, disp_h))
 
-        size_value = self.mask_size.get()
-
-        # 根据 modality 设置最大比例
-        # if self.modality == "Intracardiac Echo (ICE)":
-        #     max_ratio = 0.75  # 改为75%
-        # elif self.modality == "Transthoracic Echo (TTE)":
-        #     max_ratio = 0.75  # 改为75%
-        # else:
-        #     max_ratio = 1.0
-        max_ratio = 0.75
-
-        direction = self.mask_direction.get()
-
-        if direction == "top":
-            mask_px_by_value = max(1, min(int(size_value), int(orig_h * max_ratio)))
-            mask_px_disp = int(mask_px_by_value * disp_h / orig_h)
-            x1, y1, x2, y2 = 0, 0, disp_w, mask_px_disp
-        elif direction == "right":
-            mask_px_by_value = max(1, min(int(size_value), int(orig_w * max_ratio)))
-            mask_px_disp = int(mask_px_by_value * disp_w / orig_w)
-            x1, y1, x2, y2 = disp_w - mask_px_disp, 0, disp_w, disp_h
-        else:  # left
-            mask_px_by_value = max(1, min(int(size_value), int(orig_w * max_ratio)))
-            mask_px_disp = int(mask_px_by_value * disp_w / orig_w)
-            x1, y1, x2, y2 = 0, 0, mask_px_disp, disp_h  # 左侧遮罩
+        # 与输出视频使用同一个遮罩计划，再缩放到显示尺寸
+        plan = video_plan(
+            self.mask_direction.get(), self.mask_size.get(), orig_w, orig_h
+        )
+        x1, y1, x2, y2 = plan.display_rects(disp_w, disp_h)[0]
 
         overlay = frame.copy()
         cv2.rectangle(overlay, (x1, y1), (x2, y2), (120, 120, 120), -1)
@@ -811,8 +561,9 @@ class JPEGPreviewWindow(tk.Toplevel):
             self.offset_x : self.offset_x + disp_w,
         ] = resized_frame
 
-        # 应用黑色遮罩
-        for i, region in enumerate(self.mask_regions):
+        # 应用黑色遮罩（与输出相同，区域先裁剪到图像范围内）
+        plan = region_plan(self.mask_regions, self.frame_w, self.frame_h)
+        for i, region in enumerate(plan.rects):
             x1, y1, x2, y2 = region
 
             # 转换到画布坐标
@@ -887,10 +638,11 @@ class BatchAnonymizationApp:
     def __init__(self, root):
         self.root = root
         self.root.title("Batch Medical Data Desensitization")
-        self.center_window(560, 620)
+        self.center_window(560, 650)
         self.root.resizable(False, False)
 
         self.keep_original = tk.BooleanVar(value=True)
+        self.case_workers = tk.IntVar(value=1)
 
         self.input_dir = tk.StringVar()
         self.modality = tk.StringVar(value="")
@@ -906,8 +658,18 @@ class BatchAnonymizationApp:
 
         self.ui_queue = queue.Queue()
         self._ui_polling = False
+        # 本次运行的完整日志（见 ui_log）；界面中只保留最近的 LOG_VIEW_LINES 行
+        self._log_file = None
+
+        # 预览样本的后台索引（见 preview_index）；_index 为当前目录最新的快照
+        self.indexer = PreviewIndexer(self._emit)
+        self._index = None
+        self._index_job = None
+        self._tried_samples = set()
+        self._loading_sample = None
 
         self._build_ui()
+        self.input_dir.trace_add("write", self._on_input_dir_changed)
         self._schedule_ui_queue()
 
     def _schedule_ui_queue(self):
@@ -916,44 +678,61 @@ class BatchAnonymizationApp:
             self.root.after(50, self._process_ui_queue)
 
     def _process_ui_queue(self):
-        processed = 0
+        """
+        在 UI_DRAIN_BUDGET 内取出队列中的所有消息：日志合并为一次插入，
+        进度只显示最新值；其他消息按顺序处理（之前积累的日志和进度先显示）
+        """
+        deadline = time.perf_counter() + UI_DRAIN_BUDGET
+        logs = []
+        progress = None
         try:
-            while processed < 3:
+            while time.perf_counter() < deadline:
                 msg = self.ui_queue.get_nowait()
-                processed += 1
-
                 kind = msg[0]
 
                 if kind == "log":
-                    self.append_log(msg[1])
+                    if msg[1]:
+                        logs.append(msg[1])
+                    continue
+
+                if kind == "progress":
+                    progress = msg
+                    continue
 
-                elif kind == "progress":
-                    _, percent, case = msg
-                    self._update_progress_ui(percent, case)
+                self._flush_ui_batch(logs, progress)
+                logs = []
+                progress = None
 
-                elif kind == "status":
+                if kind == "status":
                     _, text, color = msg
                     self.status_label.config(text=text, foreground=color)
 
                 elif kind == "done":
                     self._on_batch_finished()
 
-                elif kind == "video_found":
-                    _, video, frame = msg
-                    self._on_video_found(video, frame)
+                elif kind == "index":
+                    self._on_index(msg[1])
 
-                elif kind == "jpeg_found":
-                    _, jpeg_path, frame = msg
-                    self._on_jpeg_found(jpeg_path, frame)
+                elif kind == "sample_loaded":
+                    _, root, sample_kind, path, frame = msg
+                    self._on_sample_loaded(root, sample_kind, path, frame)
 
         except queue.Empty:
             pass
 
+        self._flush_ui_batch(logs, progress)
+
         if not self.ui_queue.empty():
-            self.root.after(30, self._process_ui_queue)
+            self.root.after(UI_BUSY_DELAY, self._process_ui_queue)
         else:
             self._ui_polling = False
 
+    def _flush_ui_batch(self, logs, progress):
+        if logs:
+            self.append_logs(logs)
+        if progress is not None:
+            self._update_progress_ui(*progress[1:])
+
     def _on_jpeg_mask_confirmed(self, mask_cfg):
         """JPEG遮罩配置确认回调"""
         self.jpeg_mask_cfg = mask_cfg
@@ -965,27 +744,6 @@ class BatchAnonymizationApp:
             ("log", f"JPEG mask configured: {len(mask_cfg['regions'])} regions")
         )
 
-    def _on_video_found(self, video, first_frame):
-        self.spinner.stop()
-        self.spinner.pack_forget()
-
-        if not video or first_frame is None:
-            self.status_label.config(
-                text="❌ No ultrasound AVI found or failed to read",
-                foreground="red",
-            )
-            self.preview_btn.config(state="disabled")
-            return
-
-        self._found_video = video
-        self._found_first_frame = first_frame
-
-        self.status_label.config(
-            text="Ultrasound video found. Click Preview to view.",
-            foreground="green",
-        )
-        self.preview_btn.config(state="normal")
-
     def center_window(self, width, height):
         screen_w = self.root.winfo_screenwidth()
         screen_h = self.root.winfo_screenheight()
@@ -1018,6 +776,18 @@ class BatchAnonymizationApp:
         )
         self.keep_original_chk.pack(anchor="w", pady=(6, 0))
 
+        workers_row = ttk.Frame(frame)
+        workers_row.pack(anchor="w", pady=(4, 0))
+        ttk.Label(workers_row, text="Parallel cases (processes):").pack(side="left")
+        ttk.Spinbox(
+            workers_row,
+            from_=1,
+            to=max(1, os.cpu_count() or 1),
+            width=4,
+            textvariable=self.case_workers,
+            state="readonly",
+        ).pack(side="left", padx=5)
+
         self.browse_btn = ttk.Button(row, text="Browse", command=self.browse)
         self.browse_btn.pack(side="left", padx=5)
 
@@ -1065,6 +835,10 @@ class BatchAnonymizationApp:
         self.current_case_label = ttk.Label(prog, text="Waiting...", foreground="gray")
         self.current_case_label.pack()
 
+        # 文件数、吞吐量、剩余时间与各阶段统计（progress 消息中的 ProgressInfo）
+        self.throughput_label = ttk.Label(prog, text="", foreground="gray")
+        self.throughput_label.pack()
+
         log_frame = ttk.LabelFrame(frame, text="Output")
         log_frame.pack(fill="both", expand=True, pady=(8, 0))
 
@@ -1107,9 +881,10 @@ class BatchAnonymizationApp:
                 foreground="orange",
             )
 
-            # 查找JPEG样本
+            # 查找JPEG样本（后台索引，结果见 _update_preview_source）
             if self.input_dir.get():
-                threading.Thread(target=self._find_jpeg_sample, daemon=True).start()
+                self.indexer.request(self.input_dir.get())
+                self._update_preview_source()
             else:
                 self.status_label.config(
                     text="Please select input directory first", foreground="gray"
@@ -1132,10 +907,8 @@ class BatchAnonymizationApp:
             self.spinner.pack(pady=5)
             self.spinner.start(10)
 
-            self._found_video = None
-            self._found_first_frame = None
-
-            threading.Thread(target=self._find_video, daemon=True).start()
+            self.indexer.request(self.input_dir.get())
+            self._update_preview_source()
 
         else:
             self.preview_btn.config(state="disabled")
@@ -1180,114 +953,168 @@ class BatchAnonymizationApp:
                 modality=self.modality.get(),
             )
 
-    def _find_video(self):
-        video = None
-        for r, _, fs in os.walk(self.input_dir.get()):
-            for f in fs:
-                if f.lower().endswith(".avi"):
-                    video = os.path.join(r, f)
-                    break
-            if video:
-                break
-
-        if not video:
-            self.ui_queue.put(("video_found", None, None))
-            self._schedule_ui_queue()
-            return
+    # ================= 预览样本 =================
 
-        cap = cv2.VideoCapture(video)
-        ret, frame = cap.read()
-        cap.release()
+    def _on_input_dir_changed(self, *_):
+        """目录改变：丢弃旧的样本，稍后（输入停顿时）在后台开始索引"""
+        self._index = None
+        self._tried_samples = set()
+        self._loading_sample = None
+        self._found_video = None
+        self._found_first_frame = None
+        self._found_jpeg = None
+        self._found_first_jpeg_frame = None
 
-        self.ui_queue.put(("video_found", video, frame if ret else None))
-        self._schedule_ui_queue()
+        if self._index_job is not None:
+            self.root.after_cancel(self._index_job)
+        self._index_job = self.root.after(300, self._request_index)
 
-    def _find_jpeg_sample(self):
-        """在MRI/CT目录中查找JPEG文件作为样本"""
-        jpeg_path = None
-        sample_image = None
-
-        # 查找exam/jpeg目录
-        target_dir = self.input_dir.get()
-
-        # 检查是否存在exam/jpeg目录
-        jpeg_dir = os.path.join(target_dir, "exam", "jpeg")
-
-        if os.path.exists(jpeg_dir) and os.path.isdir(jpeg_dir):
-            # 查找第一个JPEG文件
-            for f in os.listdir(jpeg_dir):
-                if f.lower().endswith((".jpg", ".jpeg")):
-                    jpeg_path = os.path.join(jpeg_dir, f)
-                    try:
-                        # 读取图片
-                        img = cv2.imread(jpeg_path)
-                        if img is not None:
-                            sample_image = img
-                            break
-                    except:
-                        continue
-
-        # 如果没有找到，在目录中搜索任何JPEG文件
-        if not jpeg_path:
-            for root, dirs, files in os.walk(target_dir):
-                for f in files:
-                    if f.lower().endswith((".jpg", ".jpeg")):
-                        jpeg_path = os.path.join(root, f)
-                        try:
-                            img = cv2.imread(jpeg_path)
-                            if img is not None:
-                                sample_image = img
-                                break
-                        except:
-                            continue
-                if jpeg_path:
-                    break
+    def _request_index(self):
+        self._index_job = None
+        if os.path.isdir(self.input_dir.get()):
+            self.indexer.request(self.input_dir.get())
 
-        # 更新UI
-        self.ui_queue.put(("jpeg_found", jpeg_path, sample_image))
-        self._schedule_ui_queue()
+    def _on_index(self, snapshot):
+        """索引（部分）结果：只处理当前目录的"""
+        if snapshot.root != os.path.abspath(self.input_dir.get()):
+            return
+        self._index = snapshot
+        self._update_preview_source()
 
-    def _on_jpeg_found(self, jpeg_path, sample_image):
-        """JPEG样本找到后的处理"""
-        if not jpeg_path or sample_image is None:
-            self.status_label.config(
-                text="No JPEG files found in the selected directory", foreground="gray"
-            )
-            self.preview_btn.config(state="disabled")
+    def _preview_kind(self):
+        selected = self.modality.get()
+        if selected in ["MRI", "CT"]:
+            return KIND_JPEG
+        if selected in ("Intracardiac Echo (ICE)", "Transthoracic Echo (TTE)"):
+            return KIND_AVI
+        return None
+
+    def _update_preview_source(self):
+        """
+        根据当前模态和索引结果更新预览按钮与状态：
+        已有可读的样本时直接使用，否则在后台读取下一个尚未尝试的样本
+        """
+        kind = self._preview_kind()
+        if kind != KIND_AVI:
+            self.spinner.stop()
+            self.spinner.pack_forget()
+        index = self._index
+        if kind is None or index is None or not self.input_dir.get():
             return
 
-        self._found_jpeg = jpeg_path
-        self._found_first_jpeg_frame = sample_image
+        if kind == KIND_JPEG and self._found_first_jpeg_frame is not None:
+            self._show_jpeg_found(index)
+            return
+        if kind == KIND_AVI and self._found_first_frame is not None:
+            self._show_video_found()
+            return
+        if self._loading_sample is not None:
+            return
 
-        # 获取目录中JPEG文件总数
-        jpeg_count = 0
-        for root, dirs, files in os.walk(self.input_dir.get()):
-            for f in files:
-                if f.lower().endswith((".jpg", ".jpeg")):
-                    jpeg_count += 1
+        for path in index.samples[kind]:
+            if path not in self._tried_samples:
+                self._tried_samples.add(path)
+                self._loading_sample = path
+                threading.Thread(
+                    target=self._load_sample,
+                    args=(index.root, kind, path),
+                    daemon=True,
+                ).start()
+                return
 
-        if jpeg_count > 0:
+        if not index.complete:
+            return
+        if kind == KIND_JPEG:
             self.status_label.config(
-                text=f"✓ Found {jpeg_count} JPEG files. Click 'Preview' to configure mask regions.",
-                foreground="green",
+                text="No JPEG files found in the selected directory", foreground="gray"
             )
-            self.preview_btn.config(state="normal")
+            self.preview_btn.config(state="disabled")
         else:
+            self.spinner.stop()
+            self.spinner.pack_forget()
             self.status_label.config(
-                text="No JPEG files found in the selected directory", foreground="gray"
+                text="❌ No ultrasound AVI found or failed to read",
+                foreground="red",
             )
             self.preview_btn.config(state="disabled")
 
-    def append_log(self, msg: str):
-        if not msg:
+    def _load_sample(self, root, kind, path):
+        """后台线程：读取样本图片 / 视频第一帧（失败时 frame 为 None）"""
+        frame = None
+        try:
+            if kind == KIND_JPEG:
+                frame = cv2.imread(path)
+            else:
+                cap = cv2.VideoCapture(path)
+                ret, frame = cap.read()
+                cap.release()
+                if not ret:
+                    frame = None
+        except Exception:
+            frame = None
+        self._emit(("sample_loaded", root, kind, path, frame))
+
+    def _on_sample_loaded(self, root, kind, path, frame):
+        if root != os.path.abspath(self.input_dir.get()):
             return
+        self._loading_sample = None
+        if frame is not None:
+            if kind == KIND_JPEG:
+                self._found_jpeg = path
+                self._found_first_jpeg_frame = frame
+            else:
+                self._found_video = path
+                self._found_first_frame = frame
+        # 读取失败时换下一个样本
+        self._update_preview_source()
+
+    def _show_jpeg_found(self, index):
+        count = index.counts[KIND_JPEG]
+        more = "" if index.complete else "+"
+        self.status_label.config(
+            text=f"✓ Found {count}{more} JPEG files. Click 'Preview' to configure mask regions.",
+            foreground="green",
+        )
+        self.preview_btn.config(state="normal")
+
+    def _show_video_found(self):
+        self.spinner.stop()
+        self.spinner.pack_forget()
+        self.status_label.config(
+            text="Ultrasound video found. Click Preview to view.",
+            foreground="green",
+        )
+        self.preview_btn.config(state="normal")
+
+    def append_logs(self, lines):
+        """一次插入多行日志，超出 LOG_VIEW_LINES 的旧行从控件中删除（完整日志在文件中）"""
+        if self._log_file is not None:
+            try:
+                self._log_file.write_lines(lines)
+            except OSError:
+                self._log_file = None
 
         self.log_text.configure(state="normal")
-        self.log_text.insert("end", msg + "\n")
+        self.log_text.insert("end", "\n".join(lines) + "\n")
+        excess = int(self.log_text.index("end-1c").split(".")[0]) - 1 - LOG_VIEW_LINES
+        if excess > 0:
+            self.log_text.delete("1.0", f"{excess + 1}.0")
         self.log_text.see("end")
         self.log_text.configure(state="disabled")
 
-    def _update_progress_ui(self, percent, case_name):
+    def _open_log_file(self, path):
+        self._close_log_file()
+        try:
+            self._log_file = LogFile(path)
+        except OSError:
+            self._log_file = None
+
+    def _close_log_file(self):
+        if self._log_file is not None:
+            self._log_file.close()
+            self._log_file = None
+
+    def _update_progress_ui(self, percent, case_name, info=None):
         try:
             percent = int(percent)
         except Exception:
@@ -1309,12 +1136,37 @@ class BatchAnonymizationApp:
                 foreground="gray",
             )
 
+        if info is not None:
+            text = format_progress(info)
+            stages = format_stages(info)
+            if stages:
+                text += f"\n{stages}"
+            self.throughput_label.config(text=text)
+
     def start(self):
         if not self.input_dir.get():
             messagebox.showwarning("Warning", "Please select input directory first")
             return
 
         self.stop_requested = False
+        try:
+            engine = BatchEngine(
+                self.input_dir.get(),
+                {
+                    "modality": self.modality.get(),
+                    "keep_original": self.keep_original.get(),
+                    "video_mask_cfg": self.video_mask_cfg,
+                    "jpeg_mask_cfg": self.jpeg_mask_cfg,
+                    "case_workers": self.case_workers.get(),
+                },
+                emit=self._emit,
+                should_stop=lambda: self.stop_requested,
+            )
+        except ValueError as e:
+            messagebox.showerror("Error", str(e))
+            return
+        # 完整日志写到输出目录旁边，界面中只显示最近的部分
+        self._open_log_file(log_path(engine.output_root()))
 
         self.log_text.configure(state="normal")
         self.log_text.delete(1.0, tk.END)
@@ -1323,6 +1175,7 @@ class BatchAnonymizationApp:
         self.progress["value"] = 0
         self.progress_label.config(text="0%")
         self.current_case_label.config(text="Starting...", foreground="black")
+        self.throughput_label.config(text="")
         self.exit_btn.config(state="disabled")
 
         self.ui_queue.put(
@@ -1330,528 +1183,34 @@ class BatchAnonymizationApp:
         )
         self.ui_queue.put(("log", f"Input directory: {self.input_dir.get()}"))
         self.ui_queue.put(("log", f"Mask configuration: {self.video_mask_cfg}"))
+        if self._log_file is not None:
+            self.ui_queue.put(("log", f"Full log: {self._log_file.path}"))
         self._schedule_ui_queue()
 
-        threading.Thread(target=self.run_batch, daemon=True).start()
+        threading.Thread(target=self.run_batch, args=(engine,), daemon=True).start()
 
     def stop(self):
         self.stop_requested = True
         self.ui_queue.put(("status", "Stopping after current file…", "orange"))
         self._schedule_ui_queue()
 
-    def process_jpeg_files(self, case_dir):
-        """处理目录中的所有JPEG文件"""
-        jpeg_count = 0
-
-        # 查找所有JPEG文件
-        jpeg_files = []
-        for root, dirs, files in os.walk(case_dir):
-            for f in files:
-                if f.lower().endswith((".jpg", ".jpeg")):
-                    jpeg_files.append(os.path.join(root, f))
-
-        if not jpeg_files:
-            return 0
-
-        self.ui_queue.put(("log", f"Found {len(jpeg_files)} JPEG files to process"))
-
-        for i, jpeg_path in enumerate(jpeg_files, 1):
-            if self.stop_requested:
-                break
-
-            try:
-                # 读取图片
-                img = cv2.imread(jpeg_path)
-                if img is None:
-                    continue
-
-                height, width = img.shape[:2]
-                result = img.copy()
-
-                # 应用所有遮罩区域
-                for region in self.jpeg_mask_cfg.get("regions", []):
-                    x1, y1, x2, y2 = region
-
-                    # 确保区域在图像范围内
-                    x1 = max(0, min(x1, width))
-                    y1 = max(0, min(y1, height))
-                    x2 = max(0, min(x2, width))
-                    y2 = max(0, min(y2, height))
-
-                    method = self.jpeg_mask_cfg.get("method", "black")
-
-                    if method == "black":
-                        cv2.rectangle(result, (x1, y1), (x2, y2), (0, 0, 0), -1)
-                    elif method == "blur":
-                        roi = result[y1:y2, x1:x2]
-                        if roi.size > 0:
-                            blurred = cv2.GaussianBlur(roi, (51, 51), 0)
-                            result[y1:y2, x1:x2] = blurred
-                    elif method == "inpaint":
-                        mask = np.zeros((height, width), dtype=np.uint8)
-                        cv2.rectangle(mask, (x1, y1), (x2, y2), 255, -1)
-                        result = cv2.inpaint(result, mask, 3, cv2.INPAINT_TELEA)
-
-                # 保存结果
-                cv2.imwrite(jpeg_path, result)
-                jpeg_count += 1
-
-                # if i % 50 == 0:  # 每处理50个文件报告一次
-                #     self.ui_queue.put(
-                #         ("log", f"  Processed {i}/{len(jpeg_files)} JPEG files")
-                #     )
-
-            except Exception as e:
-                self.ui_queue.put(
-                    (
-                        "log",
-                        f"  ❌ Error processing {os.path.basename(jpeg_path)}: {str(e)}",
-                    )
-                )
-
-        return jpeg_count
-
-    def run_batch(self):
-        src_root = self.input_dir.get()
-
-        # =========== 添加 DICOM 检测函数 ===========
-        def is_dicom_quick(filepath):
-            """快速检查是否为DICOM文件（优化版）"""
-            try:
-                if not os.path.isfile(filepath):
-                    return False
-
-                # 检查文件大小
-                file_size = os.path.getsize(filepath)
-                if file_size < 132:  # DICOM文件最小大小
-                    return False
-
-                # 方法1：快速检查DICOM前缀（128字节后）
-                with open(filepath, "rb") as f:
-                    f.seek(128)
-                    prefix = f.read(4)
-                    if prefix == b"DICM":
-                        return True
-
-                # 方法2：检查文件扩展名（如果有）
-                filename_lower = filepath.lower()
-                if filename_lower.endswith((".dcm", ".dic", ".dicom")):
-                    # 有DICOM扩展名，尝试用pydicom验证
-                    try:
-                        pydicom.dcmread(filepath, stop_before_pixels=True, force=True)
-                        return True
-                    except:
-                        return False
-
-                # 方法3：对于没有明显标识的文件，跳过常见非DICOM文件
-                filename = os.path.basename(filepath)
-
-                # 跳过明显不是DICOM的文件
-                non_dicom_extensions = [
-                    ".txt",
-                    ".pdf",
-                    ".jpg",
-                    ".jpeg",
-                    ".png",
-                    ".gif",
-                    ".bmp",
-                    ".doc",
-                    ".docx",
-                    ".xls",
-                    ".xlsx",
-                    ".py",
-                    ".log",
-                    ".ini",
-                    ".cfg",
-                    ".config",
-                    ".bat",
-                    ".sh",
-                    ".avi",
-                    ".mp4",
-                    ".mov",
-                    ".mkv",
-                    ".wmv",
-                    ".html",
-                    ".htm",
-                    ".xml",
-                    ".json",
-                    ".csv",
-                ]
-
-                for ext in non_dicom_extensions:
-                    if filename.lower().endswith(ext):
-                        return False
-
-                # 对于其他文件，检查文件大小范围
-                # 典型的DICOM文件大小在几十KB到几百MB之间
-                if (
-                    file_size < 1024 or file_size > 2 * 1024 * 1024 * 1024
-                ):  # 小于1KB或大于2GB
-                    return False
-
-                # 方法4：作为最后手段，尝试pydicom解析
-                try:
-                    pydicom.dcmread(filepath, stop_before_pixels=True, force=True)
-                    return True
-                except (InvalidDicomError, Exception):
-                    return False
-
-            except Exception:
-                return False
-
-        # ===========================================
-
-        if self.keep_original.get():
-            dst_root = src_root + "_anon"
-            if os.path.exists(dst_root):
-                try:
-                    shutil.rmtree(dst_root)
-                except Exception as e:
-                    self.ui_queue.put(
-                        ("log", f"Warning: Could not clear {dst_root}: {e}")
-                    )
-            os.makedirs(dst_root, exist_ok=True)
-        else:
-            dst_root = src_root
-
-        # ================= 自动判断病例目录 =================
-
-        # ================= 自动判断病例目录 =================
-
-        if self.modality.get() in ["MRI", "CT"]:
-            # 对于MRI和CT，我们需要检测病例目录
-            # 病例目录的定义：包含DICOM文件的目录
-            cases = []
-
-            # 方法1：先找直接包含DICOM文件的子目录
-            for item in os.listdir(src_root):
-                item_path = os.path.join(src_root, item)
-                if os.path.isdir(item_path):
-                    # 检查这个目录是否包含DICOM文件
-                    dicom_found = False
-                    for root, dirs, files in os.walk(item_path):
-                        for file in files:
-                            filepath = os.path.join(root, file)
-                            if is_dicom_quick(filepath):
-                                cases.append(item)
-                                dicom_found = True
-                                break
-                        if dicom_found:
-                            break
-
-            # 方法2：如果没找到子目录包含DICOM，检查src_root本身
-            if not cases:
-                self.ui_queue.put(
-                    (
-                        "log",
-                        "No subdirectories with DICOM found, checking root directory...",
-                    )
-                )
-
-                root_has_dicom = False
-                for root, dirs, files in os.walk(src_root):
-                    for file in files:
-                        filepath = os.path.join(root, file)
-                        if is_dicom_quick(filepath):
-                            root_has_dicom = True
-                            break
-                    if root_has_dicom:
-                        break
-
-                if root_has_dicom:
-                    # 如果src_root包含DICOM，将其作为单个病例
-                    cases = [""]  # 空字符串表示根目录本身
-                    self.ui_queue.put(
-                        (
-                            "log",
-                            "Root directory contains DICOM files, treating as single case",
-                        )
-                    )
-
-            if not cases:
-                self.ui_queue.put(
-                    ("status", "No DICOM files found in input directory", "red")
-                )
-                self.ui_queue.put(("done", None))
-                self._schedule_ui_queue()
-                return
-
-            self.ui_queue.put(
-                (
-                    "log",
-                    f"Found {len(cases)} case directories with DICOM files",
-                )
-            )
-            self.ui_queue.put(("log", f"Case list: {cases}"))
-
-        else:
-            # 使用现有的逻辑（用于超声DICOM和视频）
-            cases = []
-            for root, dirs, files in os.walk(src_root):
-                # 检查这个目录是否有可处理文件
-                has_dicom = any(f.lower().endswith(".dcm") for f in files)
-                has_avi = any(f.lower().endswith(".avi") for f in files)
-
-                if has_dicom or has_avi:
-                    # 保存相对路径，保持目录结构
-                    rel_path = os.path.relpath(root, src_root)
-                    cases.append(rel_path)
-
-            if not cases:
-                self.ui_queue.put(
-                    ("status", "No valid cases found in input directory", "red")
-                )
-                self.ui_queue.put(("done", None))
-                self._schedule_ui_queue()
-                return
-
-        total_cases = len(cases)
-        self.ui_queue.put(("log", f"Found {total_cases} case directories"))
+    def _emit(self, msg):
+        """引擎消息回调（在工作线程中调用）"""
+        self.ui_queue.put(msg)
         self._schedule_ui_queue()
 
-        processed_cases = 0
-        total_files_processed = 0
-
-        for i, case in enumerate(cases, 1):
-            if self.stop_requested:
-                self.ui_queue.put(("log", "Batch processing stopped by user"))
-                percent = (
-                    int(processed_cases / total_cases * 100) if total_cases > 0 else 0
-                )
-                self.ui_queue.put(
-                    ("progress", percent, f"Stopped ({processed_cases}/{total_cases})")
-                )
-                break
-
-            # 在循环开始时定义 display_case
-            if case == "":  # 空字符串表示根目录
-                display_case = "[Root Directory]"
-            else:
-                display_case = case
-
-            self.ui_queue.put(
-                ("status", f"Processing: {display_case} ({i}/{total_cases})", "black")
-            )
-            self._schedule_ui_queue()
-
-            try:
-                # 处理根目录的情况
-                if case == "":  # 空字符串表示根目录
-                    src_case = src_root
-                else:
-                    src_case = os.path.join(src_root, case)
-
-                if not os.path.isdir(src_case):
-                    self.ui_queue.put(("log", f"Skipping non-directory: {case}"))
-                    continue
-
-                if self.keep_original.get():
-                    dst_case = os.path.join(dst_root, case)
-
-                    if self.modality.get() in ["MRI", "CT"]:
-                        # CT/MRI需要完整复制目录树
-                        try:
-                            # 删除已存在的目标目录
-                            if os.path.exists(dst_case):
-                                shutil.rmtree(dst_case)
-
-                            # 使用copytree完整复制
-                            shutil.copytree(src_case, dst_case)
-
-                            # 验证复制
-                            src_items = os.listdir(src_case)
-                            dst_items = os.listdir(dst_case)
-                            missing = [
-                                item for item in src_items if item not in dst_items
-                            ]
-
-                            if missing:
-                                self.ui_queue.put(
-                                    ("log", f"⚠️ 复制可能不完整，缺失: {missing}")
-                                )
-                            else:
-                                self.ui_queue.put(
-                                    ("log", f"✓ 完整复制CT/MRI病例: {display_case}")
-                                )
-
-                        except Exception as e:
-                            self.ui_queue.put(
-                                ("log", f"❌ 复制CT/MRI失败 {display_case}: {str(e)}")
-                            )
-                            continue
-                    else:
-                        # 超声DICOM/视频使用原来的文件复制
-                        os.makedirs(dst_case, exist_ok=True)
-                        for f in os.listdir(src_case):
-                            src_file = os.path.join(src_case, f)
-                            dst_file = os.path.join(dst_case, f)
-                            if os.path.isfile(src_file):
-                                shutil.copy2(src_file, dst_file)
-                        self.ui_queue.put(
-                            ("log", f"Copied {display_case or '.'} to destination")
-                        )
-                    # ============ End ============
-
-                else:
-                    dst_case = src_case
-
-                case_files_processed = 0
-
-                if self.modality.get() == "MRI":
-                    case_files_processed = anonymize_mri_case(
-                        dst_case,
-                        log=lambda m: self.ui_queue.put(("log", m)),
-                    )
-                    if hasattr(self, "jpeg_mask_cfg") and self.jpeg_mask_cfg.get(
-                        "regions"
-                    ):
-                        jpeg_files_processed = self.process_jpeg_files(dst_case)
-                        case_files_processed += jpeg_files_processed
-                        self.ui_queue.put(
-                            ("log", f"→ Processed {jpeg_files_processed} JPEG files")
-                        )
-
-                elif self.modality.get() == "CT":
-                    case_files_processed = anonymize_ct_case(
-                        dst_case,
-                        log=lambda m: self.ui_queue.put(("log", m)),
-                    )
-                    if hasattr(self, "jpeg_mask_cfg") and self.jpeg_mask_cfg.get(
-                        "regions"
-                    ):
-                        jpeg_files_processed = self.process_jpeg_files(dst_case)
-                        case_files_processed += jpeg_files_processed
-                        self.ui_queue.put(
-                            ("log", f"→ Processed {jpeg_files_processed} JPEG files")
-                        )
-
-                elif self.modality.get() == "Ultrasound DICOM":  # Ultrasound DICOM
-                    case_files_processed = anonymize_ultrasound_dicom_complete(
-                        dst_case,
-                        log=lambda m: self.ui_queue.put(("log", m)),
-                    )
-
-                else:  # ICE 或 TTE
-                    avi_files = []
-                    for r, _, fs in os.walk(dst_case):
-                        for f in fs:
-                            if f.lower().endswith(".avi"):
-                                avi_files.append(os.path.join(r, f))
-
-                    if not avi_files:
-                        self.ui_queue.put(("log", f"No AVI files found in {case}"))
-                    else:
-                        self.ui_queue.put(
-                            ("log", f"Found {len(avi_files)} AVI files in {case}")
-                        )
-
-                    for avi_file in avi_files:
-                        if self.stop_requested:
-                            break
-
-                        file_name = os.path.basename(avi_file)
-                        self.ui_queue.put(("log", f"Processing: {file_name}"))
-                        self._schedule_ui_queue()
-
-                        try:
-                            # 使用临时文件
-                            temp_file = avi_file + ".temp.avi"
-
-                            # 处理视频
-                            frame_count = anonymize_video(
-                                avi_file,
-                                temp_file,
-                                self.video_mask_cfg["direction"],
-                                self.video_mask_cfg["size"],
-                                modality=self.modality.get(),
-                            )
-
-                            # 替换原文件
-                            if os.path.exists(temp_file):
-                                if not self.keep_original.get():
-                                    backup_file = avi_file + ".backup"
-                                    shutil.copy2(avi_file, backup_file)
-
-                                os.remove(avi_file)
-                                shutil.move(temp_file, avi_file)
-
-                                case_files_processed += 1
-                                total_files_processed += 1
-
-                                self.ui_queue.put(
-                                    (
-                                        "log",
-                                        f"  ✓ Successfully processed {frame_count} frames",
-                                    )
-                                )
-
-                        except Exception as e:
-                            self.ui_queue.put(
-                                ("log", f"  ❌ Error processing {file_name}: {str(e)}")
-                            )
-                            if os.path.exists(avi_file + ".temp.avi"):
-                                try:
-                                    os.remove(avi_file + ".temp.avi")
-                                except:
-                                    pass
-                            continue
-
-                processed_cases += 1
-                total_files_processed += case_files_processed
-                percent = (
-                    int(processed_cases / total_cases * 100) if total_cases > 0 else 0
-                )
-
-                self.ui_queue.put(
-                    (
-                        "progress",
-                        percent,  # ✅ 更新实际完成的百分比
-                        f"Completed: {display_case} ({processed_cases}/{total_cases})",
-                    )
-                )
-                self.ui_queue.put(
-                    (
-                        "log",
-                        f"→ Processed {case_files_processed} {self.modality.get()} files in {display_case}",
-                    )
-                )
-                self._schedule_ui_queue()
-
-            except Exception as e:
-                processed_cases += 1
-                percent = (
-                    int(processed_cases / total_cases * 100) if total_cases > 0 else 0
-                )
-
-                self.ui_queue.put(("log", f"❌ Error processing case {case}: {str(e)}"))
-                self.ui_queue.put(
-                    (
-                        "progress",
-                        percent,
-                        f"Failed: {display_case} ({processed_cases}/{total_cases})",
-                    )
-                )
-                import traceback
-
-                self.ui_queue.put(("log", f"Traceback: {traceback.format_exc()}"))
-                self._schedule_ui_queue()  # ✅ 确保异常情况下也更新UI
-
-        # ✅ 所有case处理完成后
-        self.ui_queue.put(("log", f"\n=== Batch Processing Complete ==="))
-        self.ui_queue.put(
-            ("log", f"Total cases processed: {processed_cases}/{total_cases}")
-        )
-        self.ui_queue.put(("log", f"Total files processed: {total_files_processed}"))
-        self.ui_queue.put(("log", f"Output directory: {dst_root}"))
+    def run_batch(self, engine):
+        try:
+            engine.run()
+        except Exception as e:
+            import traceback
 
-        # ✅ 确保最终进度是100%
-        if not self.stop_requested:
-            self.ui_queue.put(("progress", 100, "All cases completed"))
-
-        self.ui_queue.put(("done", None))
-        self._schedule_ui_queue()
+            self._emit(("log", f"❌ Batch failed: {str(e)}"))
+            self._emit(("log", f"Traceback: {traceback.format_exc()}"))
+            self._emit(("done", None))
 
     def _on_batch_finished(self):
+        self._close_log_file()
         self.progress["value"] = 100
         self.progress_label.config(text="Done")
         self.current_case_label.config(text="All cases processed")
@@ -1862,6 +1221,7 @@ class BatchAnonymizationApp:
         self.exit_btn.config(state="normal")
 
     def on_exit(self):
+        self._close_log_file()
         self.root.quit()
         self.root.destroy()
 
@@ -1912,6 +1272,9 @@ def show_info_dialog(parent):
 
 
 if __name__ == "__main__":
+    # 打包后的可执行文件中启用多进程
+    multiprocessing.freeze_support()
+
     root = tk.Tk()
 
     root.geometry("1x1+0+0")
@@ -0,0 +1,120 @@
+"""
+输出文件的原子写入
+
+DICOM、JPEG、AVI 的结果都先写到目标目录中的临时文件，按 fsync 策略刷盘后用
+os.replace 提交：目标路径上要么是原来的文件，要么是完整的新文件，处理中断时
+原文件不受影响，因此原地处理也不再需要 .backup 副本。
+os.replace 替换的是目录项，目标是源文件的硬链接（dicom_stream.clone_file）时
+源文件同样不受影响。
+
+临时文件以 TEMP_PREFIX 开头并保留目标的扩展名（cv2.imwrite / cv2.VideoWriter
+按扩展名选择格式）；中断后残留的临时文件在扫描时被忽略（scan_manifest）。
+
+fsync 策略：
+- none：不刷盘（默认）。进程崩溃或被终止时安全，断电时新文件可能不完整
+- file：提交前 fsync 临时文件
+- full：另外 fsync 所在目录，提交本身也落盘
+"""
+
+import os
+import shutil
+import tempfile
+
+
+FSYNC_NONE = "none"
+FSYNC_FILE = "file"
+FSYNC_FULL = "full"
+FSYNC_POLICIES = (FSYNC_NONE, FSYNC_FILE, FSYNC_FULL)
+
+TEMP_PREFIX = ".anon_"
+
+
+class AtomicOutput:
+    """
+    目标路径 dst_path 的一次写出：
+
+        with AtomicOutput(dst_path, src_path, fsync) as out:
+            cv2.imwrite(out.path, image)
+
+    正常退出时提交，异常时删除临时文件；临时文件由其他进程写入时（AVI）
+    也可以不用 with，显式调用 commit() / discard()
+    src_path 不为 None 时提交前复制其权限位（mkstemp 创建的文件为 0600）
+    """
+
+    def __init__(self, dst_path, src_path=None, fsync=FSYNC_NONE):
+        if fsync not in FSYNC_POLICIES:
+            raise ValueError(f"Invalid fsync policy: {fsync}")
+        self.dst_path = dst_path
+        self.src_path = src_path
+        self.fsync = fsync
+        self.dst_dir = os.path.dirname(os.path.abspath(dst_path))
+        suffix = os.path.splitext(dst_path)[1] or ".tmp"
+        fd, self.path = tempfile.mkstemp(
+            prefix=TEMP_PREFIX, suffix=suffix, dir=self.dst_dir
+        )
+        os.close(fd)
+        self.closed = False
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        if exc_type is None:
+            self.commit()
+        else:
+            self.discard()
+        return False
+
+    def commit(self):
+        """刷盘（按策略）后用 os.replace 替换目标文件"""
+        if self.closed:
+            return
+        try:
+            if self.fsync != FSYNC_NONE:
+                fsync_path(self.path)
+            if self.src_path is not None:
+                shutil.copymode(self.src_path, self.path)
+            os.replace(self.path, self.dst_path)
+        except BaseException:
+            self.discard()
+            raise
+        self.closed = True
+        if self.fsync == FSYNC_FULL:
+            fsync_dir(self.dst_dir)
+
+    def discard(self):
+        """删除临时文件，目标文件保持不变"""
+        if self.closed:
+            return
+        self.closed = True
+        try:
+            os.remove(self.path)
+        except OSError:
+            pass
+
+
+def fsync_path(path):
+    fd = os.open(path, os.O_RDWR | getattr(os, "O_BINARY", 0))
+    try:
+        os.fsync(fd)
+    finally:
+        os.close(fd)
+
+
+def fsync_dir(path):
+    """目录项落盘；Windows 等不能打开目录的平台上忽略"""
+    try:
+        fd = os.open(path, os.O_RDONLY)
+    except OSError:
+        return
+    try:
+        os.fsync(fd)
+    except OSError:
+        pass
+    finally:
+        os.close(fd)
+
+
+def is_temp_output(name):
+    """文件名是否为（中断后残留的）临时输出文件"""
+    return name.startswith(TEMP_PREFIX)
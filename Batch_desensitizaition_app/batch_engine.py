@@ -0,0 +1,1112 @@
+"""
+无界面批处理引擎
+
+GUI (app_update.py) 和命令行共用同一套批处理逻辑：
+    python batch_engine.py <input_dir> --config config.json
+
+引擎通过 emit 回调发送与 GUI ui_queue 相同格式的消息：
+    ("log", text) / ("status", text, color) / ("progress", percent, case[, info]) / ("done", None)
+进度按文件字节计算，info 为 progress_meter.ProgressInfo（吞吐量、剩余时间、各阶段统计）
+"""
+
+import os
+import sys
+import json
+import queue
+import shutil
+import signal
+import argparse
+import time
+import traceback
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor, FIRST_COMPLETED, wait
+from scan_manifest import (
+    build_manifest,
+    CASE_TOP,
+    CASE_DIR,
+    KIND_DICOM,
+    KIND_JPEG,
+    KIND_AVI,
+)
+from anonymize_mri import anonymize_mri_case
+from anonymize_ct import anonymize_ct_case
+from anonymize_dicom import anonymize_ultrasound_dicom_complete
+from anonymize_jpeg import process_jpeg_files
+from anonymize_video import anonymize_video, format_stats
+from run_journal import RunJournal, journal_path
+from deid_profile import DEFAULT_PROFILE, compile_profile, load_profile, save_profile
+from dicom_scrub import SCRUB_MODES, SCRUB_PYDICOM
+from dicom_stream import clone_file
+from atomic_output import FSYNC_NONE, FSYNC_POLICIES, AtomicOutput
+from progress_meter import ProgressMeter, stage_of, format_progress, format_stages
+
+
+MODALITIES = [
+    "MRI",
+    "CT",
+    "Intracardiac Echo (ICE)",
+    "Transthoracic Echo (TTE)",
+    "Ultrasound DICOM",
+]
+
+# 命令行简写 -> 完整模态名
+MODALITY_ALIASES = {
+    "ICE": "Intracardiac Echo (ICE)",
+    "TTE": "Transthoracic Echo (TTE)",
+    "US": "Ultrasound DICOM",
+    "ULTRASOUND": "Ultrasound DICOM",
+}
+
+DEFAULT_CONFIG = {
+    "modality": "",
+    "keep_original": True,
+    "video_mask_cfg": {"direction": "top", "size": 80},
+    "jpeg_mask_cfg": {"regions": [], "method": "black"},
+    # 并行处理病例的进程数（1 = 串行）
+    "case_workers": 1,
+    # 单个MRI/CT病例内并行处理DICOM文件的线程/进程数（1 = 串行）
+    "file_workers": 1,
+    "file_executor": "thread",
+    # ICE/TTE 病例内并行处理AVI文件的进程数，以及超声 DICOM 中逐帧遮罩 JPEG 的线程数
+    # （0 = 全部CPU核心，1 = 串行）
+    "video_workers": 0,
+    # 超声 DICOM 按 video_mask_cfg（及 jpeg_mask_cfg 的区域）遮罩所有帧中烧录的患者信息
+    "dicom_pixel_mask": False,
+    # DICOM 去标识规则 JSON 文件（None = deid_profile.DEFAULT_PROFILE）
+    "deid_profile": None,
+    # 假名映射库（SQLite）：UID 与 PatientID 映射为稳定的替代值（None = 不映射）
+    "pseudonym_db": None,
+    # 只重写DICOM头部，像素数据原样拷贝（False = 完整读写整个文件）
+    "header_only": True,
+    # MRI/CT 头部去标识方式：pydicom 解析 / raw 按字节拼接 / same-length 等长原地覆盖
+    "header_scrub": SCRUB_PYDICOM,
+    # 不需要修改的文件在输出目录中硬链接到源文件（reflink 总是优先尝试；False = 复制）
+    "link_unchanged": False,
+    # 输出文件的刷盘策略：none / file（提交前 fsync 文件）/ full（另外 fsync 目录）
+    "fsync": FSYNC_NONE,
+    # 根据运行日志跳过上次已完成的文件（False = 全部重新处理）
+    "resume": True,
+    # 运行日志中额外记录文件内容哈希（更可靠，但需要完整读取每个文件）
+    "journal_hash": False,
+}
+
+
+def normalize_modality(modality):
+    """将命令行/配置文件中的模态名转换为标准名称"""
+    if not modality:
+        return ""
+    if modality in MODALITIES:
+        return modality
+    key = modality.strip().upper()
+    for name in MODALITIES:
+        if name.upper() == key:
+            return name
+    return MODALITY_ALIASES.get(key, modality)
+
+
+def make_config(overrides=None):
+    """
+    以 DEFAULT_CONFIG 为基础合并配置，并校验取值
+    """
+    config = json.loads(json.dumps(DEFAULT_CONFIG))  # 深拷贝
+
+    for key, value in (overrides or {}).items():
+        if key in ("video_mask_cfg", "jpeg_mask_cfg") and isinstance(value, dict):
+            config[key].update(value)
+        else:
+            config[key] = value
+
+    config["modality"] = normalize_modality(config.get("modality"))
+    if config["modality"] and config["modality"] not in MODALITIES:
+        raise ValueError(f"Unknown modality: {config['modality']}")
+
+    config["keep_original"] = bool(config["keep_original"])
+    config["header_only"] = bool(config["header_only"])
+    config["dicom_pixel_mask"] = bool(config["dicom_pixel_mask"])
+    config["resume"] = bool(config["resume"])
+    config["journal_hash"] = bool(config["journal_hash"])
+    config["link_unchanged"] = bool(config["link_unchanged"])
+
+    config["case_workers"] = int(config["case_workers"] or 0)
+    if config["case_workers"] <= 0:
+        config["case_workers"] = os.cpu_count() or 1
+
+    config["file_workers"] = int(config["file_workers"] or 0)
+    if config["file_workers"] <= 0:
+        config["file_workers"] = os.cpu_count() or 1
+    config["video_workers"] = int(config["video_workers"] or 0)
+    if config["video_workers"] <= 0:
+        config["video_workers"] = os.cpu_count() or 1
+    if config["file_executor"] not in ("thread", "process"):
+        raise ValueError(f"Invalid file executor: {config['file_executor']}")
+    if config["header_scrub"] not in SCRUB_MODES:
+        raise ValueError(f"Invalid header scrub mode: {config['header_scrub']}")
+    if config["fsync"] not in FSYNC_POLICIES:
+        raise ValueError(f"Invalid fsync policy: {config['fsync']}")
+
+    video_cfg = config["video_mask_cfg"]
+    if video_cfg.get("direction") not in ("left", "top", "right"):
+        raise ValueError(f"Invalid video mask direction: {video_cfg.get('direction')}")
+    video_cfg["size"] = int(video_cfg["size"])
+
+    config["pseudonym_db"] = (
+        os.path.abspath(config["pseudonym_db"]) if config["pseudonym_db"] else None
+    )
+    if config["deid_profile"]:
+        # 提前编译一次，规则文件有错误时在开始处理之前报告
+        config["deid_profile"] = os.path.abspath(config["deid_profile"])
+        profile = load_profile(config["deid_profile"])
+        for modality in ("MRI", "CT", "Ultrasound DICOM"):
+            compile_profile(profile, modality, bool(config["pseudonym_db"]))
+    else:
+        config["deid_profile"] = None
+
+    jpeg_cfg = config["jpeg_mask_cfg"]
+    jpeg_cfg["regions"] = [tuple(int(v) for v in r) for r in jpeg_cfg.get("regions", [])]
+    if any(len(r) != 4 for r in jpeg_cfg["regions"]):
+        raise ValueError("JPEG mask regions must be [x1, y1, x2, y2]")
+
+    return config
+
+
+def load_config(path):
+    """读取JSON配置文件"""
+    with open(path, "r", encoding="utf-8") as f:
+        return make_config(json.load(f))
+
+
+def save_config(config, path):
+    """保存JSON配置文件（GUI中配置好的遮罩可导出给命令行使用）"""
+    with open(path, "w", encoding="utf-8") as f:
+        json.dump(config, f, indent=2, ensure_ascii=False)
+
+
+class BatchEngine:
+    """
+    批处理引擎：病例发现、复制、按模态分派、AVI处理
+    """
+
+    def __init__(self, input_dir, config, emit=None, should_stop=None):
+        self.src_root = input_dir
+        self.config = make_config(config)
+        self.emit = emit or (lambda msg: None)
+        self.should_stop = should_stop or (lambda: False)
+        self.journal = None
+        self._entries_by_path = {}
+        self._dst_root = None
+        self.meter = ProgressMeter()
+
+    @property
+    def modality(self):
+        return self.config["modality"]
+
+    def log(self, msg):
+        self.emit(("log", msg))
+
+    def output_root(self):
+        if self.config["keep_original"]:
+            return self.src_root + "_anon"
+        return self.src_root
+
+    # ================= 扫描与病例发现 =================
+
+    def scan(self):
+        """单次遍历输入目录，生成扫描清单"""
+        if self.modality in ["MRI", "CT"]:
+            manifest = build_manifest(self.src_root, CASE_TOP, sniff=True)
+        else:
+            # 超声DICOM/视频按扩展名识别，病例 = 文件所在目录
+            manifest = build_manifest(self.src_root, CASE_DIR, sniff=False)
+
+        counts = manifest.counts()
+        self.log(
+            f"Scanned {len(manifest)} files: {counts[KIND_DICOM]} DICOM, "
+            f"{counts[KIND_JPEG]} JPEG, {counts[KIND_AVI]} AVI"
+        )
+        return manifest
+
+    def discover_cases(self, manifest):
+        if self.modality in ["MRI", "CT"]:
+            # 对于MRI和CT，病例目录的定义：包含DICOM文件的一级子目录
+            dicom_cases = manifest.cases(kinds=(KIND_DICOM,))
+            cases = [c for c in dicom_cases if c != ""]
+
+            # 如果没找到子目录包含DICOM，检查src_root本身
+            if not cases:
+                self.log("No subdirectories with DICOM found, checking root directory...")
+
+                if "" in dicom_cases:
+                    # 如果src_root包含DICOM，将其作为单个病例
+                    cases = [""]  # 空字符串表示根目录本身
+                    self.log("Root directory contains DICOM files, treating as single case")
+
+            if cases:
+                self.log(f"Found {len(cases)} case directories with DICOM files")
+                self.log(f"Case list: {cases}")
+
+        else:
+            # 用于超声DICOM和视频：包含 .dcm 或 .avi 文件的目录（保持目录结构）
+            cases = manifest.cases(kinds=(KIND_DICOM, KIND_AVI))
+
+        return cases
+
+    def case_entries(self, manifest, cases):
+        """每个病例对应的清单条目"""
+        if cases == [""]:
+            # 根目录作为单个病例时包含全部文件
+            return {"": list(manifest.entries)}
+        grouped = manifest.by_case()
+        return {case: grouped.get(case, []) for case in cases}
+
+    # ================= 主流程 =================
+
+    def run(self):
+        """
+        执行整个批处理，返回汇总信息 dict
+        """
+        dst_root = self.output_root()
+        summary = {
+            "total_cases": 0,
+            "processed_cases": 0,
+            "files_processed": 0,
+            "output_dir": dst_root,
+            "stopped": False,
+        }
+
+        self._dst_root = dst_root
+        self.journal = self._open_journal(dst_root)
+        resuming = self.journal.has_records()
+
+        if self.config["keep_original"]:
+            if os.path.exists(dst_root) and not resuming:
+                try:
+                    shutil.rmtree(dst_root)
+                except Exception as e:
+                    self.log(f"Warning: Could not clear {dst_root}: {e}")
+            os.makedirs(dst_root, exist_ok=True)
+
+        try:
+            manifest = self.scan()
+            cases = self.discover_cases(manifest)
+            if not cases:
+                if self.modality in ["MRI", "CT"]:
+                    self.emit(("status", "No DICOM files found in input directory", "red"))
+                else:
+                    self.emit(("status", "No valid cases found in input directory", "red"))
+                self.emit(("done", None))
+                self.journal.finish_run("empty")
+                return summary
+
+            summary["total_cases"] = len(cases)
+            self.log(f"Found {len(cases)} case directories")
+
+            entries = self.case_entries(manifest, cases)
+            self._entries_by_path = {
+                e.path: e for case_list in entries.values() for e in case_list
+            }
+            if resuming:
+                entries = self._skip_completed(entries)
+            self.meter = self._make_meter(entries)
+
+            workers = min(self.config["case_workers"], len(cases))
+            if workers > 1:
+                self.log(f"Processing cases in parallel with {workers} worker processes")
+                self._run_parallel(cases, entries, dst_root, workers, summary)
+            else:
+                self._run_serial(cases, entries, dst_root, summary)
+
+            self.journal.finish_run("stopped" if summary["stopped"] else "completed")
+        finally:
+            self.journal.close()
+
+        # 所有case处理完成后
+        self.log(f"\n=== Batch Processing Complete ===")
+        self.log(f"Total cases processed: {summary['processed_cases']}/{len(cases)}")
+        self.log(f"Total files processed: {summary['files_processed']}")
+        info = self.meter.snapshot()
+        if info.files_done:
+            self.log(f"Files by stage: {format_stages(info)}")
+        self.log(f"Output directory: {dst_root}")
+
+        # 确保最终进度是100%
+        if not summary["stopped"]:
+            self.emit(("progress", 100, "All cases completed", info))
+
+        self.emit(("done", None))
+        return summary
+
+    def _run_serial(self, cases, entries, dst_root, summary):
+        total_cases = len(cases)
+
+        for i, case in enumerate(cases, 1):
+            if self.should_stop():
+                self._report_stopped(summary, total_cases)
+                break
+
+            self.emit(
+                ("status", f"Processing: {_display(case)} ({i}/{total_cases})", "black")
+            )
+
+            try:
+                count = run_case(
+                    self.config,
+                    self.src_root,
+                    dst_root,
+                    case,
+                    entries[case],
+                    self.log,
+                    self.should_stop,
+                    report=self._record,
+                )
+            except Exception as e:
+                self._report_case(summary, total_cases, case, error=e)
+                continue
+
+            if count is not None:
+                self._report_case(summary, total_cases, case, count=count)
+
+    def _run_parallel(self, cases, entries, dst_root, workers, summary):
+        """
+        每个病例在独立进程中处理；日志经 multiprocessing 队列转发到 emit，
+        停止请求通过共享 Event 通知所有工作进程
+        """
+        total_cases = len(cases)
+        order = {case: i for i, case in enumerate(cases)}
+        msg_queue = multiprocessing.Queue()
+        stop_event = multiprocessing.Event()
+        # 工作进程完成的 (文件数, 字节数)；两个计数器都在 files_done 的锁下更新
+        files_done = multiprocessing.Value("q", 0)
+        bytes_done = multiprocessing.Value("q", 0, lock=False)
+
+        # 病例进程内再开的视频进程池按病例并行度均分CPU，避免过度订阅
+        worker_config = dict(self.config)
+        worker_config["video_workers"] = max(1, self.config["video_workers"] // workers)
+
+        with ProcessPoolExecutor(
+            max_workers=workers,
+            initializer=_init_case_worker,
+            initargs=(msg_queue, stop_event, files_done, bytes_done),
+        ) as pool:
+            futures = {
+                pool.submit(
+                    _case_worker,
+                    worker_config,
+                    self.src_root,
+                    dst_root,
+                    case,
+                    entries[case],
+                ): case
+                for case in cases
+            }
+            pending = set(futures)
+            self.emit(
+                ("status", f"Processing {total_cases} cases ({workers} workers)", "black")
+            )
+
+            while pending:
+                done, pending = wait(pending, timeout=0.1, return_when=FIRST_COMPLETED)
+                self._drain(msg_queue)
+                with files_done.get_lock():
+                    self.meter.sync(files_done.value, bytes_done.value)
+                # 结果按批交回，期间（以及大视频处理中）也定期刷新进度、速率和剩余时间
+                if not done and self.meter.due():
+                    info = self.meter.snapshot()
+                    self.emit(("progress", info.percent, "", info))
+
+                if self.should_stop() and not stop_event.is_set():
+                    stop_event.set()
+                    for future in pending:
+                        future.cancel()
+
+                # 按提交顺序汇报，保证与串行模式的输出顺序一致
+                for future in sorted(done, key=lambda f: order[futures[f]]):
+                    if future.cancelled():
+                        continue
+                    case = futures[future]
+                    try:
+                        count = future.result()
+                    except Exception as e:
+                        self._report_case(summary, total_cases, case, error=e)
+                        continue
+                    if count is not None:
+                        self._report_case(summary, total_cases, case, count=count)
+
+        self._drain(msg_queue)
+        msg_queue.close()
+
+        if stop_event.is_set():
+            self._report_stopped(summary, total_cases)
+
+    def _drain(self, msg_queue):
+        while True:
+            try:
+                msg = msg_queue.get_nowait()
+            except queue.Empty:
+                return
+            if msg[0] == "file":
+                self._record(*msg[1:])
+            elif msg[0] == "files":
+                # 一批成功处理的文件
+                for path in msg[1]:
+                    self._record(path, True)
+            else:
+                self.emit(msg)
+
+    # ================= 运行日志 =================
+
+    def _open_journal(self, dst_root):
+        path = journal_path(dst_root)
+        journal = RunJournal(path, self.config, use_hash=self.config["journal_hash"])
+        if not self.config["resume"]:
+            journal.reset()
+        elif journal.has_records():
+            self.log(f"Resuming from journal: {path}")
+        journal.begin_run(self.src_root)
+        return journal
+
+    def _skip_completed(self, entries):
+        """过滤掉上次运行中已完成且未变化的文件"""
+        remaining = {}
+        skipped = 0
+        for case, case_entries in entries.items():
+            todo = []
+            for e in case_entries:
+                if self.journal.is_done(e, os.path.join(self._dst_root, e.rel_path)):
+                    skipped += 1
+                else:
+                    todo.append(e)
+            remaining[case] = todo
+
+        if skipped:
+            self.log(f"Skipping {skipped} files completed in a previous run")
+        return remaining
+
+    def _record(self, path, ok, error=None):
+        case = self.meter.done(path)
+        if case is not None and self.meter.due():
+            info = self.meter.snapshot()
+            self.emit(("progress", info.percent, _display(case), info))
+
+        entry = self._entries_by_path.get(path)
+        if entry is None or self.journal is None:
+            return
+        dst_path = os.path.join(self._dst_root, entry.rel_path)
+        self.journal.record(entry, dst_path, ok, error)
+
+    def _make_meter(self, entries):
+        """登记本次要处理的文件；原地模式下不修改的文件不计入"""
+        meter = ProgressMeter()
+        handled = handled_kinds(self.config)
+        for case_entries in entries.values():
+            for e in progress_entries(self.config, case_entries):
+                meter.add(e, stage_of(e, handled))
+        return meter
+
+    def _report_case(self, summary, total_cases, case, count=0, error=None):
+        summary["processed_cases"] += 1
+        processed_cases = summary["processed_cases"]
+        self.meter.finish_case(case)
+        info = self.meter.snapshot()
+
+        if error is not None:
+            self.log(f"❌ Error processing case {case}: {str(error)}")
+            self.emit(
+                (
+                    "progress",
+                    info.percent,
+                    f"Failed: {_display(case)} ({processed_cases}/{total_cases})",
+                    info,
+                )
+            )
+            tb = "".join(
+                traceback.format_exception(type(error), error, error.__traceback__)
+            )
+            self.log(f"Traceback: {tb}")
+            return
+
+        summary["files_processed"] += count
+        self.emit(
+            (
+                "progress",
+                info.percent,
+                f"Completed: {_display(case)} ({processed_cases}/{total_cases})",
+                info,
+            )
+        )
+        self.log(f"→ Processed {count} {self.modality} files in {_display(case)}")
+
+    def _report_stopped(self, summary, total_cases):
+        summary["stopped"] = True
+        processed_cases = summary["processed_cases"]
+        self.log("Batch processing stopped by user")
+        info = self.meter.snapshot()
+        self.emit(
+            (
+                "progress",
+                info.percent,
+                f"Stopped ({processed_cases}/{total_cases})",
+                info,
+            )
+        )
+
+
+# ================= 单个病例（可在子进程中运行） =================
+
+
+def run_case(config, src_root, dst_root, case, entries, log, should_stop, report=None):
+    """
+    按模态处理单个病例
+    entries 为该病例在扫描清单中（尚未完成）的条目；保留原始数据模式下直接从源文件读取，
+    匿名化结果写到输出目录，只有不需要修改的文件才原样复制
+    report(path, ok, error) 用于逐文件记录结果（运行日志）
+    返回成功处理的文件数；病例被跳过时返回 None
+    """
+    src_case = src_root if case == "" else os.path.join(src_root, case)
+
+    if not os.path.isdir(src_case):
+        log(f"Skipping non-directory: {case}")
+        return None
+
+    if not entries:
+        log(f"✓ {_display(case)}: already completed in a previous run")
+        return 0
+
+    dst_case = os.path.join(dst_root, case) if config["keep_original"] else src_case
+
+    if config["keep_original"]:
+        handled = handled_kinds(config)
+        unchanged = [e for e in entries if e.kind not in handled]
+        if not copy_unchanged(
+            unchanged, dst_root, log, report, config["link_unchanged"]
+        ):
+            return None
+        os.makedirs(dst_case, exist_ok=True)
+
+    return process_case(
+        config, case, dst_case, dst_root, entries, log, should_stop, report
+    )
+
+
+def handled_kinds(config):
+    """该模态会改写的文件类型，其余文件在保留原始数据模式下原样复制"""
+    modality = config["modality"]
+    if modality in ["MRI", "CT"]:
+        if config["jpeg_mask_cfg"].get("regions"):
+            return (KIND_DICOM, KIND_JPEG)
+        return (KIND_DICOM,)
+    if modality == "Ultrasound DICOM":
+        return (KIND_DICOM,)
+    return (KIND_AVI,)
+
+
+def progress_entries(config, entries):
+    """计入进度的条目：原地模式下不修改的文件不计入"""
+    handled = handled_kinds(config)
+    return [e for e in entries if config["keep_original"] or e.kind in handled]
+
+
+def copy_unchanged(entries, dst_root, log, report=None, hardlink=False):
+    """
+    把不需要修改的文件放到输出目录（clone_file：reflink，hardlink=True 时硬链接，否则复制），
+    失败返回 False
+    """
+    try:
+        for e in entries:
+            dst_file = os.path.join(dst_root, e.rel_path)
+            os.makedirs(os.path.dirname(dst_file), exist_ok=True)
+            clone_file(e.path, dst_file, hardlink)
+            if report:
+                report(e.path, True, None)
+    except Exception as e:
+        log(f"❌ 复制失败: {str(e)}")
+        return False
+
+    if entries:
+        log(f"Copied {len(entries)} unchanged files to destination")
+    return True
+
+
+def process_case(
+    config, case, dst_case, dst_root, entries, log, should_stop, report=None
+):
+    """按模态处理单个病例，返回成功处理的文件数"""
+    modality = config["modality"]
+
+    def src_paths(kind):
+        return [e.path for e in entries if e.kind == kind]
+
+    def dst_paths(kind):
+        # 输出路径；原地模式下 dst_root 就是输入目录，与源路径相同
+        return [os.path.join(dst_root, e.rel_path) for e in entries if e.kind == kind]
+
+    if modality in ["MRI", "CT"]:
+        case_fn = anonymize_mri_case if modality == "MRI" else anonymize_ct_case
+        count = case_fn(
+            dst_case,
+            log=log,
+            workers=config["file_workers"],
+            executor=config["file_executor"],
+            should_stop=should_stop,
+            dicom_files=src_paths(KIND_DICOM),
+            header_only=config["header_only"],
+            dst_files=dst_paths(KIND_DICOM),
+            report=report,
+            profile=config["deid_profile"],
+            scrub=config["header_scrub"],
+            pseudonym_db=config["pseudonym_db"],
+            link_unchanged=config["link_unchanged"],
+            fsync=config["fsync"],
+        )
+
+        if config["jpeg_mask_cfg"].get("regions"):
+            jpeg_count = process_jpeg_files(
+                dst_case,
+                config["jpeg_mask_cfg"],
+                log=log,
+                should_stop=should_stop,
+                jpeg_files=src_paths(KIND_JPEG),
+                dst_files=dst_paths(KIND_JPEG),
+                report=report,
+                fsync=config["fsync"],
+            )
+            count += jpeg_count
+            log(f"→ Processed {jpeg_count} JPEG files")
+        return count
+
+    if modality == "Ultrasound DICOM":
+        pixel_mask = config["dicom_pixel_mask"]
+        return anonymize_ultrasound_dicom_complete(
+            dst_case,
+            log=log,
+            dicom_files=src_paths(KIND_DICOM),
+            header_only=config["header_only"],
+            dst_files=dst_paths(KIND_DICOM),
+            report=report,
+            pixel_mask_cfg=config["video_mask_cfg"] if pixel_mask else None,
+            mask_regions=config["jpeg_mask_cfg"]["regions"] if pixel_mask else None,
+            frame_workers=config["video_workers"],
+            profile=config["deid_profile"],
+            pseudonym_db=config["pseudonym_db"],
+            link_unchanged=config["link_unchanged"],
+            fsync=config["fsync"],
+        )
+
+    # ICE 或 TTE
+    return process_avi_files(
+        config,
+        case,
+        src_paths(KIND_AVI),
+        dst_paths(KIND_AVI),
+        log,
+        should_stop,
+        report,
+    )
+
+
+def process_avi_files(
+    config, case, avi_files, dst_files, log, should_stop, report=None
+):
+    if not avi_files:
+        log(f"No AVI files found in {case}")
+    else:
+        log(f"Found {len(avi_files)} AVI files in {case}")
+
+    workers = min(config["video_workers"], len(avi_files))
+    if workers > 1:
+        return _process_avi_parallel(
+            config, avi_files, dst_files, workers, log, should_stop, report
+        )
+
+    video_cfg = config["video_mask_cfg"]
+    count = 0
+
+    for avi_file, dst_file in zip(avi_files, dst_files):
+        if should_stop():
+            break
+
+        file_name = os.path.basename(avi_file)
+        log(f"Processing: {file_name}")
+
+        try:
+            os.makedirs(os.path.dirname(dst_file), exist_ok=True)
+
+            # 使用临时文件（与目标文件同目录），完成后替换原文件 / 写入输出目录
+            with AtomicOutput(dst_file, avi_file, config["fsync"]) as output:
+                # 处理视频：直接读取源文件
+                frame_count, stats = _anonymize_avi(
+                    avi_file, output.path, video_cfg, config["modality"]
+                )
+
+            count += 1
+            log(f"  ✓ Successfully processed {frame_count} frames")
+            if stats:
+                log(f"    {format_stats(stats)}")
+            if report:
+                report(avi_file, True, None)
+
+        except Exception as e:
+            log(f"  ❌ Error processing {file_name}: {str(e)}")
+            if report:
+                report(avi_file, False, str(e))
+
+    return count
+
+
+def _process_avi_parallel(config, avi_files, dst_files, workers, log, should_stop, report):
+    """
+    用进程池并行处理多个AVI文件
+    临时文件的提交和清理都在当前进程完成，子进程失败或被取消时不会残留临时文件
+    """
+    log(f"Processing {len(avi_files)} AVI files with {workers} worker processes")
+
+    video_cfg = config["video_mask_cfg"]
+    total = len(avi_files)
+    count = 0
+    finished_files = 0
+    stopped = False
+
+    with ProcessPoolExecutor(
+        max_workers=workers, initializer=_init_video_worker
+    ) as pool:
+        pending = {}
+        for avi_file, dst_file in zip(avi_files, dst_files):
+            os.makedirs(os.path.dirname(dst_file), exist_ok=True)
+            output = AtomicOutput(dst_file, avi_file, config["fsync"])
+            future = pool.submit(
+                _anonymize_avi, avi_file, output.path, video_cfg, config["modality"]
+            )
+            pending[future] = (avi_file, output)
+
+        while pending:
+            done, _ = wait(pending, timeout=0.2, return_when=FIRST_COMPLETED)
+
+            if not stopped and should_stop():
+                stopped = True
+                for future in pending:
+                    future.cancel()
+                log("Stop requested, waiting for running videos to finish...")
+
+            for future in done:
+                avi_file, output = pending.pop(future)
+                if future.cancelled():
+                    output.discard()
+                    continue
+
+                finished_files += 1
+                file_name = os.path.basename(avi_file)
+                try:
+                    frame_count, stats = future.result()
+                    output.commit()
+                    count += 1
+                    log(
+                        f"  ✓ [{finished_files}/{total}] {file_name}: "
+                        f"{frame_count} frames"
+                    )
+                    if stats:
+                        log(f"    {format_stats(stats)}")
+                    if report:
+                        report(avi_file, True, None)
+                except Exception as e:
+                    log(f"  ❌ [{finished_files}/{total}] Error processing {file_name}: {str(e)}")
+                    if report:
+                        report(avi_file, False, str(e))
+                    output.discard()
+
+    return count
+
+
+def _anonymize_avi(avi_file, temp_file, video_cfg, modality):
+    """处理单个视频（可在子进程中运行），返回 (帧数, 各阶段耗时)"""
+    stats = {}
+    frame_count = anonymize_video(
+        avi_file,
+        temp_file,
+        video_cfg["direction"],
+        video_cfg["size"],
+        modality=modality,
+        stats=stats,
+    )
+    return frame_count, stats
+
+
+def _init_video_worker():
+    # Ctrl+C 由主进程统一处理
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+
+
+# 工作进程交回成功结果的批大小与最长间隔（秒）；失败的文件立即逐个交回
+FILE_BATCH = 256
+FILE_BATCH_INTERVAL = 1.0
+
+# 子进程中的全局状态（由 _init_case_worker 设置）
+_worker_queue = None
+_worker_stop = None
+_worker_files = None
+_worker_bytes = None
+
+
+def _init_case_worker(msg_queue, stop_event, files_done, bytes_done):
+    global _worker_queue, _worker_stop, _worker_files, _worker_bytes
+    _worker_queue = msg_queue
+    _worker_stop = stop_event
+    _worker_files = files_done
+    _worker_bytes = bytes_done
+    # Ctrl+C 由主进程统一处理
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+
+
+def _case_worker(config, src_root, dst_root, case, entries):
+    prefix = f"[{_display(case)}] "
+
+    def log(msg):
+        body = msg.lstrip("\n")
+        _worker_queue.put(("log", msg[: len(msg) - len(body)] + prefix + body))
+
+    # 进度计数器只统计主进程登记过的文件
+    sizes = {e.path: e.size for e in progress_entries(config, entries)}
+    batch = []
+    flushed = time.monotonic()
+
+    def flush():
+        nonlocal flushed
+        if batch:
+            _worker_queue.put(("files", list(batch)))
+            batch.clear()
+        flushed = time.monotonic()
+
+    def report(path, ok, error=None):
+        # 进度经共享计数器更新；结果按批交回主进程写入运行日志
+        size = sizes.pop(path, None)
+        if size is not None:
+            with _worker_files.get_lock():
+                _worker_files.value += 1
+                _worker_bytes.value += size
+        if not ok:
+            _worker_queue.put(("file", path, ok, error))
+            return
+        batch.append(path)
+        if len(batch) >= FILE_BATCH or time.monotonic() - flushed >= FILE_BATCH_INTERVAL:
+            flush()
+
+    if _worker_stop.is_set():
+        return None
+    try:
+        return run_case(
+            config, src_root, dst_root, case, entries, log, _worker_stop.is_set, report
+        )
+    finally:
+        flush()
+
+
+def _display(case):
+    # 空字符串表示根目录
+    return "[Root Directory]" if case == "" else case
+
+
+# ================= 命令行入口 =================
+
+
+def _print_message(msg):
+    kind = msg[0]
+    if kind == "log":
+        print(msg[1], flush=True)
+    elif kind == "status":
+        print(f"[{msg[1]}]", flush=True)
+    elif kind == "progress":
+        parts = [p for p in (msg[2], len(msg) > 3 and format_progress(msg[3])) if p]
+        print(f"[{msg[1]:3d}%] {' | '.join(parts)}", flush=True)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(
+        description="Batch medical data desensitization (headless)"
+    )
+    parser.add_argument("input_dir", help="Input directory")
+    parser.add_argument("--config", help="JSON config file")
+    parser.add_argument(
+        "--modality",
+        help="MRI, CT, ICE, TTE or 'Ultrasound DICOM' (overrides config)",
+    )
+    mode = parser.add_mutually_exclusive_group()
+    mode.add_argument(
+        "--keep-original",
+        dest="keep_original",
+        action="store_true",
+        default=None,
+        help="Write results to <input>_anon (default)",
+    )
+    mode.add_argument(
+        "--in-place",
+        dest="keep_original",
+        action="store_false",
+        help="Modify files in place",
+    )
+    parser.add_argument(
+        "--workers",
+        type=int,
+        help="Number of cases processed in parallel (0 = all CPU cores)",
+    )
+    parser.add_argument(
+        "--file-workers",
+        type=int,
+        help="DICOM files processed in parallel within one MRI/CT case (0 = all cores)",
+    )
+    parser.add_argument(
+        "--file-executor",
+        choices=["thread", "process"],
+        help="Pool type used by --file-workers (default: thread)",
+    )
+    parser.add_argument(
+        "--video-workers",
+        type=int,
+        help="AVI files processed in parallel within one ICE/TTE case (0 = all cores)",
+    )
+    parser.add_argument(
+        "--full-rewrite",
+        action="store_true",
+        help="Decode and rewrite whole DICOM files instead of only the header",
+    )
+    parser.add_argument(
+        "--header-scrub",
+        choices=SCRUB_MODES,
+        help="How MRI/CT headers are de-identified: pydicom (default), raw "
+        "(byte-level splice) or same-length (overwrite values in place)",
+    )
+    parser.add_argument(
+        "--link-unchanged",
+        action="store_true",
+        help="Hard-link files that need no changes into the output directory "
+        "instead of copying them (when reflinks are not available)",
+    )
+    parser.add_argument(
+        "--fsync",
+        choices=FSYNC_POLICIES,
+        help="Flush output files before committing them: none (default), "
+        "file, or full (also the directory entry)",
+    )
+    parser.add_argument(
+        "--mask-dicom-pixels",
+        action="store_true",
+        help="Also black out burned-in patient information in every frame of "
+        "ultrasound DICOM files (video mask plus JPEG mask regions)",
+    )
+    parser.add_argument(
+        "--fresh",
+        action="store_true",
+        help="Ignore the run journal and reprocess everything",
+    )
+    parser.add_argument(
+        "--journal-hash",
+        action="store_true",
+        help="Also verify file content hashes when resuming",
+    )
+    parser.add_argument(
+        "--profile",
+        metavar="PATH",
+        help="DICOM de-identification profile (JSON, see --write-profile)",
+    )
+    parser.add_argument(
+        "--pseudonymize",
+        metavar="DB",
+        help="Map UIDs and PatientID to stable pseudonyms kept in the SQLite "
+        "database DB (shared across runs) instead of removing them",
+    )
+    parser.add_argument(
+        "--write-profile",
+        metavar="PATH",
+        help="Write the default de-identification profile to PATH and exit",
+    )
+    parser.add_argument(
+        "--write-config",
+        metavar="PATH",
+        help="Write the effective config to PATH and exit",
+    )
+    args = parser.parse_args(argv)
+
+    overrides = {}
+    if args.config:
+        with open(args.config, "r", encoding="utf-8") as f:
+            overrides.update(json.load(f))
+    if args.modality:
+        overrides["modality"] = args.modality
+    if args.keep_original is not None:
+        overrides["keep_original"] = args.keep_original
+    if args.workers is not None:
+        overrides["case_workers"] = args.workers
+    if args.file_workers is not None:
+        overrides["file_workers"] = args.file_workers
+    if args.video_workers is not None:
+        overrides["video_workers"] = args.video_workers
+    if args.mask_dicom_pixels:
+        overrides["dicom_pixel_mask"] = True
+    if args.fresh:
+        overrides["resume"] = False
+    if args.journal_hash:
+        overrides["journal_hash"] = True
+    if args.full_rewrite:
+        overrides["header_only"] = False
+    if args.file_executor:
+        overrides["file_executor"] = args.file_executor
+    if args.header_scrub:
+        overrides["header_scrub"] = args.header_scrub
+    if args.link_unchanged:
+        overrides["link_unchanged"] = True
+    if args.fsync:
+        overrides["fsync"] = args.fsync
+    if args.profile:
+        overrides["deid_profile"] = args.profile
+    if args.pseudonymize:
+        overrides["pseudonym_db"] = args.pseudonymize
+
+    if args.write_profile:
+        save_profile(DEFAULT_PROFILE, args.write_profile)
+        return 0
+
+    try:
+        config = make_config(overrides)
+    except (ValueError, TypeError, KeyError, OSError) as e:
+        parser.error(str(e))
+
+    if args.write_config:
+        save_config(config, args.write_config)
+        return 0
+
+    if not config["modality"]:
+        parser.error("modality is required (--modality or config file)")
+    if not os.path.isdir(args.input_dir):
+        parser.error(f"Input directory not found: {args.input_dir}")
+
+    input_dir = os.path.normpath(os.path.abspath(args.input_dir))
+    stop = {"requested": False}
+
+    def on_sigint(signum, frame):
+        # 第一次 Ctrl+C：处理完当前文件后停止；第二次：立即中断
+        if stop["requested"]:
+            raise KeyboardInterrupt
+        stop["requested"] = True
+        print("Stopping after current file… (Ctrl+C again to abort)", file=sys.stderr)
+
+    signal.signal(signal.SIGINT, on_sigint)
+
+    engine = BatchEngine(
+        input_dir,
+        config,
+        emit=_print_message,
+        should_stop=lambda: stop["requested"],
+    )
+
+    print(f"Starting batch processing for modality: {config['modality']}", flush=True)
+    print(f"Input directory: {input_dir}", flush=True)
+    print(f"Mask configuration: {config['video_mask_cfg']}", flush=True)
+    try:
+        summary = engine.run()
+    except KeyboardInterrupt:
+        print("Aborted", file=sys.stderr)
+        return 130
+
+    return 1 if summary["stopped"] else 0
+
+
+if __name__ == "__main__":
+    multiprocessing.freeze_support()
+    sys.exit(main())
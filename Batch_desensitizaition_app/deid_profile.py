@@ -0,0 +1,499 @@
+"""
+DICOM 去标识规则（profile）
+
+规则写在 JSON（或 DEFAULT_PROFILE）中：
+{
+    "salt": "",                        # hash 动作使用的盐
+    "rules": {"PatientName": {"action": "replace", "value": "ANON"}, ...},
+    "add": {"PatientIdentityRemoved": "YES"},
+    "modalities": {"MRI": {"rules": {...}, "add": {...}}, ...}
+}
+规则的键为关键字（PatientName）或标签（"0010,0010"），值为动作名或
+{"action": ..., "value": ...}。动作：remove / empty / replace / keep / hash /
+pseudonymize。模态规则覆盖通用规则；启用假名映射库时，"pseudonymize" 中的规则
+再覆盖前两者（见 pseudonym_store）。
+
+每个 (profile, 模态) 只编译一次，得到以标签为键的分派表；应用时对数据集的元素只遍历一遍，
+并递归进入序列（SQ）中的各个条目。
+"""
+
+import copy
+import hashlib
+import json
+import os
+import threading
+from collections import OrderedDict
+from functools import lru_cache
+from pydicom.datadict import dictionary_VR, keyword_for_tag, tag_for_keyword
+from pydicom.dataelem import DataElement
+from pydicom.filebase import DicomBytesIO
+from pydicom.filereader import data_element_generator
+from pydicom.filewriter import write_data_element
+from pydicom.multival import MultiValue
+from pydicom.tag import Tag
+from pseudonym_store import get_store
+
+
+REMOVE = "remove"
+EMPTY = "empty"
+REPLACE = "replace"
+KEEP = "keep"
+HASH = "hash"
+PSEUDONYMIZE = "pseudonymize"
+
+ACTIONS = (REMOVE, EMPTY, REPLACE, KEEP, HASH, PSEUDONYMIZE)
+
+# 值为文本的 VR，清空时写入 ""（其他 VR 写入 None）
+TEXT_VRS = set("AE AS CS DA DS DT IS LO LT PN SH ST TM UC UI UR UT".split())
+
+# 每个规则对象缓存的序列模板数（见 SeriesTemplate）
+TEMPLATE_CACHE_SIZE = 32
+
+SERIES_INSTANCE_UID = 0x0020000E
+# 同一序列的实例中这些值必须与模板一致，否则走完整路径
+IDENTITY_TAGS = (
+    0x00080005,  # SpecificCharacterSet
+    0x00100010,  # PatientName
+    0x00100020,  # PatientID
+    0x00100030,  # PatientBirthDate
+    0x0020000D,  # StudyInstanceUID
+)
+
+# 通用规则与原来 anonymize_dicom_file / anonymize_ultrasound_dicom_complete 中的处理相同
+DEFAULT_PROFILE = {
+    "salt": "",
+    "rules": {
+        "PatientName": {"action": REPLACE, "value": "ANON"},
+        "PatientID": {"action": REPLACE, "value": "ANON_ID"},
+        "PatientBirthDate": EMPTY,
+        "PatientSex": EMPTY,
+        "InstitutionName": EMPTY,
+        "ReferringPhysicianName": EMPTY,
+        "PerformingPhysicianName": EMPTY,
+        "OperatorsName": EMPTY,
+        "PatientAddress": EMPTY,
+        "PatientTelephoneNumbers": EMPTY,
+        "OtherPatientIDs": EMPTY,
+        "OtherPatientNames": EMPTY,
+        "InstitutionAddress": EMPTY,
+        "InstitutionalDepartmentName": EMPTY,
+        "PhysiciansOfRecord": EMPTY,
+        "StudyDescription": EMPTY,
+        "SeriesDescription": EMPTY,
+    },
+    "add": {},
+    "modalities": {
+        "MRI": {
+            "rules": {
+                "PatientAge": EMPTY,
+                "PatientSize": EMPTY,
+                "AdditionalPatientHistory": EMPTY,
+                "PatientComments": EMPTY,
+                "StationName": EMPTY,
+                "ProtocolName": EMPTY,
+                "StudyID": EMPTY,
+            },
+            "add": {
+                "DeidentificationMethod": "De-identified",
+                "PatientIdentityRemoved": "YES",
+            },
+        },
+        "CT": {
+            "rules": {"StudyID": EMPTY},
+        },
+        "Ultrasound DICOM": {
+            # 超声 DICOM 直接删除这些标签（包括 Weasis 中显示的所有信息）
+            "rules": {
+                keyword: REMOVE
+                for keyword in (
+                    "PatientName",
+                    "PatientID",
+                    "PatientBirthDate",
+                    "PatientSex",
+                    "PatientAge",
+                    "StudyDate",
+                    "SeriesDate",
+                    "AcquisitionDate",
+                    "ContentDate",
+                    "StudyTime",
+                    "SeriesTime",
+                    "AcquisitionTime",
+                    "ContentTime",
+                    "InstitutionName",
+                    "ReferringPhysicianName",
+                    "OperatorsName",
+                    "InstitutionAddress",
+                    "InstitutionalDepartmentName",
+                    "PhysiciansOfRecord",
+                    "PerformingPhysicianName",
+                    "StudyInstanceUID",
+                    "SeriesInstanceUID",
+                    "StudyID",
+                    "SeriesNumber",
+                    "SOPInstanceUID",
+                    "Manufacturer",
+                    "ManufacturerModelName",
+                    "DeviceSerialNumber",
+                )
+            },
+        },
+    },
+    # 启用假名映射库时：UID 与 PatientID 映射为稳定的替代值，保留检查/序列结构
+    "pseudonymize": {
+        "rules": {
+            keyword: PSEUDONYMIZE
+            for keyword in (
+                "PatientID",
+                "StudyInstanceUID",
+                "SeriesInstanceUID",
+                "SOPInstanceUID",
+                "FrameOfReferenceUID",
+                "ReferencedSOPInstanceUID",
+            )
+        },
+    },
+}
+
+
+class ProfileError(ValueError):
+    """profile 文件格式错误"""
+
+
+class CompiledProfile:
+    """
+    编译后的规则
+    actions    {标签（int）: (动作, 值)}
+    additions  [(关键字, 值), ...]，处理后总是写入
+    pseudonyms pseudonymize 动作使用的映射库（PseudonymStore）
+    """
+
+    __slots__ = (
+        "actions",
+        "additions",
+        "salt",
+        "pseudonyms",
+        "_templates",
+        "_templates_lock",
+    )
+
+    def __init__(self, actions, additions, salt="", pseudonyms=None):
+        self.actions = actions
+        self.additions = additions
+        self.salt = salt
+        self.pseudonyms = pseudonyms
+        self._templates = OrderedDict()
+        self._templates_lock = threading.Lock()
+
+    def apply(self, ds):
+        """
+        对数据集原地应用规则，返回被修改/删除的元素关键字列表（含序列中的元素）
+        """
+        changed = []
+        self._apply(ds, changed)
+        self._finish(ds, changed)
+        return changed
+
+    def apply_series(self, ds):
+        """
+        与 apply 结果相同，但按 SeriesInstanceUID 复用同一序列第一个实例的处理结果
+        （SeriesTemplate）；实例的患者/检查信息或元素组成与模板不一致时走完整路径
+        """
+        series = _raw_value(ds, SERIES_INSTANCE_UID)
+        implicit, little_endian = _encoding(ds)
+        if not isinstance(series, bytes) or not little_endian:
+            return self.apply(ds)
+        series = (series, implicit)
+
+        with self._templates_lock:
+            template = self._templates.get(series)
+            if template is not None:
+                self._templates.move_to_end(series)
+
+        if template is not None and template.matches(ds):
+            changed = template.apply(ds, self)
+            self._finish(ds, changed)
+            return changed
+
+        template = SeriesTemplate(self, ds)
+        changed = self.apply(ds)
+        template.learn(ds, changed)
+        with self._templates_lock:
+            self._templates[series] = template
+            while len(self._templates) > TEMPLATE_CACHE_SIZE:
+                self._templates.popitem(last=False)
+        return changed
+
+    def _finish(self, ds, changed):
+        for keyword, value in self.additions:
+            setattr(ds, keyword, value)
+
+        # 文件头中的 MediaStorageSOPInstanceUID 与新的 SOPInstanceUID 保持一致
+        meta = getattr(ds, "file_meta", None)
+        if (
+            "SOPInstanceUID" in changed
+            and ds.get("SOPInstanceUID")
+            and meta is not None
+            and "MediaStorageSOPInstanceUID" in meta
+        ):
+            meta.MediaStorageSOPInstanceUID = ds.SOPInstanceUID
+
+    def _apply(self, ds, changed):
+        actions = self.actions
+        for tag in list(ds.keys()):
+            rule = actions.get(int(tag))
+            if rule is None:
+                if _element_vr(ds, tag) == "SQ":
+                    for item in ds[tag].value:
+                        self._apply(item, changed)
+                continue
+            self._apply_element(ds, tag, rule, changed)
+
+    def _apply_element(self, ds, tag, rule, changed):
+        action, value = rule
+        if action == KEEP:
+            return
+        if action == REMOVE:
+            del ds[tag]
+        elif action == HASH:
+            elem = ds[tag]
+            elem.value = hash_value(elem.value, elem.VR, self.salt)
+        elif action == PSEUDONYMIZE:
+            elem = ds[tag]
+            elem.value = self.pseudonymize(elem.value, elem.VR)
+        else:
+            # 新值与原值无关，直接替换元素，不必先解码原始值
+            vr = _element_vr(ds, tag) or ds[tag].VR
+            new_value = _empty_value(vr) if action == EMPTY else value
+            ds[tag] = DataElement(tag, vr, new_value)
+        changed.append(keyword_for_tag(tag) or str(tag))
+
+    def pseudonymize(self, value, vr):
+        """映射库中的替代值（多值元素逐个映射，空值保持为空）"""
+        if isinstance(value, (MultiValue, list)):
+            return [self.pseudonymize(v, vr) for v in value]
+        if value is None or str(value) == "":
+            return value
+        return self.pseudonyms.pseudonym(str(value), vr)
+
+
+class SeriesTemplate:
+    """
+    一个序列的头部处理结果，取自该序列第一个实例（只用于小端数据集）
+    entries    {标签: (原始字节, 规则, 处理后的元素或 None（删除）, 关键字)}，只含顶层元素；
+               处理后的元素已编码为 RawDataElement，各实例共用，写出时不再转换
+    sequences  {需要递归处理的顶层序列标签: (原始字节, 序列中是否有元素被修改)}
+    之后的实例只要患者/检查信息与元素组成相同，就直接写入这些结果，不再逐个元素
+    判断规则；hash / pseudonymize 的元素原始值不同时（如 SOPInstanceUID）只对该元素求值。
+    原始字节与模板相同、且模板中没有修改的序列不再解析
+    """
+
+    __slots__ = ("tags", "identity", "rules", "entries", "sequences")
+
+    def __init__(self, profile, ds):
+        # 在应用规则之前记录原始值（标签转为 int，比较时不经过 BaseTag.__eq__）
+        self.tags = frozenset(map(int, ds.keys()))
+        self.identity = tuple(_raw_value(ds, tag) for tag in IDENTITY_TAGS)
+        actions = profile.actions
+        self.rules = {}
+        self.sequences = {}
+        for tag in sorted(self.tags):
+            rule = actions.get(tag)
+            if rule is None:
+                if _element_vr(ds, tag) == "SQ":
+                    self.sequences[tag] = _raw_value(ds, tag)
+            elif rule[0] != KEEP:
+                self.rules[tag] = (_raw_value(ds, tag), rule)
+        self.entries = None
+
+    def learn(self, ds, changed):
+        """记录应用规则之后的结果（changed 为 apply 的返回值）"""
+        implicit, _ = _encoding(ds)
+        encodings = ds._character_set
+        entries = {}
+        for tag, (raw, rule) in self.rules.items():
+            elem = ds.get(tag)
+            result = None if elem is None else _encode_raw(elem, implicit, encodings)
+            entries[tag] = (raw, rule, result, keyword_for_tag(tag) or str(Tag(tag)))
+        self.entries = entries
+
+        # 顶层的每条规则在 changed 中恰好对应一项，多出的来自序列内部
+        nested = len(changed) != len(self.rules)
+        for tag, raw in self.sequences.items():
+            # 无法区分修改发生在哪个序列中时，所有序列都保持逐个解析
+            self.sequences[tag] = (raw, nested)
+
+    def matches(self, ds):
+        """只比较原始字节和元素组成，不解码任何值"""
+        if self.entries is None:
+            return False
+        if tuple(_raw_value(ds, tag) for tag in IDENTITY_TAGS) != self.identity:
+            return False
+        return frozenset(map(int, ds.keys())) == self.tags
+
+    def apply(self, ds, profile):
+        changed = []
+        for tag, (raw, rule, result, keyword) in self.entries.items():
+            if rule[0] in (HASH, PSEUDONYMIZE) and _raw_value(ds, tag) != raw:
+                # 新值取决于该实例自己的原始值
+                profile._apply_element(ds, tag, rule, changed)
+                continue
+            if result is None:
+                del ds[tag]
+            else:
+                ds[tag] = result
+            changed.append(keyword)
+
+        for tag, (raw, nested) in self.sequences.items():
+            if not nested and _raw_value(ds, tag) == raw:
+                continue
+            for item in ds[tag].value:
+                profile._apply(item, changed)
+        return changed
+
+
+def _encoding(ds):
+    """(is_implicit_VR, is_little_endian)"""
+    encoding = getattr(ds, "original_encoding", None)
+    if encoding is None or encoding[0] is None:
+        return ds.is_implicit_VR, ds.is_little_endian
+    return encoding
+
+
+def _encode_raw(elem, implicit, encodings):
+    """把元素按数据集的编码转换为 RawDataElement（小端）"""
+    fp = DicomBytesIO()
+    fp.is_little_endian = True
+    fp.is_implicit_VR = implicit
+    write_data_element(fp, elem, encodings)
+    fp.seek(0)
+    return next(data_element_generator(fp, implicit, True))
+
+
+def _raw_value(ds, tag):
+    """
+    元素未解码的原始字节；不存在时为 None，已解码的元素返回一个不与任何值相等的对象
+    """
+    elem = ds.get_item(tag)
+    if elem is None:
+        return None
+    value = elem.value
+    return value if isinstance(value, bytes) else object()
+
+
+def _element_vr(ds, tag):
+    """元素的 VR；隐式 VR 的原始元素按字典查找，查不到时返回 None"""
+    vr = ds.get_item(tag).VR
+    if vr is None:
+        try:
+            vr = dictionary_VR(tag)
+        except KeyError:
+            return None
+    return vr
+
+
+def _empty_value(vr):
+    if vr == "SQ":
+        return []
+    return "" if vr in TEXT_VRS else None
+
+
+def hash_value(value, vr, salt=""):
+    """
+    确定性的替换值：相同的输入（和盐）总是得到相同的结果
+    UI 生成 2.25 开头的 UID，其他 VR 为 16 位十六进制字符串
+    """
+    digest = hashlib.sha256(f"{salt}|{value}".encode("utf-8")).digest()
+    if vr == "UI":
+        return "2.25." + str(int.from_bytes(digest[:16], "big"))
+    return digest.hex()[:16].upper()
+
+
+# ================= 读取与编译 =================
+
+
+def parse_tag(key):
+    """关键字或 "gggg,eeee" / "ggggeeee" 形式的标签"""
+    tag = tag_for_keyword(key)
+    if tag is not None:
+        return Tag(tag)
+    text = key.strip("()").replace(",", "").replace(" ", "")
+    if len(text) == 8:
+        try:
+            return Tag(int(text, 16))
+        except ValueError:
+            pass
+    raise ProfileError(f"Unknown DICOM keyword or tag: {key}")
+
+
+def _compile_rules(rules, actions):
+    for key, rule in rules.items():
+        if isinstance(rule, str):
+            rule = {"action": rule}
+        action = rule.get("action")
+        if action not in ACTIONS:
+            raise ProfileError(f"Invalid action for {key}: {action}")
+        if action == REPLACE and "value" not in rule:
+            raise ProfileError(f"Replace rule for {key} has no value")
+        actions[int(parse_tag(key))] = (action, rule.get("value"))
+
+
+def compile_profile(profile, modality, pseudonymize=False):
+    """
+    把 profile（字典）按模态编译为 CompiledProfile
+    pseudonymize=True 时加入 "pseudonymize" 中的规则（调用方负责设置 pseudonyms）
+    """
+    actions = {}
+    additions = dict(profile.get("add", {}))
+    _compile_rules(profile.get("rules", {}), actions)
+
+    for name, override in profile.get("modalities", {}).items():
+        if name.upper() == (modality or "").upper():
+            _compile_rules(override.get("rules", {}), actions)
+            additions.update(override.get("add", {}))
+
+    if pseudonymize:
+        _compile_rules(profile.get("pseudonymize", {}).get("rules", {}), actions)
+    elif any(action == PSEUDONYMIZE for action, _ in actions.values()):
+        raise ProfileError("Pseudonymize rules require a pseudonym store")
+
+    for keyword in additions:
+        if tag_for_keyword(keyword) is None:
+            raise ProfileError(f"Unknown DICOM keyword in add: {keyword}")
+
+    return CompiledProfile(actions, list(additions.items()), profile.get("salt", ""))
+
+
+def load_profile(path=None):
+    """读取 JSON profile；path 为空时返回 DEFAULT_PROFILE 的副本"""
+    if not path:
+        return copy.deepcopy(DEFAULT_PROFILE)
+    with open(path, "r", encoding="utf-8") as f:
+        profile = json.load(f)
+    if not isinstance(profile, dict):
+        raise ProfileError(f"Profile must be a JSON object: {path}")
+    return profile
+
+
+def save_profile(profile, path):
+    with open(path, "w", encoding="utf-8") as f:
+        json.dump(profile, f, indent=2, ensure_ascii=False)
+
+
+def get_profile(path, modality, pseudonym_db=None):
+    """
+    按 (profile 路径, 模态) 取编译好的规则（每个进程缓存一份，文件修改后重新编译）
+    pseudonym_db 不为空时启用假名映射（SQLite 映射库路径）
+    """
+    mtime = os.path.getmtime(path) if path else None
+    # 编译结果中带有映射库连接，pid 参与缓存键，fork 出的子进程重新编译并打开自己的连接
+    return _cached_profile(
+        path or None, mtime, modality or "", pseudonym_db or None, os.getpid()
+    )
+
+
+@lru_cache(maxsize=16)
+def _cached_profile(path, mtime, modality, pseudonym_db, pid):
+    compiled = compile_profile(load_profile(path), modality, pseudonym_db is not None)
+    if pseudonym_db is not None:
+        compiled.pseudonyms = get_store(pseudonym_db)
+    return compiled
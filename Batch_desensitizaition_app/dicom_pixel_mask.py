@@ -0,0 +1,325 @@
+"""
+DICOM 像素遮罩（烧录在超声图像中的患者信息）
+
+直接在原始像素缓冲区上按 (帧, 行, 列, 采样) 的视图遮罩，不经过 pydicom 的
+pixel_array（它会把 YBR 转成 RGB），因此 RGB / YBR_FULL / YBR_FULL_422 /
+MONOCHROME 数据都按原色彩空间写入“黑色”，写回后无需修改 PhotometricInterpretation。
+目前只支持非压缩（native）传输语法。
+
+只写头部的路径（dicom_stream）下，像素数据由内核拷贝到输出文件后用 np.memmap
+映射，只写入遮罩覆盖的行列，不把整个像素数据读入内存。
+
+JPEG Baseline 封装的多帧数据按帧拆分（Basic Offset Table），在线程池中逐帧解码、
+遮罩、重新编码后重新封装；遮罩区域解码后已接近全黑（不超过 BLACK_TOLERANCE）的帧
+原样保留，不重新编码，避免整帧的二次压缩损失。PhotometricInterpretation 为 RGB 的
+JPEG 帧不遮罩：OpenCV 按 YCbCr 编码，与头部声明的色彩空间不符，这类文件记为失败、不写出。
+"""
+
+import struct
+from concurrent.futures import ThreadPoolExecutor
+import cv2
+import numpy as np
+from pydicom.encaps import encapsulate
+from pydicom.uid import (
+    ImplicitVRLittleEndian,
+    ExplicitVRLittleEndian,
+    ExplicitVRBigEndian,
+    DeflatedExplicitVRLittleEndian,
+    JPEGBaseline8Bit,
+)
+from mask_plan import dicom_plan
+
+try:
+    from pydicom.encaps import generate_frames
+except ImportError:  # pydicom 2.x
+    from pydicom.encaps import generate_pixel_data_frame
+
+    def generate_frames(buffer, number_of_frames=None):
+        return generate_pixel_data_frame(buffer, number_of_frames)
+
+
+PIXEL_DATA_TAG_LE = b"\xe0\x7f\x10\x00"
+PIXEL_DATA_TAG_BE = b"\x7f\xe0\x00\x10"
+
+# 显式 VR 中长度字段为 4 字节（前面有 2 字节保留）的 VR
+LONG_VRS = (b"OB", b"OW", b"OD", b"OF", b"OL", b"OV", b"UN")
+
+# 可以逐帧遮罩的封装传输语法
+ENCAPSULATED_SYNTAXES = (JPEGBaseline8Bit,)
+
+# 重新编码 JPEG 帧时的质量和各色彩空间的色度采样
+JPEG_QUALITY = 95
+# 有损压缩后黑色区域的解码值很少恰好为 0：遮罩区域最大值不超过该值时视为已经全黑
+BLACK_TOLERANCE = 16
+JPEG_SAMPLING = {
+    "YBR_FULL_422": cv2.IMWRITE_JPEG_SAMPLING_FACTOR_422,
+    "YBR_FULL": cv2.IMWRITE_JPEG_SAMPLING_FACTOR_444,
+}
+
+
+NATIVE_SYNTAXES = (
+    ImplicitVRLittleEndian,
+    ExplicitVRLittleEndian,
+    ExplicitVRBigEndian,
+    DeflatedExplicitVRLittleEndian,
+)
+
+
+class PixelMaskUnsupported(Exception):
+    """该文件的像素数据无法遮罩（压缩格式、调色板等）"""
+
+
+class PixelLayout:
+    """
+    原始像素数据的排列方式
+    frames / rows / columns / samples  维度
+    planar       PlanarConfiguration（1 = 按颜色平面存放）
+    dtype        每个采样的 numpy 类型（含字节序）
+    photometric  PhotometricInterpretation
+    fill         黑色对应的采样值（每个采样一个）
+    """
+
+    def __init__(self, ds):
+        meta = getattr(ds, "file_meta", None)
+        transfer_syntax = getattr(meta, "TransferSyntaxUID", None)
+        if transfer_syntax is not None and transfer_syntax not in NATIVE_SYNTAXES:
+            raise PixelMaskUnsupported(f"Compressed transfer syntax {transfer_syntax}")
+
+        self.frames = int(getattr(ds, "NumberOfFrames", 1) or 1)
+        self.rows = int(ds.Rows)
+        self.columns = int(ds.Columns)
+        self.samples = int(getattr(ds, "SamplesPerPixel", 1))
+        self.planar = int(getattr(ds, "PlanarConfiguration", 0) or 0)
+        self.photometric = str(getattr(ds, "PhotometricInterpretation", "MONOCHROME2"))
+
+        bits = int(ds.BitsAllocated)
+        stored = int(getattr(ds, "BitsStored", bits))
+        signed = int(getattr(ds, "PixelRepresentation", 0)) == 1
+        if bits not in (8, 16):
+            raise PixelMaskUnsupported(f"BitsAllocated {bits} is not supported")
+        byteorder = ">" if transfer_syntax == ExplicitVRBigEndian else "<"
+        self.dtype = np.dtype(f"{byteorder}{'i' if signed else 'u'}{bits // 8}")
+
+        if self.photometric == "MONOCHROME1":
+            # 数值越大越黑
+            fill = [(1 << (stored - 1)) - 1 if signed else (1 << stored) - 1]
+        elif self.photometric == "MONOCHROME2":
+            fill = [-(1 << (stored - 1)) if signed else 0]
+        elif self.photometric == "RGB":
+            fill = [0, 0, 0]
+        elif self.photometric in ("YBR_FULL", "YBR_FULL_422"):
+            # Y = 0，色度取中值
+            half = 1 << (stored - 1)
+            fill = [0, half, half]
+        else:
+            raise PixelMaskUnsupported(
+                f"Photometric interpretation {self.photometric} is not supported"
+            )
+        if len(fill) != self.samples:
+            raise PixelMaskUnsupported(
+                f"{self.photometric} with {self.samples} samples per pixel"
+            )
+        self.fill = np.array(fill, dtype=self.dtype)
+
+    @property
+    def subsampled(self):
+        """YBR_FULL_422 的原始数据按 Y0 Y1 Cb Cr 每两个像素存放"""
+        return self.photometric == "YBR_FULL_422"
+
+    @property
+    def frame_bytes(self):
+        # YBR_FULL_422 每个像素平均 2 个采样
+        samples = 2 if self.subsampled else self.samples
+        return self.rows * self.columns * samples * self.dtype.itemsize
+
+    @property
+    def nbytes(self):
+        return self.frames * self.frame_bytes
+
+    def view(self, buffer):
+        """
+        把可写缓冲区（bytearray / memmap）看作 (帧, 行, 列, 采样) 数组
+        YBR_FULL_422 时列维为像素对：(帧, 行, 列/2, 4)，采样为 Y0 Y1 Cb Cr
+        """
+        count = self.nbytes // self.dtype.itemsize
+        arr = np.frombuffer(buffer, dtype=self.dtype, count=count)
+        if self.subsampled:
+            if self.columns % 2:
+                raise PixelMaskUnsupported("YBR_FULL_422 with odd number of columns")
+            return arr.reshape(self.frames, self.rows, self.columns // 2, 4)
+        if self.planar and self.samples > 1:
+            arr = arr.reshape(self.frames, self.samples, self.rows, self.columns)
+            return arr.transpose(0, 2, 3, 1)
+        return arr.reshape(self.frames, self.rows, self.columns, self.samples)
+
+
+def mask_pixels(pixels, layout, plan):
+    """
+    在 (帧, 行, 列, 采样) 视图上遮罩所有帧，每个矩形一次向量化赋值
+    """
+    if layout.subsampled:
+        fill = np.array(
+            [layout.fill[0], layout.fill[0], layout.fill[1], layout.fill[2]],
+            dtype=layout.dtype,
+        )
+        for ys, xs in plan.slices:
+            # 列范围扩大到完整的像素对
+            pairs = slice(xs.start // 2, (min(xs.stop, layout.columns) + 1) // 2)
+            pixels[:, ys, pairs] = fill
+    else:
+        for ys, xs in plan.slices:
+            pixels[:, ys, xs] = layout.fill
+
+
+def mask_dataset(ds, video_cfg, regions=(), workers=1):
+    """
+    按视频遮罩配置 video_cfg 和区域 regions 遮罩数据集中所有帧的像素，并设置 BurnedInAnnotation
+    封装的 JPEG Baseline 数据用 workers 个线程逐帧处理
+    数据集没有像素数据时返回 False；无法处理时抛出 PixelMaskUnsupported
+    """
+    if "PixelData" not in ds:
+        return False
+
+    if is_encapsulated(ds):
+        plan = dicom_plan(video_cfg, regions, int(ds.Columns), int(ds.Rows))
+        mask_encapsulated(ds, plan, workers)
+        ds.BurnedInAnnotation = "NO"
+        return True
+
+    layout = PixelLayout(ds)
+    buffer = bytearray(ds.PixelData)
+    if len(buffer) < layout.nbytes:
+        raise PixelMaskUnsupported("Pixel data is shorter than the image size")
+
+    plan = dicom_plan(video_cfg, regions, layout.columns, layout.rows)
+    mask_pixels(layout.view(buffer), layout, plan)
+
+    ds.PixelData = bytes(buffer)
+    ds.BurnedInAnnotation = "NO"
+    return True
+
+
+def is_encapsulated(ds):
+    """像素数据是否为可以逐帧遮罩的封装格式（目前只有 JPEG Baseline）"""
+    meta = getattr(ds, "file_meta", None)
+    return getattr(meta, "TransferSyntaxUID", None) in ENCAPSULATED_SYNTAXES
+
+
+# ================= 封装的 JPEG 帧 =================
+
+
+def mask_encapsulated(ds, plan, workers=1):
+    """
+    逐帧遮罩封装的 JPEG Baseline 像素数据，重新生成封装序列和 Basic Offset Table
+    返回重新编码的帧数
+    """
+    photometric = str(getattr(ds, "PhotometricInterpretation", ""))
+    if photometric != "MONOCHROME2" and photometric not in JPEG_SAMPLING:
+        raise PixelMaskUnsupported(
+            f"JPEG frames with photometric interpretation {photometric} are not masked"
+        )
+
+    count = int(getattr(ds, "NumberOfFrames", 1) or 1)
+    frames = list(generate_frames(ds.PixelData, number_of_frames=count))
+    if len(frames) != count:
+        raise PixelMaskUnsupported(
+            f"Found {len(frames)} JPEG frames, expected {count}"
+        )
+
+    def work(frame):
+        return _mask_jpeg_frame(frame, plan, photometric)
+
+    with ThreadPoolExecutor(max_workers=max(1, workers)) as pool:
+        results = list(pool.map(work, frames))
+
+    masked = [data for data, _ in results]
+    # 超过 4GB 时 Basic Offset Table 的 32 位偏移放不下，留空
+    has_bot = sum(len(data) + 8 for data in masked) < 1 << 32
+    ds.PixelData = encapsulate(masked, has_bot=has_bot)
+    return sum(1 for _, changed in results if changed)
+
+
+def _mask_jpeg_frame(data, plan, photometric):
+    """
+    遮罩单个 JPEG 帧，返回 (新的帧数据, 是否重新编码)
+    遮罩区域已经接近全黑（不超过 BLACK_TOLERANCE）的帧原样返回
+    """
+    gray = photometric == "MONOCHROME2"
+    flags = cv2.IMREAD_GRAYSCALE if gray else cv2.IMREAD_COLOR
+    image = cv2.imdecode(np.frombuffer(data, dtype=np.uint8), flags)
+    if image is None:
+        raise PixelMaskUnsupported("JPEG frame cannot be decoded")
+    if image.shape[:2] != (plan.height, plan.width):
+        raise PixelMaskUnsupported("JPEG frame size does not match Rows/Columns")
+
+    if all(image[region].max(initial=0) <= BLACK_TOLERANCE for region in plan.slices):
+        return data, False
+
+    plan.apply(image)
+    params = [cv2.IMWRITE_JPEG_QUALITY, JPEG_QUALITY]
+    if not gray:
+        params += [cv2.IMWRITE_JPEG_SAMPLING_FACTOR, JPEG_SAMPLING[photometric]]
+    ok, encoded = cv2.imencode(".jpg", image, params)
+    if not ok:
+        raise PixelMaskUnsupported("JPEG frame cannot be encoded")
+    return encoded.tobytes(), True
+
+
+def pixel_data_range(path, pixel_offset):
+    """
+    解析 pixel_offset 处的 (7FE0,0010) 元素头
+    返回像素数据值在文件中的 (偏移, 长度)，该位置没有像素数据时返回 None
+    """
+    with open(path, "rb") as f:
+        f.seek(pixel_offset)
+        header = f.read(12)
+
+    if header[:4] == PIXEL_DATA_TAG_LE:
+        fmt = "<I"
+    elif header[:4] == PIXEL_DATA_TAG_BE:
+        fmt = ">I"
+    else:
+        return None
+
+    if header[4:6] in LONG_VRS:
+        # 显式 VR：tag, VR, 保留, 长度
+        length = struct.unpack(fmt, header[8:12])[0]
+        value_offset = pixel_offset + 12
+    else:
+        # 隐式 VR：tag, 长度
+        length = struct.unpack(fmt, header[4:8])[0]
+        value_offset = pixel_offset + 8
+
+    if length == 0xFFFFFFFF:
+        raise PixelMaskUnsupported("Encapsulated (compressed) pixel data")
+    return value_offset, length
+
+
+def pixel_mask_patch(ds, path, pixel_offset, video_cfg, regions=()):
+    """
+    为只写头部的路径准备像素遮罩（ds 为 read_header 读到的头部）
+    返回 dicom_stream.write_header_with_tail 的 patch 回调并设置 BurnedInAnnotation；
+    文件没有像素数据时返回 None。在写出任何内容之前检查能否遮罩，不能时抛出 PixelMaskUnsupported
+    """
+    value_range = pixel_data_range(path, pixel_offset)
+    if value_range is None:
+        return None
+
+    layout = PixelLayout(ds)
+    value_offset, length = value_range
+    if length < layout.nbytes:
+        raise PixelMaskUnsupported("Pixel data is shorter than the image size")
+    plan = dicom_plan(video_cfg, regions, layout.columns, layout.rows)
+
+    def patch(tmp_path, tail_offset):
+        start = tail_offset + (value_offset - pixel_offset)
+        # 只有遮罩覆盖的页面会被读写，内存占用与文件大小无关
+        mapped = np.memmap(
+            tmp_path, dtype=np.uint8, mode="r+", offset=start, shape=(layout.nbytes,)
+        )
+        mask_pixels(layout.view(mapped), layout, plan)
+        mapped.flush()
+        del mapped
+
+    ds.BurnedInAnnotation = "NO"
+    return patch
@@ -0,0 +1,536 @@
+"""
+不构建 pydicom Dataset 的 DICOM 头部去标识
+
+对 CT 等大量小文件，按 profile 清空/替换/删除一组固定标签时，逐个解析为 Dataset
+是主要的 CPU 开销。这里直接在 mmap 上遍历显式/隐式 VR 小端的元素头，只记录
+命中规则的元素的字节偏移，不解码其他任何值：
+
+- 拼接（默认）：输出时按字节区间拼接原文件与新元素，同时修正外层序列、条目和
+  组长度元素的长度字段；像素数据及其后的字节由内核拷贝（dicom_stream.copy_range）
+- same_length=True：新值用空格（UI 用 \\0）填充到原长度后按偏移写入，原地处理时
+  文件不需要重写；删除的元素改为清空。放不下时退回拼接
+
+处理后与原值字节相同的元素不算修改；needs_scrub 只扫描不写出，用于在解析之前
+跳过没有需要修改的元素的文件。
+
+大端、deflate、没有文件头、UN 中的未定义长度序列、非 ASCII 替换值等情况抛出
+ScrubUnsupported，调用方应回退到 pydicom 路径（dicom_stream.read_header）。
+"""
+
+import mmap
+import os
+import struct
+from functools import lru_cache
+from pydicom.datadict import dictionary_VR, keyword_for_tag, tag_for_keyword
+from pydicom.tag import Tag
+from deid_profile import (
+    EMPTY,
+    HASH,
+    KEEP,
+    PSEUDONYMIZE,
+    REMOVE,
+    REPLACE,
+    TEXT_VRS,
+    hash_value,
+)
+from dicom_stream import clone_file, copy_range
+from atomic_output import FSYNC_NONE, AtomicOutput
+
+
+IMPLICIT_VR_LITTLE_ENDIAN = "1.2.840.10008.1.2"
+EXPLICIT_VR_BIG_ENDIAN = "1.2.840.10008.1.2.2"
+DEFLATED_EXPLICIT_VR_LITTLE_ENDIAN = "1.2.840.10008.1.2.1.99"
+
+FILE_META_GROUP_LENGTH = 0x00020000
+MEDIA_STORAGE_SOP_INSTANCE_UID = 0x00020003
+TRANSFER_SYNTAX_TAG = 0x00020010
+SOP_INSTANCE_UID = 0x00080018
+FLOAT_PIXEL_DATA = 0x7FE00008
+ITEM = 0xFFFEE000
+ITEM_DELIMITER = 0xFFFEE00D
+SEQUENCE_DELIMITER = 0xFFFEE0DD
+UNDEFINED_LENGTH = 0xFFFFFFFF
+
+# 显式 VR 中使用 4 字节长度字段的 VR
+LONG_VRS = {
+    b"OB", b"OD", b"OF", b"OL", b"OV", b"OW", b"SQ", b"SV", b"UC", b"UN", b"UR",
+    b"UT", b"UV",
+}
+
+# header_scrub 配置的取值：pydicom 解析 / 按字节拼接 / 等长原地覆盖
+SCRUB_PYDICOM = "pydicom"
+SCRUB_RAW = "raw"
+SCRUB_SAME_LENGTH = "same-length"
+SCRUB_MODES = (SCRUB_PYDICOM, SCRUB_RAW, SCRUB_SAME_LENGTH)
+
+# 可以直接按原始字节计算 hash / 假名的 VR（与 pydicom 解码后的 str 相同）
+HASHABLE_VRS = {"AE", "CS", "LO", "PN", "SH", "UI"}
+
+
+class ScrubUnsupported(Exception):
+    """该文件不能按字节处理（调用方应回退到 pydicom 路径）"""
+
+
+class _Element:
+    """一个元素在文件中的位置"""
+
+    __slots__ = ("tag", "vr", "start", "value_start", "end", "fields")
+
+    def __init__(self, tag, vr, start, value_start, end, fields):
+        self.tag = tag
+        self.vr = vr
+        self.start = start
+        self.value_start = value_start
+        self.end = end
+        # 包含该元素的各级长度字段偏移（修改后长度变化时需要同步修正）
+        self.fields = fields
+
+
+def scrub_file(
+    src_path,
+    profile,
+    dst_path=None,
+    same_length=False,
+    hardlink=False,
+    fsync=FSYNC_NONE,
+):
+    """
+    按编译好的规则（deid_profile.CompiledProfile）处理 src_path
+    dst_path 为 None 或与 src_path 相同时原地处理
+    没有需要修改的元素时不重写：原地处理时什么都不做，否则用 clone_file 放到 dst_path
+    （hardlink 见 clone_file）
+    输出经 atomic_output.AtomicOutput 写出（fsync 为刷盘策略）；等长原地覆盖不经过
+    临时文件，fsync 不为 none 时覆盖后刷盘
+    返回被修改/删除的元素关键字列表（与 CompiledProfile.apply 相同）
+    """
+    dst_path = dst_path or src_path
+    in_place = None
+    output = None
+
+    with open(src_path, "rb") as f:
+        size = os.fstat(f.fileno()).st_size
+        if size < 132:
+            raise ScrubUnsupported("File too small")
+        with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as buf:
+            edits, changed, header_end = _scan(buf, size, profile)
+            patches = _same_length_patches(edits) if same_length else None
+            if not edits:
+                pass
+            elif patches is not None and dst_path == src_path:
+                in_place = patches
+            else:
+                if patches is None:
+                    patches = _splice_patches(buf, edits)
+                else:
+                    header_end = size
+                output = AtomicOutput(dst_path, src_path, fsync)
+                try:
+                    _write_output(buf, f.fileno(), size, header_end, patches, output.path)
+                except BaseException:
+                    output.discard()
+                    raise
+
+    # 源文件关闭之后再覆盖/替换
+    if not edits:
+        if dst_path != src_path:
+            clone_file(src_path, dst_path, hardlink)
+    elif in_place is not None:
+        _patch_in_place(src_path, in_place, fsync != FSYNC_NONE)
+    else:
+        output.commit()
+    return changed
+
+
+def needs_scrub(path, profile):
+    """
+    只扫描头部（不构建 Dataset、不写出）：按规则是否有需要修改的元素
+    无法按字节解析时抛出 ScrubUnsupported（调用方应按需要修改处理）
+    hash / pseudonymize 规则命中的元素直接算作需要修改，不计算新值
+    （pseudonymize 会在假名数据库中写入映射，之后原样放置的文件不应留下记录）
+    """
+    with open(path, "rb") as f:
+        size = os.fstat(f.fileno()).st_size
+        if size < 132:
+            raise ScrubUnsupported("File too small")
+        with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as buf:
+            edits, _, _ = _scan(buf, size, profile, check_only=True)
+            return bool(edits)
+
+
+# ================= 解析 =================
+
+
+def _scan(buf, size, profile, check_only=False):
+    try:
+        return _plan_edits(buf, size, profile, check_only)
+    except (struct.error, IndexError) as e:
+        raise ScrubUnsupported(f"Truncated element: {e}")
+
+
+def _plan_edits(buf, size, profile, check_only=False):
+    """
+    返回 (修改列表, 修改的关键字, 像素数据的起始偏移)
+    check_only=True 时修改列表只用于判断是否为空（hash / pseudonymize 的新值为 None）
+    """
+    if buf[128:132] != b"DICM":
+        raise ScrubUnsupported("No DICOM file meta information")
+
+    pos, transfer_syntax, media_uid = _skip_file_meta(buf, size)
+    if transfer_syntax in (EXPLICIT_VR_BIG_ENDIAN, DEFLATED_EXPLICIT_VR_LITTLE_ENDIAN):
+        raise ScrubUnsupported(f"Transfer syntax {transfer_syntax}")
+    explicit = transfer_syntax != IMPLICIT_VR_LITTLE_ENDIAN
+
+    walker = _Walker(buf, size, explicit, profile, check_only)
+    top, header_end = walker.walk_dataset(pos, size, (), top_level=True)
+    walker.add_elements(top, header_end)
+    if media_uid is not None and not check_only:
+        walker.sync_media_uid(top.get(SOP_INSTANCE_UID), media_uid)
+    return walker.edits, walker.changed, header_end
+
+
+def _skip_file_meta(buf, size):
+    """
+    文件头（0002 组，总是显式 VR 小端）
+    返回 (数据集起始偏移, 传输语法, MediaStorageSOPInstanceUID 元素或 None)
+    """
+    pos = 132
+    transfer_syntax = None
+    media_uid = None
+    group_length = ()
+    while pos + 8 <= size:
+        group, elem = struct.unpack_from("<HH", buf, pos)
+        if group != 0x0002:
+            break
+        vr = buf[pos + 4 : pos + 6]
+        if vr in LONG_VRS:
+            (length,) = struct.unpack_from("<I", buf, pos + 8)
+            value_start = pos + 12
+        else:
+            (length,) = struct.unpack_from("<H", buf, pos + 6)
+            value_start = pos + 8
+        if length == UNDEFINED_LENGTH:
+            raise ScrubUnsupported("Undefined length in file meta")
+        tag = group << 16 | elem
+        if tag == TRANSFER_SYNTAX_TAG:
+            transfer_syntax = (
+                buf[value_start : value_start + length].rstrip(b"\0 ").decode("ascii")
+            )
+        elif tag == FILE_META_GROUP_LENGTH:
+            group_length = (value_start,)
+        elif tag == MEDIA_STORAGE_SOP_INSTANCE_UID:
+            media_uid = _Element(
+                tag, "UI", pos, value_start, value_start + length, group_length
+            )
+        pos = value_start + length
+
+    if transfer_syntax is None:
+        raise ScrubUnsupported("No transfer syntax in file meta")
+    return pos, transfer_syntax, media_uid
+
+
+@lru_cache(maxsize=4096)
+def _dictionary_vr(tag):
+    try:
+        return dictionary_VR(tag)
+    except KeyError:
+        return None
+
+
+class _Walker:
+    """遍历元素并按规则生成修改 (start, end, 新字节, 长度字段)"""
+
+    def __init__(self, buf, size, explicit, profile, check_only=False):
+        self.buf = buf
+        self.size = size
+        self.explicit = explicit
+        self.profile = profile
+        self.check_only = check_only
+        self.actions = profile.actions
+        self.edits = {}
+        self.changed = []
+
+    def walk_dataset(self, pos, end, parents, top_level=False, scan_only=False):
+        """
+        遍历 [pos, end) 中的元素（end 为 None 时到条目结束符为止）
+        scan_only=True 时不应用规则，只用于找到整体处理的未定义长度序列的结束位置
+        返回 (该层元素 {tag: _Element}（只在顶层记录）, 结束位置)
+        """
+        buf = self.buf
+        explicit = self.explicit
+        limit = self.size if end is None else end
+        elements = {}
+        group_lengths = {}
+
+        while pos < limit:
+            group, elem = struct.unpack_from("<HH", buf, pos)
+            tag = group << 16 | elem
+            if tag == ITEM_DELIMITER:
+                if end is not None:
+                    raise ScrubUnsupported("Unexpected item delimiter")
+                return elements, pos + 8
+            if top_level and tag >= FLOAT_PIXEL_DATA:
+                # 像素数据及其后的元素原样保留
+                return elements, pos
+
+            if explicit:
+                vr = buf[pos + 4 : pos + 6]
+                if not (vr.isalpha() and vr.isupper()):
+                    raise ScrubUnsupported(f"Invalid VR at offset {pos}")
+                if vr in LONG_VRS:
+                    (length,) = struct.unpack_from("<I", buf, pos + 8)
+                    length_field = pos + 8
+                    value_start = pos + 12
+                else:
+                    (length,) = struct.unpack_from("<H", buf, pos + 6)
+                    length_field = None
+                    value_start = pos + 8
+                vr = vr.decode("ascii")
+            else:
+                (length,) = struct.unpack_from("<I", buf, pos + 4)
+                length_field = pos + 4
+                value_start = pos + 8
+                vr = _dictionary_vr(tag)
+                if vr is None and length == UNDEFINED_LENGTH:
+                    vr = "SQ"
+
+            if length == UNDEFINED_LENGTH and vr != "SQ":
+                raise ScrubUnsupported(f"Undefined length {vr} element {Tag(tag)}")
+
+            fields = parents
+            if group in group_lengths:
+                fields = parents + (group_lengths[group],)
+            if elem == 0 and length == 4:
+                # 组长度元素（已废弃，但旧设备仍会写入）：组内长度变化时同步修正
+                group_lengths[group] = value_start
+
+            if length == UNDEFINED_LENGTH:
+                value_end = None
+            else:
+                value_end = value_start + length
+                if value_end > self.size:
+                    raise ScrubUnsupported(f"Element {Tag(tag)} exceeds file size")
+
+            rule = None if scan_only else self.actions.get(tag)
+            if rule is None and vr == "SQ":
+                inner = fields
+                if length != UNDEFINED_LENGTH:
+                    inner = fields + (length_field,)
+                value_end = self._walk_sequence(value_start, value_end, inner, scan_only)
+            elif value_end is None:
+                value_end = self._walk_sequence(value_start, None, (), scan_only=True)
+
+            element = _Element(tag, vr, pos, value_start, value_end, fields)
+            if top_level:
+                elements[tag] = element
+            if rule is not None and rule[0] != KEEP:
+                self._apply_rule(element, rule)
+            pos = value_end
+
+        if end is not None and pos != end:
+            raise ScrubUnsupported("Element crosses item boundary")
+        return elements, pos
+
+    def _walk_sequence(self, pos, end, parents, scan_only=False):
+        """遍历序列中的条目，返回序列结束位置"""
+        buf = self.buf
+        limit = self.size if end is None else end
+        while pos < limit:
+            group, elem = struct.unpack_from("<HH", buf, pos)
+            tag = group << 16 | elem
+            (length,) = struct.unpack_from("<I", buf, pos + 4)
+            if tag == SEQUENCE_DELIMITER:
+                if end is not None:
+                    raise ScrubUnsupported("Unexpected sequence delimiter")
+                return pos + 8
+            if tag != ITEM:
+                raise ScrubUnsupported(f"Invalid tag {Tag(tag)} in sequence")
+            if length == UNDEFINED_LENGTH:
+                _, pos = self.walk_dataset(pos + 8, None, parents, scan_only=scan_only)
+            else:
+                _, pos = self.walk_dataset(
+                    pos + 8, pos + 8 + length, parents + (pos + 4,), scan_only=scan_only
+                )
+
+        if end is None:
+            raise ScrubUnsupported("Missing sequence delimiter")
+        if pos != end:
+            raise ScrubUnsupported("Item crosses sequence boundary")
+        return pos
+
+    def _apply_rule(self, element, rule):
+        action, value = rule
+        if action == REMOVE:
+            data = b""
+        elif action == EMPTY:
+            data = _element_bytes(element.tag, element.vr, b"", self.explicit)
+        elif action in (HASH, PSEUDONYMIZE) and self.check_only:
+            # 只判断是否需要修改：不计算新值（pseudonymize 有写数据库的副作用）
+            self.edits[element.start] = (element, None, action)
+            return
+        elif action in (HASH, PSEUDONYMIZE):
+            data = self._derived_element(element, action)
+        else:
+            data = _element_bytes(
+                element.tag, element.vr, _encode_text(value, element.vr), self.explicit
+            )
+        if data == self.buf[element.start : element.end]:
+            # 已经是处理后的值（例如已去标识过的导出文件）
+            return
+        self.edits[element.start] = (element, data, action)
+        self.changed.append(keyword_for_tag(element.tag) or str(Tag(element.tag)))
+
+    def _derived_element(self, element, action):
+        """由原值计算新值的 hash / pseudonymize 动作"""
+        vr = element.vr
+        if vr not in HASHABLE_VRS:
+            raise ScrubUnsupported(f"Cannot {action} {vr} element {Tag(element.tag)}")
+        raw = self.buf[element.value_start : element.end].rstrip(b"\0 ")
+        if b"\\" in raw:
+            raise ScrubUnsupported(f"Cannot {action} multi-valued {Tag(element.tag)}")
+        try:
+            text = raw.decode("ascii")
+        except UnicodeDecodeError:
+            raise ScrubUnsupported(f"Non-ASCII value in {Tag(element.tag)}")
+        if action == HASH:
+            new_value = hash_value(text, vr, self.profile.salt)
+        else:
+            new_value = self.profile.pseudonymize(text, vr)
+        return _element_bytes(element.tag, vr, _encode_text(new_value, vr), self.explicit)
+
+    def add_elements(self, top, header_end):
+        """profile 中 add 的元素：已存在时替换，否则按标签顺序插入顶层"""
+        ordered = sorted(top)
+        for keyword, value in self.profile.additions:
+            tag = tag_for_keyword(keyword)
+            vr = _dictionary_vr(tag)
+            element = top.get(tag)
+            if element is not None:
+                data = _element_bytes(tag, element.vr, _encode_text(value, element.vr), self.explicit)
+                if element.start in self.edits or data != self.buf[element.start : element.end]:
+                    self.edits[element.start] = (element, data, None)
+                continue
+
+            # 插入到第一个标签更大的元素之前
+            start = header_end
+            for other in ordered:
+                if other > tag:
+                    start = top[other].start
+                    break
+            group_length = top.get(tag & 0xFFFF0000)
+            fields = (group_length.value_start,) if group_length else ()
+            element = _Element(tag, vr, start, start, start, fields)
+            data = _element_bytes(tag, vr, _encode_text(value, vr), self.explicit)
+            # 同一位置可能插入多个元素，按标签排序
+            key = (start, tag)
+            self.edits[key] = (element, data, None)
+
+    def sync_media_uid(self, sop_uid, media_uid):
+        """SOPInstanceUID 换成新值时，文件头中的 MediaStorageSOPInstanceUID 随之修改"""
+        edit = self.edits.get(sop_uid.start) if sop_uid is not None else None
+        if edit is None or edit[2] in (REMOVE, EMPTY):
+            return
+        element, data, _ = edit
+        value = data[element.value_start - element.start :]
+        if not value.rstrip(b"\0 "):
+            return
+        data = _element_bytes(MEDIA_STORAGE_SOP_INSTANCE_UID, "UI", value, True)
+        self.edits[media_uid.start] = (media_uid, data, REPLACE)
+
+
+def _encode_text(value, vr):
+    """替换值编码为字节（补齐为偶数长度）；只支持 ASCII 文本"""
+    if vr not in TEXT_VRS or not isinstance(value, str):
+        raise ScrubUnsupported(f"Cannot encode {value!r} as {vr}")
+    try:
+        data = value.encode("ascii")
+    except UnicodeEncodeError:
+        raise ScrubUnsupported(f"Non-ASCII replacement value {value!r}")
+    if len(data) % 2:
+        data += b"\0" if vr == "UI" else b" "
+    return data
+
+
+def _element_bytes(tag, vr, data, explicit):
+    group, elem = tag >> 16, tag & 0xFFFF
+    if not explicit:
+        return struct.pack("<HHI", group, elem, len(data)) + data
+    code = vr.encode("ascii")
+    if code in LONG_VRS:
+        return struct.pack("<HH2sHI", group, elem, code, 0, len(data)) + data
+    if len(data) > 0xFFFF:
+        raise ScrubUnsupported(f"Value too long for {vr}")
+    return struct.pack("<HH2sH", group, elem, code, len(data)) + data
+
+
+# ================= 输出 =================
+
+
+def _splice_patches(buf, edits):
+    """拼接模式：[(start, end, 新字节)]，包括需要修正的长度字段"""
+    deltas = {}
+    patches = []
+    for element, data, _ in edits.values():
+        delta = len(data) - (element.end - element.start)
+        for field in element.fields:
+            deltas[field] = deltas.get(field, 0) + delta
+        patches.append((element.start, element.end, element.tag, data))
+
+    for field, delta in deltas.items():
+        if delta:
+            (length,) = struct.unpack_from("<I", buf, field)
+            patches.append((field, field + 4, -1, struct.pack("<I", length + delta)))
+
+    patches.sort()
+    return [(start, end, data) for start, end, _, data in patches]
+
+
+def _same_length_patches(edits):
+    """
+    等长覆盖：新值补齐到原值长度，只覆盖值的字节
+    有插入、值放不下或非文本 VR 时返回 None（改用拼接）
+    """
+    patches = []
+    for element, data, action in edits.values():
+        if element.start == element.end or element.vr not in TEXT_VRS:
+            return None
+        old_length = element.end - element.value_start
+        header = element.value_start - element.start
+        value = b"" if action in (REMOVE, EMPTY) else data[header:]
+        if len(value) > old_length:
+            return None
+        pad = b"\0" if element.vr == "UI" else b" "
+        patches.append((element.value_start, element.end, value.ljust(old_length, pad)))
+    patches.sort()
+    return patches
+
+
+def _write_output(buf, src_fd, size, header_end, patches, out_path):
+    """
+    把 [0, header_end) 按 patches 拼接写入 out_path（临时文件），
+    header_end 之后的字节由内核拷贝
+    """
+    with open(out_path, "wb") as out:
+        cursor = 0
+        for start, end, data in patches:
+            out.write(buf[cursor:start])
+            out.write(data)
+            cursor = end
+        out.write(buf[cursor:header_end])
+        out.flush()
+        copy_range(src_fd, out.fileno(), header_end, size - header_end)
+
+
+def _patch_in_place(path, patches, sync=False):
+    """原地按偏移覆盖（文件长度不变）"""
+    fd = os.open(path, os.O_RDWR | getattr(os, "O_BINARY", 0))
+    try:
+        for start, _, data in patches:
+            os.lseek(fd, start, os.SEEK_SET)
+            view = memoryview(data)
+            while view:
+                n = os.write(fd, view)
+                view = view[n:]
+        if sync:
+            os.fsync(fd)
+    finally:
+        os.close(fd)
@@ -0,0 +1,169 @@
+"""
+只重写DICOM头部的流式写出
+
+pydicom 以 stop_before_pixels=True 读取时只解析到 (7FE0,0010) 之前，
+并把文件指针停在像素数据元素的起始位置。修改头部后只序列化头部，
+像素数据及其后的所有字节用 os.copy_file_range / os.sendfile 原样拷贝，
+不会读入 Python 内存。
+不需要修改的文件用 clone_file 放到输出目录（reflink / 硬链接 / 复制）。
+"""
+
+import os
+import shutil
+import sys
+import pydicom
+
+try:
+    import fcntl
+except ImportError:  # Windows
+    fcntl = None
+from pydicom.uid import DeflatedExplicitVRLittleEndian
+from atomic_output import FSYNC_NONE, AtomicOutput
+
+
+COPY_CHUNK = 64 * 1024 * 1024
+
+# Linux ioctl：整个文件 reflink（Btrfs、XFS、bcachefs 等支持写时复制的文件系统）
+FICLONE = 0x40049409
+
+
+class HeaderOnlyUnsupported(Exception):
+    """该文件不能走只写头部的路径（调用方应回退到完整读写）"""
+
+
+def read_header(path):
+    """
+    读取像素数据之前的所有元素
+    返回 (ds, pixel_offset)，pixel_offset 为像素数据元素（或文件末尾）的字节偏移
+    """
+    with open(path, "rb") as f:
+        ds = pydicom.dcmread(f, stop_before_pixels=True, force=True)
+        pixel_offset = f.tell()
+
+    transfer_syntax = getattr(getattr(ds, "file_meta", None), "TransferSyntaxUID", None)
+    if transfer_syntax == DeflatedExplicitVRLittleEndian:
+        # 压缩的数据集无法按字节偏移拼接
+        raise HeaderOnlyUnsupported("Deflated transfer syntax")
+
+    return ds, pixel_offset
+
+
+def write_header_with_tail(
+    ds, src_path, pixel_offset, dst_path=None, patch=None, fsync=FSYNC_NONE
+):
+    """
+    写出修改后的头部，然后把 src_path 中 pixel_offset 之后的字节原样追加
+    dst_path 为 None 或与 src_path 相同时原地替换
+    （经 atomic_output.AtomicOutput 写临时文件再 os.replace，fsync 为刷盘策略）
+    patch(tmp_path, tail_offset) 不为 None 时在替换之前调用，可原地修改拷贝过来的像素数据；
+    tail_offset 为 src_path 的 pixel_offset 在临时文件中对应的位置
+    """
+    dst_path = dst_path or src_path
+
+    with AtomicOutput(dst_path, src_path, fsync) as output:
+        with open(output.path, "wb") as out:
+            ds.save_as(out)
+            out.flush()
+            tail_offset = out.tell()
+            with open(src_path, "rb") as src:
+                src_size = os.fstat(src.fileno()).st_size
+                copy_range(
+                    src.fileno(), out.fileno(), pixel_offset, src_size - pixel_offset
+                )
+
+        if patch is not None:
+            patch(output.path, tail_offset)
+
+
+def copy_range(src_fd, dst_fd, offset, length):
+    """
+    把 src_fd 从 offset 开始的 length 字节追加到 dst_fd 的当前位置
+    优先使用内核态拷贝（copy_file_range / sendfile），不支持时退回分块读写
+    """
+    start = os.lseek(dst_fd, 0, os.SEEK_CUR)
+
+    for name in ("copy_file_range", "sendfile"):
+        fn = getattr(os, name, None)
+        if fn is None:
+            continue
+        done = os.lseek(dst_fd, 0, os.SEEK_CUR) - start
+        try:
+            _kernel_copy(name, fn, src_fd, dst_fd, offset + done, length - done)
+            return
+        except OSError:
+            # 跨文件系统、不支持的文件系统等：换下一种方式继续拷贝剩余部分
+            continue
+
+    done = os.lseek(dst_fd, 0, os.SEEK_CUR) - start
+    offset += done
+    remaining = length - done
+    os.lseek(src_fd, offset, os.SEEK_SET)
+    while remaining > 0:
+        chunk = os.read(src_fd, min(COPY_CHUNK, remaining))
+        if not chunk:
+            raise EOFError("Unexpected end of file while copying pixel data")
+        view = memoryview(chunk)
+        while view:
+            n = os.write(dst_fd, view)
+            view = view[n:]
+        offset += len(chunk)
+        remaining -= len(chunk)
+
+
+def _kernel_copy(name, fn, src_fd, dst_fd, offset, length):
+    remaining = length
+    while remaining > 0:
+        count = min(COPY_CHUNK, remaining)
+        if name == "copy_file_range":
+            n = fn(src_fd, dst_fd, count, offset)
+        else:
+            n = fn(dst_fd, src_fd, offset, count)
+        if n == 0:
+            raise EOFError("Unexpected end of file while copying pixel data")
+        offset += n
+        remaining -= n
+
+
+def clone_file(src_path, dst_path, hardlink=False):
+    """
+    把不需要修改的文件放到输出目录，代替 shutil.copy2：
+    先尝试 reflink（写时复制，不占额外空间，也不会与源文件互相影响），
+    hardlink=True 时再尝试硬链接（之后不能原地修改输出文件），最后退回复制
+    返回实际使用的方式："reflink" / "hardlink" / "copy"
+    """
+    try:
+        if os.path.samefile(src_path, dst_path):
+            # 上次运行已经链接过
+            return "hardlink"
+    except OSError:
+        pass
+    if os.path.lexists(dst_path):
+        # 先删除旧的输出：它可能是源文件的硬链接，直接覆盖会改写源文件
+        os.remove(dst_path)
+
+    if _reflink(src_path, dst_path):
+        return "reflink"
+    if hardlink:
+        try:
+            os.link(src_path, dst_path)
+            return "hardlink"
+        except OSError:
+            pass
+    shutil.copy2(src_path, dst_path)
+    return "copy"
+
+
+def _reflink(src_path, dst_path):
+    if fcntl is None or not sys.platform.startswith("linux"):
+        return False
+    try:
+        with open(src_path, "rb") as src, open(dst_path, "wb") as dst:
+            fcntl.ioctl(dst.fileno(), FICLONE, src.fileno())
+    except OSError:
+        try:
+            os.remove(dst_path)
+        except OSError:
+            pass
+        return False
+    shutil.copystat(src_path, dst_path)
+    return True
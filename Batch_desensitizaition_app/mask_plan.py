@@ -0,0 +1,119 @@
+"""
+遮罩计划
+
+把遮罩配置（视频的 direction / size，JPEG 的 regions）针对某个画面尺寸编译一次，
+得到裁剪后的矩形和对应的数组切片。视频处理、JPEG 处理和两个预览窗口都从这里取遮罩几何，
+保证预览与输出一致；结果按 (配置, 画面尺寸) 做 LRU 缓存。
+"""
+
+from functools import lru_cache
+
+
+# 视频遮罩最多覆盖画面的比例
+MAX_VIDEO_RATIO = 0.75
+
+# 视频遮罩的最小像素数，同时也是另一侧至少保留的像素数
+MIN_VIDEO_MARGIN = 10
+
+PLAN_CACHE_SIZE = 64
+
+
+class MaskPlan:
+    """
+    某个画面尺寸下编译好的遮罩（缓存共享，不要修改）
+    rects  (x1, y1, x2, y2) 已裁剪到 [0, width] x [0, height]，与 cv2.rectangle 一样含两个角点
+    slices 每个矩形对应的 (行切片, 列切片)，覆盖的像素与 cv2.rectangle 填充的完全一致
+    """
+
+    __slots__ = ("width", "height", "rects", "slices")
+
+    def __init__(self, width, height, rects):
+        self.width = width
+        self.height = height
+        self.rects = tuple(rects)
+        self.slices = tuple(
+            (
+                slice(min(y1, y2), max(y1, y2) + 1),
+                slice(min(x1, x2), max(x1, x2) + 1),
+            )
+            for x1, y1, x2, y2 in self.rects
+        )
+
+    def apply(self, frame, value=0):
+        """原地把遮罩区域填为 value，每个矩形一次切片赋值"""
+        for region in self.slices:
+            frame[region] = value
+        return frame
+
+    def display_rects(self, disp_w, disp_h):
+        """缩放到显示尺寸后的矩形（预览窗口用）"""
+        sx = disp_w / self.width
+        sy = disp_h / self.height
+        return [
+            (int(x1 * sx), int(y1 * sy), int(x2 * sx), int(y2 * sy))
+            for x1, y1, x2, y2 in self.rects
+        ]
+
+
+def mask_size(direction, size, width, height):
+    """视频遮罩像素数，最大为画面的 75%，且至少保留 10 像素"""
+    size_value = int(size)
+
+    if direction == "top":
+        mask_px = min(size_value, int(height * MAX_VIDEO_RATIO))
+        return max(MIN_VIDEO_MARGIN, min(mask_px, height - MIN_VIDEO_MARGIN))
+    # right / left
+    mask_px = min(size_value, int(width * MAX_VIDEO_RATIO))
+    return max(MIN_VIDEO_MARGIN, min(mask_px, width - MIN_VIDEO_MARGIN))
+
+
+def mask_rect(direction, mask_px, width, height):
+    """视频遮罩矩形 (x1, y1, x2, y2)，与 cv2.rectangle 的两个角点相同"""
+    if direction == "top":
+        return 0, 0, width, mask_px
+    elif direction == "right":  # 右侧
+        return width - mask_px, 0, width, height
+    else:  # left - 左侧
+        return 0, 0, mask_px, height
+
+
+@lru_cache(maxsize=PLAN_CACHE_SIZE)
+def video_plan(direction, size, width, height):
+    """视频遮罩（direction / size 配置）在 width x height 画面上的遮罩计划"""
+    mask_px = mask_size(direction, size, width, height)
+    return MaskPlan(width, height, [mask_rect(direction, mask_px, width, height)])
+
+
+def region_plan(regions, width, height):
+    """JPEG 遮罩区域列表在 width x height 图像上的遮罩计划"""
+    key = tuple(tuple(int(v) for v in region) for region in regions)
+    return _region_plan(key, width, height)
+
+
+@lru_cache(maxsize=PLAN_CACHE_SIZE)
+def _region_plan(regions, width, height):
+    rects = []
+    for x1, y1, x2, y2 in regions:
+        # 确保区域在图像范围内
+        rects.append(
+            (
+                max(0, min(x1, width)),
+                max(0, min(y1, height)),
+                max(0, min(x2, width)),
+                max(0, min(y2, height)),
+            )
+        )
+    return MaskPlan(width, height, rects)
+
+
+def dicom_plan(video_cfg, regions, width, height):
+    """
+    超声 DICOM 像素遮罩：视频遮罩（direction / size）加上 JPEG 遮罩区域
+    video_cfg 为 None 时只使用 regions
+    """
+    rects = ()
+    if video_cfg:
+        rects += video_plan(video_cfg["direction"], video_cfg["size"], width, height).rects
+    if regions:
+        rects += region_plan(regions, width, height).rects
+    return MaskPlan(width, height, rects)
@@ -0,0 +1,170 @@
+"""
+GUI 预览用的后台文件索引
+
+选择输入目录后在后台线程中用 os.scandir 遍历一次，统计 AVI / JPEG 数量并记录
+前几个样本文件（exam/jpeg 目录优先，与以前的查找顺序一致），遍历过程中通过
+emit 把部分结果（IndexSnapshot）陆续交给界面，不需要等整棵树扫描完。
+
+扫描完成的索引按目录缓存，并记录每个子目录的 mtime：目录中增删文件会改变它的
+mtime，再次请求时只 stat 这些目录即可判断缓存是否有效，有效时立即返回。
+"""
+
+import os
+import threading
+import time
+from collections import namedtuple
+from scan_manifest import JPEG_EXTENSIONS, KIND_AVI, KIND_JPEG
+from atomic_output import is_temp_output
+
+
+# 每种类型记录的样本数（第一个无法读取时依次尝试后面的）
+SAMPLE_LIMIT = 8
+# 扫描过程中发送进度快照的最小间隔（秒）
+PROGRESS_INTERVAL = 0.25
+
+PREVIEW_KINDS = (KIND_AVI, KIND_JPEG)
+
+# counts / samples 以类型为键；complete 为 False 时是扫描中的部分结果
+IndexSnapshot = namedtuple("IndexSnapshot", ["root", "counts", "samples", "complete"])
+
+
+def preview_kind(name):
+    """按扩展名判断预览关心的文件类型，其他文件返回 None"""
+    name = name.lower()
+    if name.endswith(".avi"):
+        return KIND_AVI
+    if name.endswith(JPEG_EXTENSIONS):
+        return KIND_JPEG
+    return None
+
+
+class _Scan:
+    """一次扫描的状态（后台线程写入，加锁读取快照）"""
+
+    def __init__(self, root):
+        self.root = root
+        self.counts = {kind: 0 for kind in PREVIEW_KINDS}
+        self.samples = {kind: [] for kind in PREVIEW_KINDS}
+        self.dir_mtimes = {}
+        self.complete = False
+        self.cancelled = threading.Event()
+
+    def snapshot(self):
+        return IndexSnapshot(
+            self.root,
+            dict(self.counts),
+            {kind: tuple(paths) for kind, paths in self.samples.items()},
+            self.complete,
+        )
+
+    def is_current(self):
+        """缓存是否仍然有效：扫描过的目录都还在且 mtime 未变"""
+        for path, mtime in self.dir_mtimes.items():
+            try:
+                if os.stat(path).st_mtime_ns != mtime:
+                    return False
+            except OSError:
+                return False
+        return True
+
+
+class PreviewIndexer:
+    """
+    emit(("index", snapshot)) 在后台线程中调用（界面侧放入 ui_queue 即可，不能阻塞）；
+    扫描中的快照在锁内取出并送出，保证按顺序到达
+    同一时间只扫描一个目录；请求另一个目录时取消正在进行的扫描
+    """
+
+    def __init__(self, emit):
+        self.emit = emit
+        self._lock = threading.Lock()
+        self._cache = {}
+        self._scan = None
+
+    def request(self, root):
+        """请求 root 的索引（立即返回，结果通过 emit 送出）"""
+        if not root:
+            return
+        root = os.path.abspath(root)
+        threading.Thread(target=self._serve, args=(root,), daemon=True).start()
+
+    def _serve(self, root):
+        with self._lock:
+            running = self._scan
+            if running is not None and running.root == root:
+                # 正在扫描：先送出已有的部分结果，之后的结果由扫描线程继续发送
+                self.emit(("index", running.snapshot()))
+                return
+            cached = self._cache.get(root)
+
+        if cached is not None and cached.is_current():
+            self.emit(("index", cached.snapshot()))
+            return
+
+        scan = _Scan(root)
+        with self._lock:
+            if self._scan is not None:
+                self._scan.cancelled.set()
+            self._scan = scan
+            self._cache.pop(root, None)
+
+        try:
+            self._walk(scan)
+        finally:
+            with self._lock:
+                if self._scan is scan:
+                    self._scan = None
+                if scan.complete:
+                    self._cache[root] = scan
+                if not scan.cancelled.is_set():
+                    self.emit(("index", scan.snapshot()))
+
+    def _walk(self, scan):
+        # exam/jpeg 目录最先扫描，其余按名称顺序深度优先
+        stack = [scan.root]
+        priority = os.path.join(scan.root, "exam", "jpeg")
+        if os.path.isdir(priority):
+            stack.append(priority)
+        last_emit = time.monotonic()
+
+        while stack:
+            if scan.cancelled.is_set():
+                return
+            path = stack.pop()
+            if path in scan.dir_mtimes:
+                continue
+            try:
+                scan.dir_mtimes[path] = os.stat(path).st_mtime_ns
+                with os.scandir(path) as it:
+                    items = sorted(it, key=lambda d: d.name)
+            except OSError:
+                continue
+
+            subdirs = []
+            found = False
+            for item in items:
+                if is_temp_output(item.name):
+                    continue
+                try:
+                    if item.is_dir(follow_symlinks=False):
+                        subdirs.append(item.path)
+                        continue
+                except OSError:
+                    continue
+                kind = preview_kind(item.name)
+                if kind is None:
+                    continue
+                with self._lock:
+                    scan.counts[kind] += 1
+                    if len(scan.samples[kind]) < SAMPLE_LIMIT:
+                        scan.samples[kind].append(item.path)
+                        found = True
+            stack.extend(reversed(subdirs))
+
+            now = time.monotonic()
+            if found or now - last_emit >= PROGRESS_INTERVAL:
+                last_emit = now
+                with self._lock:
+                    self.emit(("index", scan.snapshot()))
+
+        scan.complete = True
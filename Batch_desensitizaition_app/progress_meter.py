@@ -0,0 +1,214 @@
+"""
+按文件字节加权的批处理进度
+
+扫描清单已经知道每个待处理文件的大小，引擎在记录每个文件的结果时（_record，
+主进程中调用）更新计数。并行处理病例时工作进程按批交回结果，期间的进度来自
+工作进程共享的计数器（sync）；进度按字节计算（没有字节时按文件数），
+吞吐量和剩余时间用指数平滑的速率估计，并按处理阶段分别统计：
+    copy   原样复制到输出目录的文件
+    scrub  DICOM 去标识
+    mask   JPEG 遮罩
+    video  AVI 遮罩与编码
+"""
+
+import time
+from collections import namedtuple
+from scan_manifest import KIND_AVI, KIND_DICOM, KIND_JPEG
+
+
+STAGE_COPY = "copy"
+STAGE_SCRUB = "scrub"
+STAGE_MASK = "mask"
+STAGE_VIDEO = "video"
+STAGES = (STAGE_COPY, STAGE_SCRUB, STAGE_MASK, STAGE_VIDEO)
+
+_KIND_STAGES = {KIND_DICOM: STAGE_SCRUB, KIND_JPEG: STAGE_MASK, KIND_AVI: STAGE_VIDEO}
+
+# 两次进度消息之间的最小间隔（秒）
+PROGRESS_INTERVAL = 0.5
+# 速率的指数平滑系数（越大越跟随最近的速度）
+RATE_SMOOTHING = 0.3
+
+# stages: {阶段: (完成文件数, 完成字节数)}；eta 为秒，速率未知时为 None
+ProgressInfo = namedtuple(
+    "ProgressInfo",
+    [
+        "percent",
+        "files_done",
+        "files_total",
+        "bytes_done",
+        "bytes_total",
+        "files_per_sec",
+        "bytes_per_sec",
+        "eta",
+        "stages",
+    ],
+)
+
+
+def stage_of(entry, handled):
+    """扫描条目的处理阶段；handled 为该模态会改写的文件类型（batch_engine.handled_kinds）"""
+    if entry.kind not in handled:
+        return STAGE_COPY
+    return _KIND_STAGES.get(entry.kind, STAGE_COPY)
+
+
+class ProgressMeter:
+    """只在主进程中使用（引擎线程），不需要加锁"""
+
+    def __init__(self, clock=time.monotonic):
+        self.clock = clock
+        self._pending = {}
+        self._by_case = {}
+        self.files_total = 0
+        self.bytes_total = 0
+        self.files_done = 0
+        self.bytes_done = 0
+        self.stages = {stage: [0, 0] for stage in STAGES}
+        # 逐个报告过结果的文件 (数量, 字节) 与工作进程计数器的最新值
+        self._reported = [0, 0]
+        self._live = (0, 0)
+
+        self._last_sample = (clock(), 0, 0)
+        self._file_rate = None
+        self._byte_rate = None
+        self._last_emit = None
+
+    def add(self, entry, stage):
+        """登记一个待处理的文件"""
+        if entry.path in self._pending:
+            return
+        self._pending[entry.path] = (entry.case, entry.size, stage)
+        self._by_case.setdefault(entry.case, []).append(entry.path)
+        self.files_total += 1
+        self.bytes_total += entry.size
+
+    def done(self, path, reported=True):
+        """
+        一个文件处理完成（成功或失败）；未登记或已完成的路径忽略
+        reported=False 表示没有逐个报告结果（不计入工作进程计数器）
+        """
+        item = self._pending.pop(path, None)
+        if item is None:
+            return None
+        case, size, stage = item
+        self.files_done += 1
+        self.bytes_done += size
+        counts = self.stages[stage]
+        counts[0] += 1
+        counts[1] += size
+        if reported:
+            self._reported[0] += 1
+            self._reported[1] += size
+        return case
+
+    def finish_case(self, case):
+        """病例结束：没有逐个报告结果的文件（跳过、整个病例失败）也计为完成"""
+        for path in self._by_case.pop(case, ()):
+            self.done(path, reported=False)
+
+    def sync(self, files, size):
+        """
+        工作进程共享计数器中已完成的文件数和字节数；
+        其中尚未按批交回的部分也计入进度
+        """
+        self._live = (files, size)
+
+    def due(self, interval=PROGRESS_INTERVAL):
+        """距上次发送进度是否已超过 interval"""
+        now = self.clock()
+        if self._last_emit is not None and now - self._last_emit < interval:
+            return False
+        self._last_emit = now
+        return True
+
+    def snapshot(self):
+        now = self.clock()
+        files_done, bytes_done = self._totals()
+        self._sample(now, files_done, bytes_done)
+
+        if self.bytes_total > 0:
+            fraction = bytes_done / self.bytes_total
+        elif self.files_total > 0:
+            fraction = files_done / self.files_total
+        else:
+            fraction = 1.0
+
+        eta = None
+        if self._byte_rate and self.bytes_total > 0:
+            eta = (self.bytes_total - bytes_done) / self._byte_rate
+        elif self._file_rate and self.bytes_total == 0:
+            eta = (self.files_total - files_done) / self._file_rate
+
+        return ProgressInfo(
+            percent=int(fraction * 100),
+            files_done=files_done,
+            files_total=self.files_total,
+            bytes_done=bytes_done,
+            bytes_total=self.bytes_total,
+            files_per_sec=self._file_rate or 0.0,
+            bytes_per_sec=self._byte_rate or 0.0,
+            eta=eta,
+            stages={stage: tuple(counts) for stage, counts in self.stages.items()},
+        )
+
+    def _totals(self):
+        """(完成文件数, 完成字节数)：加上计数器中已完成但还没有交回结果的文件"""
+        files = self.files_done + max(0, self._live[0] - self._reported[0])
+        size = self.bytes_done + max(0, self._live[1] - self._reported[1])
+        return min(files, self.files_total), min(size, self.bytes_total)
+
+    def _sample(self, now, files_done, bytes_done):
+        """距上次采样超过 PROGRESS_INTERVAL 时取一次区间速率，并做指数平滑"""
+        last_time, last_files, last_bytes = self._last_sample
+        elapsed = now - last_time
+        if elapsed < PROGRESS_INTERVAL:
+            return
+
+        file_rate = (files_done - last_files) / elapsed
+        byte_rate = (bytes_done - last_bytes) / elapsed
+        if self._byte_rate is None:
+            self._file_rate, self._byte_rate = file_rate, byte_rate
+        else:
+            a = RATE_SMOOTHING
+            self._file_rate = a * file_rate + (1 - a) * self._file_rate
+            self._byte_rate = a * byte_rate + (1 - a) * self._byte_rate
+        self._last_sample = (now, files_done, bytes_done)
+
+
+def format_eta(seconds):
+    if seconds is None:
+        return "--"
+    seconds = int(seconds + 0.5)
+    if seconds >= 3600:
+        return f"{seconds // 3600}h{seconds % 3600 // 60:02d}m"
+    if seconds >= 60:
+        return f"{seconds // 60}m{seconds % 60:02d}s"
+    return f"{seconds}s"
+
+
+def format_size(size):
+    for unit in ("B", "KB", "MB"):
+        if size < 1000:
+            return f"{size:.0f} {unit}" if unit == "B" else f"{size:.1f} {unit}"
+        size /= 1000
+    return f"{size:.1f} GB"
+
+
+def format_progress(info):
+    """一行摘要：文件数、速率、剩余时间"""
+    return (
+        f"{info.files_done}/{info.files_total} files, "
+        f"{format_size(info.bytes_done)}/{format_size(info.bytes_total)}, "
+        f"{info.files_per_sec:.1f} files/s, {info.bytes_per_sec / 1e6:.1f} MB/s, "
+        f"ETA {format_eta(info.eta)}"
+    )
+
+
+def format_stages(info):
+    """各阶段完成的文件数（只列出有文件的阶段）"""
+    return ", ".join(
+        f"{stage} {files} ({format_size(size)})"
+        for stage, (files, size) in info.stages.items()
+        if files
+    )
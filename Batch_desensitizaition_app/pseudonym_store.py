@@ -0,0 +1,105 @@
+"""
+假名映射（SQLite）
+
+每个原始 UID / PatientID 第一次出现时生成一个随机的替代值并写入映射库，之后
+总是返回同一个值，因此检查/序列/实例之间的引用关系在去标识后仍然保持。
+映射库可以在多次运行、多个线程和进程之间共享（WAL 模式，INSERT OR IGNORE 后
+再读取，并发时以先写入者为准）；每个进程内另有 LRU 缓存，重复的 UID 不访问数据库。
+
+UID 生成 2.25 开头的 UUID 形式，其他值生成 ANON 加 12 位十六进制字符。
+"""
+
+import os
+import secrets
+import sqlite3
+import threading
+import time
+import uuid
+from functools import lru_cache
+
+
+PSEUDONYM_CACHE_SIZE = 65536
+
+# 同一类中的值共用一套映射（例如 SOPInstanceUID 与 ReferencedSOPInstanceUID）
+KIND_UID = "UID"
+KIND_ID = "ID"
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS pseudonyms (
+    kind TEXT NOT NULL,
+    original TEXT NOT NULL,
+    pseudonym TEXT NOT NULL,
+    created REAL NOT NULL,
+    PRIMARY KEY (kind, original),
+    UNIQUE (kind, pseudonym)
+);
+"""
+
+
+class PseudonymStore:
+    """线程安全；每个进程通过 get_store 各自打开一个连接"""
+
+    def __init__(self, path, cache_size=PSEUDONYM_CACHE_SIZE):
+        self.path = path
+        self._lock = threading.Lock()
+        self.conn = sqlite3.connect(
+            path, timeout=60, isolation_level=None, check_same_thread=False
+        )
+        self.conn.execute("PRAGMA journal_mode=WAL")
+        self.conn.execute("PRAGMA synchronous=NORMAL")
+        self.conn.executescript(_SCHEMA)
+        self._cached = lru_cache(maxsize=cache_size)(self._lookup)
+
+    def pseudonym(self, original, vr):
+        """original 对应的替代值；VR 为 UI 时生成 UID"""
+        kind = KIND_UID if vr == "UI" else KIND_ID
+        return self._cached(kind, original)
+
+    def _lookup(self, kind, original):
+        with self._lock:
+            row = self.conn.execute(
+                "SELECT pseudonym FROM pseudonyms WHERE kind = ? AND original = ?",
+                (kind, original),
+            ).fetchone()
+            while row is None:
+                # 其他进程可能同时写入同一个值：忽略冲突后重新读取
+                # （生成值与已有替代值重复时也会被忽略，换一个值重试）
+                self.conn.execute(
+                    "INSERT OR IGNORE INTO pseudonyms (kind, original, pseudonym, created) "
+                    "VALUES (?, ?, ?, ?)",
+                    (kind, original, _generate(kind), time.time()),
+                )
+                row = self.conn.execute(
+                    "SELECT pseudonym FROM pseudonyms WHERE kind = ? AND original = ?",
+                    (kind, original),
+                ).fetchone()
+            return row[0]
+
+    def __len__(self):
+        with self._lock:
+            return self.conn.execute("SELECT COUNT(*) FROM pseudonyms").fetchone()[0]
+
+    def close(self):
+        with self._lock:
+            self.conn.close()
+
+
+def _generate(kind):
+    if kind == KIND_UID:
+        return f"2.25.{uuid.uuid4().int}"
+    return "ANON" + secrets.token_hex(6).upper()
+
+
+# 以 (pid, 路径) 为键：fork 出的子进程继承父进程的缓存，但不能共用父进程的 SQLite 连接
+_stores = {}
+_stores_lock = threading.Lock()
+
+
+def get_store(path):
+    """按路径取（并缓存）本进程的映射库"""
+    key = (os.getpid(), os.path.abspath(path))
+    with _stores_lock:
+        store = _stores.get(key)
+        if store is None:
+            store = _stores[key] = PseudonymStore(key[1])
+        return store
@@ -0,0 +1,214 @@
+"""
+批处理运行日志（SQLite），用于增量/断点续跑
+
+日志文件放在输出目录旁边：<output>.journal.sqlite
+每个输入文件记录：相对路径、大小、修改时间、可选的内容哈希、所用配置的哈希、
+处理状态以及输出文件的大小/修改时间。再次运行同一输入时，
+已完成且未变化的文件直接跳过，新增的文件和上次未完成的文件才会处理。
+"""
+
+import os
+import json
+import time
+import hashlib
+import sqlite3
+
+
+STATUS_DONE = "done"
+STATUS_FAILED = "failed"
+
+# 影响输出内容的配置项（并行度等不影响结果的配置不参与哈希）
+OUTPUT_CONFIG_KEYS = (
+    "modality",
+    "keep_original",
+    "video_mask_cfg",
+    "jpeg_mask_cfg",
+    "dicom_pixel_mask",
+    "deid_profile",
+    "header_only",
+    "header_scrub",
+    "pseudonym_db",
+)
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS runs (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    input_root TEXT NOT NULL,
+    config_hash TEXT NOT NULL,
+    config TEXT NOT NULL,
+    started REAL NOT NULL,
+    finished REAL,
+    status TEXT
+);
+CREATE TABLE IF NOT EXISTS files (
+    rel_path TEXT PRIMARY KEY,
+    size INTEGER NOT NULL,
+    mtime REAL NOT NULL,
+    digest TEXT,
+    config_hash TEXT NOT NULL,
+    status TEXT NOT NULL,
+    out_size INTEGER,
+    out_mtime REAL,
+    error TEXT,
+    run_id INTEGER,
+    updated REAL NOT NULL
+);
+"""
+
+
+def journal_path(dst_root):
+    """日志文件路径：输出目录旁边（原地模式下即输入目录旁边）"""
+    return os.path.normpath(dst_root) + ".journal.sqlite"
+
+
+def config_hash(config):
+    subset = {k: config.get(k) for k in OUTPUT_CONFIG_KEYS}
+    if subset.get("deid_profile"):
+        # 规则文件内容变化时也视为不同的输出设置
+        subset["deid_profile"] = file_digest(subset["deid_profile"])
+    text = json.dumps(subset, sort_keys=True, default=list)
+    return hashlib.sha256(text.encode("utf-8")).hexdigest()[:16]
+
+
+def file_digest(path, chunk_size=1024 * 1024):
+    h = hashlib.sha256()
+    with open(path, "rb") as f:
+        while True:
+            chunk = f.read(chunk_size)
+            if not chunk:
+                break
+            h.update(chunk)
+    return h.hexdigest()
+
+
+class RunJournal:
+    """
+    单写者的运行日志：只应在主进程中写入
+    （并行模式下子进程通过消息队列把结果交回主进程）
+    """
+
+    def __init__(self, path, config, use_hash=False, commit_every=200):
+        self.path = path
+        self.config_hash = config_hash(config)
+        self.use_hash = use_hash
+        self.commit_every = commit_every
+        self._pending = 0
+        self.run_id = None
+
+        self.conn = sqlite3.connect(path, check_same_thread=False)
+        self.conn.execute("PRAGMA journal_mode=WAL")
+        self.conn.execute("PRAGMA synchronous=NORMAL")
+        self.conn.executescript(_SCHEMA)
+        self._config_json = json.dumps(
+            {k: config.get(k) for k in OUTPUT_CONFIG_KEYS}, default=list
+        )
+
+    # ================= 运行记录 =================
+
+    def begin_run(self, input_root):
+        cur = self.conn.execute(
+            "INSERT INTO runs (input_root, config_hash, config, started) VALUES (?, ?, ?, ?)",
+            (input_root, self.config_hash, self._config_json, time.time()),
+        )
+        self.conn.commit()
+        self.run_id = cur.lastrowid
+        return self.run_id
+
+    def finish_run(self, status):
+        self.conn.execute(
+            "UPDATE runs SET finished = ?, status = ? WHERE id = ?",
+            (time.time(), status, self.run_id),
+        )
+        self.flush()
+
+    def reset(self):
+        """清空文件记录（完全重新处理时使用）"""
+        self.conn.execute("DELETE FROM files")
+        self.conn.commit()
+
+    def has_records(self):
+        return self.conn.execute("SELECT 1 FROM files LIMIT 1").fetchone() is not None
+
+    # ================= 文件状态 =================
+
+    def is_done(self, entry, dst_path):
+        """
+        该输入文件是否已用相同配置成功处理过，且输入/输出均未变化
+        entry 为 scan_manifest.ManifestEntry
+        """
+        row = self.conn.execute(
+            "SELECT size, mtime, digest, config_hash, status, out_size, out_mtime "
+            "FROM files WHERE rel_path = ?",
+            (entry.rel_path,),
+        ).fetchone()
+        if row is None:
+            return False
+
+        size, mtime, digest, cfg_hash, status, out_size, out_mtime = row
+        if status != STATUS_DONE or cfg_hash != self.config_hash:
+            return False
+
+        try:
+            out_st = os.stat(dst_path)
+        except OSError:
+            return False
+        if out_st.st_size != out_size or out_st.st_mtime != out_mtime:
+            return False
+
+        if dst_path == entry.path:
+            # 原地模式：输入文件就是上次的输出
+            if self.use_hash:
+                return digest is not None and file_digest(dst_path) == digest
+            return True
+
+        if entry.size != size or entry.mtime != mtime:
+            return False
+        if self.use_hash:
+            return digest is not None and file_digest(entry.path) == digest
+        return True
+
+    def record(self, entry, dst_path, ok, error=None):
+        """记录一个输入文件的处理结果"""
+        out_size = out_mtime = None
+        digest = None
+        if ok:
+            try:
+                out_st = os.stat(dst_path)
+                out_size, out_mtime = out_st.st_size, out_st.st_mtime
+            except OSError:
+                ok = False
+                error = error or "Output file missing"
+
+        if ok and self.use_hash:
+            # 原地模式记录输出内容，否则记录输入内容
+            digest = file_digest(dst_path if dst_path == entry.path else entry.path)
+
+        self.conn.execute(
+            "INSERT OR REPLACE INTO files (rel_path, size, mtime, digest, config_hash, "
+            "status, out_size, out_mtime, error, run_id, updated) "
+            "VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)",
+            (
+                entry.rel_path,
+                entry.size,
+                entry.mtime,
+                digest,
+                self.config_hash,
+                STATUS_DONE if ok else STATUS_FAILED,
+                out_size,
+                out_mtime,
+                error,
+                self.run_id,
+                time.time(),
+            ),
+        )
+        self._pending += 1
+        if self._pending >= self.commit_every:
+            self.flush()
+
+    def flush(self):
+        self.conn.commit()
+        self._pending = 0
+
+    def close(self):
+        self.flush()
+        self.conn.close()
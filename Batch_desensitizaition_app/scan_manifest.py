@@ -0,0 +1,219 @@
+"""
+单次扫描清单
+
+一次 os.scandir 遍历输入目录，记录每个文件的类型（DICOM/JPEG/AVI/other）、
+大小、修改时间和所属病例。之后的病例发现、DICOM/JPEG/AVI 处理都复用这份清单，
+不再重复 os.walk 和 pydicom 解析。
+
+DICOM 判断顺序：
+1. 扩展名 .avi / .jpg / .jpeg 直接归类
+2. 读取前 132 字节，偏移 128 处为 b"DICM" 即为 DICOM
+3. 明显的非DICOM扩展名 / 过小的文件归为 other
+4. 无前导码但看起来像裸DICOM数据集（.dcm 扩展名或以 0002/0008 组开头）的文件
+   才用 pydicom 完整解析确认
+"""
+
+import os
+from collections import namedtuple
+import pydicom
+from atomic_output import is_temp_output
+
+
+KIND_DICOM = "dicom"
+KIND_JPEG = "jpeg"
+KIND_AVI = "avi"
+KIND_OTHER = "other"
+
+# case 模式
+CASE_TOP = "top"  # 病例 = 输入目录下的一级子目录（MRI/CT）
+CASE_DIR = "dir"  # 病例 = 文件所在目录（超声DICOM/视频）
+
+NON_DICOM_EXTENSIONS = (
+    ".txt",
+    ".pdf",
+    ".jpg",
+    ".jpeg",
+    ".png",
+    ".gif",
+    ".bmp",
+    ".doc",
+    ".docx",
+    ".xls",
+    ".xlsx",
+    ".py",
+    ".log",
+    ".ini",
+    ".cfg",
+    ".config",
+    ".bat",
+    ".sh",
+    ".avi",
+    ".mp4",
+    ".mov",
+    ".mkv",
+    ".wmv",
+    ".html",
+    ".htm",
+    ".xml",
+    ".json",
+    ".csv",
+)
+
+DICOM_EXTENSIONS = (".dcm", ".dic", ".dicom")
+JPEG_EXTENSIONS = (".jpg", ".jpeg")
+
+MIN_DICOM_SIZE = 132
+MAX_SNIFF_PARSE_SIZE = 2 * 1024 * 1024 * 1024
+
+# 无前导码DICOM常见的起始组：(0002,xxxx) 或 (0008,xxxx)，小端
+_RAW_DICOM_GROUPS = (b"\x02\x00", b"\x08\x00")
+
+
+ManifestEntry = namedtuple(
+    "ManifestEntry", ["path", "rel_path", "kind", "size", "mtime", "case"]
+)
+
+
+class ScanManifest:
+    """扫描结果：按遍历顺序保存的 ManifestEntry 列表"""
+
+    def __init__(self, root, entries, case_mode=CASE_TOP):
+        self.root = root
+        self.entries = entries
+        self.case_mode = case_mode
+
+    def __len__(self):
+        return len(self.entries)
+
+    def files(self, kind=None, case=None):
+        return [
+            e
+            for e in self.entries
+            if (kind is None or e.kind == kind) and (case is None or e.case == case)
+        ]
+
+    def paths(self, kind=None, case=None):
+        return [e.path for e in self.files(kind, case)]
+
+    def cases(self, kinds=(KIND_DICOM,)):
+        """包含指定类型文件的病例，按首次出现顺序"""
+        seen = {}
+        for e in self.entries:
+            if e.kind in kinds and e.case not in seen:
+                seen[e.case] = True
+        return list(seen)
+
+    def by_case(self):
+        grouped = {}
+        for e in self.entries:
+            grouped.setdefault(e.case, []).append(e)
+        return grouped
+
+    def total_size(self, kind=None, case=None):
+        return sum(e.size for e in self.files(kind, case))
+
+    def counts(self):
+        counts = {KIND_DICOM: 0, KIND_JPEG: 0, KIND_AVI: 0, KIND_OTHER: 0}
+        for e in self.entries:
+            counts[e.kind] += 1
+        return counts
+
+
+def classify_file(path, size, sniff=True):
+    """根据扩展名、大小和132字节前导码判断文件类型"""
+    name = path.lower()
+
+    if name.endswith(".avi"):
+        return KIND_AVI
+    if name.endswith(JPEG_EXTENSIONS):
+        return KIND_JPEG
+    if size < MIN_DICOM_SIZE or name.endswith(NON_DICOM_EXTENSIONS):
+        return KIND_OTHER
+    if not sniff:
+        return KIND_DICOM if name.endswith(DICOM_EXTENSIONS) else KIND_OTHER
+
+    try:
+        with open(path, "rb") as f:
+            head = f.read(MIN_DICOM_SIZE)
+    except OSError:
+        return KIND_OTHER
+
+    if head[128:132] == b"DICM":
+        return KIND_DICOM
+
+    # 模糊情况：才做一次完整的头部解析
+    ambiguous = name.endswith(DICOM_EXTENSIONS) or head[:2] in _RAW_DICOM_GROUPS
+    if ambiguous and size <= MAX_SNIFF_PARSE_SIZE and _parses_as_dicom(path):
+        return KIND_DICOM
+
+    return KIND_OTHER
+
+
+def _parses_as_dicom(path):
+    try:
+        ds = pydicom.dcmread(path, stop_before_pixels=True, force=True)
+    except Exception:
+        return False
+    return len(ds) > 0
+
+
+def build_manifest(root, case_mode=CASE_TOP, sniff=True, skip=None):
+    """
+    递归扫描 root，返回 ScanManifest
+
+    sniff=False 时只按扩展名识别DICOM（与超声DICOM流程的 .dcm 规则一致）
+    skip: 可选的 callable(path) -> bool，用于跳过某些文件/目录
+    """
+    entries = []
+    _scan_dir(root, root, case_mode, sniff, skip, entries)
+    return ScanManifest(root, entries, case_mode)
+
+
+def _scan_dir(root, path, case_mode, sniff, skip, entries):
+    try:
+        with os.scandir(path) as it:
+            items = sorted(it, key=lambda d: d.name)
+    except OSError:
+        return
+
+    subdirs = []
+    for item in items:
+        if skip and skip(item.path):
+            continue
+        if is_temp_output(item.name):
+            # 中断的运行残留的临时输出文件（见 atomic_output）
+            continue
+        try:
+            if item.is_dir(follow_symlinks=False):
+                subdirs.append(item.path)
+                continue
+            if not item.is_file():
+                continue
+            st = item.stat()
+        except OSError:
+            continue
+
+        rel_path = os.path.relpath(item.path, root)
+        entries.append(
+            ManifestEntry(
+                path=item.path,
+                rel_path=rel_path,
+                kind=classify_file(item.path, st.st_size, sniff),
+                size=st.st_size,
+                mtime=st.st_mtime,
+                case=case_of(rel_path, case_mode),
+            )
+        )
+
+    for sub in subdirs:
+        _scan_dir(root, sub, case_mode, sniff, skip, entries)
+
+
+def case_of(rel_path, case_mode=CASE_TOP):
+    """根据相对路径计算文件所属病例（"" 表示根目录）"""
+    rel_dir = os.path.dirname(rel_path)
+    if case_mode == CASE_DIR:
+        return rel_dir if rel_dir else "."
+    if not rel_dir:
+        return ""
+    return rel_dir.split(os.sep, 1)[0]
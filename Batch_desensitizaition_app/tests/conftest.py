@@ -0,0 +1,65 @@
+import os
+import sys
+
+import numpy as np
+import pytest
+from pydicom.dataset import Dataset, FileMetaDataset
+from pydicom.sequence import Sequence
+from pydicom.uid import CTImageStorage, ExplicitVRLittleEndian, generate_uid
+
+# 各模块按平铺的脚本互相导入（from dicom_stream import ...），测试时同样从程序目录导入
+APP_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+if APP_DIR not in sys.path:
+    sys.path.insert(0, APP_DIR)
+
+
+def write_ct(path, transfer_syntax=ExplicitVRLittleEndian, seed=0, patient_id="PID1"):
+    """写一个带嵌套序列的小 CT 文件（含常见 PHI 标签）"""
+    ds = Dataset()
+    ds.SOPClassUID = CTImageStorage
+    ds.SOPInstanceUID = generate_uid()
+    ds.PatientName = "DOE^JANE"
+    ds.PatientID = patient_id
+    ds.PatientBirthDate = "19700101"
+    ds.PatientSex = "F"
+    ds.InstitutionName = "GENERAL HOSPITAL"
+    ds.ReferringPhysicianName = "DR^X"
+    ds.StudyDescription = "CHEST"
+    ds.StationName = "ST1"
+    ds.Manufacturer = "ACME"
+    ds.StudyInstanceUID = "1.2.3.4"
+    ds.SeriesInstanceUID = "1.2.3.4.5"
+    ds.Modality = "CT"
+
+    inner = Dataset()
+    inner.InstitutionName = "NESTED HOSPITAL"
+    inner.CodeValue = "X"
+    item = Dataset()
+    item.ReferencedSOPClassUID = CTImageStorage
+    item.ReferencedSOPInstanceUID = generate_uid()
+    item.PurposeOfReferenceCodeSequence = Sequence([inner])
+    ds.ReferencedStudySequence = Sequence([item, Dataset()])
+
+    ds.Rows = 16
+    ds.Columns = 16
+    ds.BitsAllocated = 16
+    ds.BitsStored = 12
+    ds.HighBit = 11
+    ds.PixelRepresentation = 0
+    ds.SamplesPerPixel = 1
+    ds.PhotometricInterpretation = "MONOCHROME2"
+    ds.PixelData = (np.arange(256, dtype=np.uint16) + seed).tobytes()
+
+    meta = FileMetaDataset()
+    meta.TransferSyntaxUID = transfer_syntax
+    meta.MediaStorageSOPClassUID = ds.SOPClassUID
+    meta.MediaStorageSOPInstanceUID = ds.SOPInstanceUID
+    ds.file_meta = meta
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    ds.save_as(path, enforce_file_format=True)
+    return path
+
+
+@pytest.fixture
+def ct_file(tmp_path):
+    return write_ct(str(tmp_path / "src" / "ct.dcm"))
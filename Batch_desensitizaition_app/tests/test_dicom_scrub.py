@@ -0,0 +1,92 @@
+import copy
+import sqlite3
+
+import pydicom
+import pytest
+from pydicom.uid import ExplicitVRLittleEndian, ImplicitVRLittleEndian
+
+from anonymize_common import _anonymize_dicom
+from deid_profile import DEFAULT_PROFILE, get_profile, save_profile
+from dicom_scrub import SCRUB_MODES, needs_scrub
+
+from conftest import write_ct
+
+
+def _custom_profile(path):
+    """默认规则之外加上 hash、删除序列和替换为更长的值"""
+    profile = copy.deepcopy(DEFAULT_PROFILE)
+    profile["salt"] = "test"
+    profile["rules"].update(
+        {
+            "StudyInstanceUID": "hash",
+            "ReferencedSOPInstanceUID": "hash",
+            "PurposeOfReferenceCodeSequence": "remove",
+            "Manufacturer": "remove",
+            "ReferencedStudySequence": "keep",
+            "StudyDescription": {"action": "replace", "value": "A LONGER DESCRIPTION"},
+        }
+    )
+    save_profile(profile, path)
+    return path
+
+
+def _flatten(ds, prefix=""):
+    """
+    {路径: 值} 形式的全部元素（含序列条目），忽略组长度元素
+    same-length 模式把删除改为清空，因此空值与不存在视为相同
+    """
+    values = {}
+    for elem in ds:
+        if elem.tag.element == 0:
+            continue
+        key = prefix + (elem.keyword or str(elem.tag))
+        if elem.VR == "SQ":
+            values[key] = len(elem.value)
+            for i, item in enumerate(elem.value):
+                values.update(_flatten(item, f"{key}[{i}]."))
+        elif elem.value is not None and str(elem.value) not in ("", "b''"):
+            values[key] = str(elem.value)
+    return values
+
+
+@pytest.mark.parametrize("transfer_syntax", [ExplicitVRLittleEndian, ImplicitVRLittleEndian])
+@pytest.mark.parametrize("profile_kind", ["default", "custom", "pseudonym"])
+def test_scrub_modes_produce_same_dataset(tmp_path, transfer_syntax, profile_kind):
+    src = write_ct(str(tmp_path / "src" / "ct.dcm"), transfer_syntax)
+    profile = None
+    pseudonym_db = None
+    if profile_kind == "custom":
+        profile = _custom_profile(str(tmp_path / "profile.json"))
+    elif profile_kind == "pseudonym":
+        pseudonym_db = str(tmp_path / "pseudonyms.sqlite")
+
+    outputs = {}
+    for mode in SCRUB_MODES:
+        dst = str(tmp_path / mode / "ct.dcm")
+        _anonymize_dicom(src, "CT", True, dst, profile, mode, pseudonym_db)
+        outputs[mode] = pydicom.dcmread(dst)
+
+    expected = outputs["pydicom"]
+    assert "DOE^JANE" not in _flatten(expected).values()
+    if profile_kind != "default":
+        assert expected.StudyInstanceUID != "1.2.3.4"
+    for mode in SCRUB_MODES:
+        assert _flatten(outputs[mode]) == _flatten(expected), mode
+        assert outputs[mode].PixelData == expected.PixelData, mode
+
+
+def test_output_needs_no_second_scrub(tmp_path, ct_file):
+    rules = get_profile(None, "CT")
+    for mode in SCRUB_MODES:
+        dst = str(tmp_path / mode / "ct.dcm")
+        _anonymize_dicom(ct_file, "CT", True, dst, scrub=mode)
+        assert not needs_scrub(dst, rules), mode
+
+
+def test_needs_scrub_does_not_create_pseudonyms(tmp_path, ct_file):
+    db = str(tmp_path / "pseudonyms.sqlite")
+    rules = get_profile(None, "CT", db)
+
+    assert needs_scrub(ct_file, rules)
+    with sqlite3.connect(db) as conn:
+        assert conn.execute("SELECT COUNT(*) FROM pseudonyms").fetchone()[0] == 0
@@ -0,0 +1,61 @@
+import cv2
+import numpy as np
+import pytest
+
+from mask_plan import dicom_plan, region_plan, video_plan
+
+
+def _rectangle_mask(plan):
+    """cv2.rectangle 按同样的角点填充得到的遮罩"""
+    mask = np.zeros((plan.height, plan.width), dtype=np.uint8)
+    for x1, y1, x2, y2 in plan.rects:
+        cv2.rectangle(mask, (x1, y1), (x2, y2), 255, -1)
+    return mask
+
+
+def _plan_mask(plan):
+    mask = np.zeros((plan.height, plan.width), dtype=np.uint8)
+    return plan.apply(mask, 255)
+
+
+@pytest.mark.parametrize("direction", ["top", "left", "right"])
+@pytest.mark.parametrize("size", [0, 1, 37, 80, 10000])
+@pytest.mark.parametrize("width, height", [(640, 480), (641, 481), (32, 24)])
+def test_video_plan_matches_rectangle(direction, size, width, height):
+    plan = video_plan(direction, size, width, height)
+    assert np.array_equal(_plan_mask(plan), _rectangle_mask(plan))
+
+
+@pytest.mark.parametrize(
+    "regions",
+    [
+        [(0, 0, 50, 50)],
+        [(10, 20, 10, 20)],
+        [(50, 40, 5, 3)],
+        [(-20, -20, 1000, 1000)],
+        [(190, 140, 250, 300), (0, 0, 0, 0), (30, 30, 60, 45)],
+    ],
+)
+def test_region_plan_matches_rectangle(regions):
+    plan = region_plan(regions, 200, 150)
+    assert np.array_equal(_plan_mask(plan), _rectangle_mask(plan))
+
+
+def test_dicom_plan_combines_video_and_regions():
+    plan = dicom_plan({"direction": "top", "size": 30}, [(100, 100, 120, 140)], 200, 150)
+    assert len(plan.rects) == 2
+    assert np.array_equal(_plan_mask(plan), _rectangle_mask(plan))
+
+
+def test_apply_masks_color_frames_in_place():
+    plan = video_plan("right", 40, 160, 120)
+    frame = np.full((120, 160, 3), 200, dtype=np.uint8)
+    assert plan.apply(frame) is frame
+    expected = cv2.rectangle(
+        np.full((120, 160, 3), 200, dtype=np.uint8),
+        plan.rects[0][:2],
+        plan.rects[0][2:],
+        (0, 0, 0),
+        -1,
+    )
+    assert np.array_equal(frame, expected)
@@ -0,0 +1,95 @@
+import multiprocessing
+import os
+from concurrent.futures import ProcessPoolExecutor
+
+import pytest
+
+from deid_profile import get_profile
+import pseudonym_store
+from pseudonym_store import PseudonymStore, get_store
+
+UIDS = [f"1.2.840.99.{i}" for i in range(50)]
+IDS = [f"PATIENT{i}" for i in range(10)]
+
+
+def _pseudonyms(db, values, vr):
+    """在（子）进程中经 get_profile 取映射，与批处理中的用法相同"""
+    rules = get_profile(None, "CT", db)
+    return [rules.pseudonymize(value, vr) for value in values]
+
+
+def test_mapping_is_stable_and_distinct(tmp_path):
+    store = PseudonymStore(str(tmp_path / "pseudonyms.sqlite"))
+    first = [store.pseudonym(uid, "UI") for uid in UIDS]
+    assert [store.pseudonym(uid, "UI") for uid in UIDS] == first
+    assert len(set(first)) == len(UIDS)
+    assert all(p.startswith("2.25.") for p in first)
+    assert store.pseudonym("PATIENT1", "LO").startswith("ANON")
+    assert len(store) == len(UIDS) + 1
+    store.close()
+
+
+def test_mapping_persists_across_connections(tmp_path):
+    db = str(tmp_path / "pseudonyms.sqlite")
+    store = PseudonymStore(db)
+    first = [store.pseudonym(uid, "UI") for uid in UIDS]
+    store.close()
+
+    reopened = PseudonymStore(db)
+    assert [reopened.pseudonym(uid, "UI") for uid in UIDS] == first
+    reopened.close()
+
+
+def test_mapping_is_stable_across_processes(tmp_path):
+    db = str(tmp_path / "pseudonyms.sqlite")
+    # 一半的值先在主进程中映射，另一半由多个子进程同时首次映射
+    known = _pseudonyms(db, UIDS[:25], "UI")
+
+    context = multiprocessing.get_context("spawn")
+    with ProcessPoolExecutor(max_workers=4, mp_context=context) as pool:
+        uid_results = [pool.submit(_pseudonyms, db, UIDS, "UI") for _ in range(4)]
+        id_results = [pool.submit(_pseudonyms, db, IDS, "LO") for _ in range(4)]
+        uid_results = [f.result() for f in uid_results]
+        id_results = [f.result() for f in id_results]
+
+    for result in uid_results:
+        assert result[:25] == known
+        assert result == uid_results[0]
+    for result in id_results:
+        assert result == id_results[0]
+    assert get_store(db).pseudonym(UIDS[-1], "UI") == uid_results[0][-1]
+
+
+def _forked_child(db):
+    """返回 (规则是否使用本进程另开的连接, 映射结果)"""
+    # 缓存中不属于本进程的映射库都是从父进程继承来的
+    inherited = [
+        store
+        for key, store in pseudonym_store._stores.items()
+        if key[0] != os.getpid()
+    ]
+    store = get_profile(None, "CT", db).pseudonyms
+    own = store is get_store(db) and all(
+        store is not other and store.conn is not other.conn for other in inherited
+    )
+    return own and bool(inherited), _pseudonyms(db, UIDS, "UI")
+
+
+@pytest.mark.skipif(
+    "fork" not in multiprocessing.get_all_start_methods(), reason="needs fork"
+)
+def test_forked_workers_open_their_own_connection(tmp_path):
+    db = str(tmp_path / "pseudonyms.sqlite")
+    # 主进程先打开映射库，fork 出的子进程继承了这个连接和已编译的规则
+    known = _pseudonyms(db, UIDS[:25], "UI")
+
+    context = multiprocessing.get_context("fork")
+    with ProcessPoolExecutor(max_workers=4, mp_context=context) as pool:
+        futures = [pool.submit(_forked_child, db) for _ in range(8)]
+        results = [f.result() for f in futures]
+
+    for own, mapped in results:
+        assert own
+        assert mapped[:25] == known
+        assert mapped == results[0][1]
+    assert _pseudonyms(db, UIDS, "UI") == results[0][1]
@@ -0,0 +1,85 @@
+import os
+
+import pydicom
+import pytest
+
+from batch_engine import BatchEngine
+
+from conftest import write_ct
+
+
+def _make_input(root):
+    for case in ("case0", "case1"):
+        for i in range(3):
+            write_ct(os.path.join(root, case, "exam", f"{i}.dcm"), seed=i)
+
+
+def _run(root, **config):
+    config = {"modality": "CT", **config}
+    return BatchEngine(root, config).run()
+
+
+def _outputs(root):
+    """{相对路径: 输出文件的 (inode, mtime_ns)}"""
+    out_root = root + "_anon"
+    result = {}
+    for dirpath, _, files in os.walk(out_root):
+        for name in files:
+            path = os.path.join(dirpath, name)
+            st = os.stat(path)
+            result[os.path.relpath(path, out_root)] = (st.st_ino, st.st_mtime_ns)
+    return result
+
+
+@pytest.mark.parametrize("case_workers", [1, 2])
+def test_resume_skips_completed_files(tmp_path, case_workers):
+    root = str(tmp_path / "input")
+    _make_input(root)
+
+    summary = _run(root, case_workers=case_workers)
+    assert summary["files_processed"] == 6
+    before = _outputs(root)
+
+    summary = _run(root, case_workers=case_workers)
+    assert summary["files_processed"] == 0
+    assert _outputs(root) == before
+
+
+@pytest.mark.parametrize("case_workers", [1, 2])
+def test_resume_reprocesses_new_and_modified_files(tmp_path, case_workers):
+    root = str(tmp_path / "input")
+    _make_input(root)
+    _run(root, case_workers=case_workers)
+    before = _outputs(root)
+
+    modified = os.path.join("case0", "exam", "1.dcm")
+    added = os.path.join("case1", "exam", "new.dcm")
+    write_ct(os.path.join(root, modified), seed=100, patient_id="ANOTHER-PATIENT")
+    write_ct(os.path.join(root, added), seed=200)
+
+    summary = _run(root, case_workers=case_workers)
+    assert summary["files_processed"] == 2
+
+    after = _outputs(root)
+    assert set(after) == set(before) | {added}
+    changed = {path for path in before if after[path] != before[path]}
+    assert changed == {modified}
+    ds = pydicom.dcmread(os.path.join(root + "_anon", modified))
+    assert ds.PixelData == pydicom.dcmread(os.path.join(root, modified)).PixelData
+
+
+def test_output_setting_change_reprocesses_everything(tmp_path):
+    root = str(tmp_path / "input")
+    _make_input(root)
+    _run(root)
+
+    assert _run(root, header_only=False)["files_processed"] == 6
+    assert _run(root, header_only=False)["files_processed"] == 0
+
+
+def test_no_resume_reprocesses_everything(tmp_path):
+    root = str(tmp_path / "input")
+    _make_input(root)
+    _run(root)
+
+    assert _run(root, resume=False)["files_processed"] == 6
@@ -0,0 +1,96 @@
+import threading
+
+import cv2
+import numpy as np
+import pytest
+
+from anonymize_video import PIPELINE_DEPTH, run_pipeline
+
+WIDTH, HEIGHT = 64, 48
+
+# 流水线卡住时测试失败而不是一直等待
+TIMEOUT = 10
+
+
+class FakeCapture:
+    def __init__(self, frames=50, fail_at=None):
+        self.frames = frames
+        self.fail_at = fail_at
+        self.reads = 0
+
+    def get(self, prop):
+        return WIDTH if prop == cv2.CAP_PROP_FRAME_WIDTH else HEIGHT
+
+    def read(self, buf=None):
+        self.reads += 1
+        if self.reads == self.fail_at:
+            raise RuntimeError("read failed")
+        if self.reads > self.frames:
+            return False, None
+        return True, np.zeros((HEIGHT, WIDTH, 3), dtype=np.uint8)
+
+
+class FakeWriter:
+    def __init__(self, fail_at=None):
+        self.fail_at = fail_at
+        self.writes = 0
+
+    def write(self, frame):
+        self.writes += 1
+        if self.writes == self.fail_at:
+            raise RuntimeError("write failed")
+
+
+class FakePlan:
+    def __init__(self, fail_at=None, error=ValueError):
+        self.fail_at = fail_at
+        self.error = error
+        self.calls = 0
+
+    def apply(self, frame):
+        self.calls += 1
+        if self.calls == self.fail_at:
+            raise self.error("mask failed")
+        return frame
+
+
+def _run(cap, writer, plan):
+    """在线程中运行流水线，返回 (是否结束, 帧数或异常)"""
+    result = []
+
+    def target():
+        try:
+            result.append(run_pipeline(cap, writer, plan))
+        except BaseException as e:
+            result.append(e)
+
+    thread = threading.Thread(target=target, daemon=True)
+    thread.start()
+    thread.join(TIMEOUT)
+    return not thread.is_alive(), result[0] if result else None
+
+
+def test_all_frames_written():
+    writer = FakeWriter()
+    finished, result = _run(FakeCapture(frames=50), writer, FakePlan())
+    assert finished
+    assert result == 50
+    assert writer.writes == 50
+
+
+@pytest.mark.parametrize(
+    "cap, writer, plan, error",
+    [
+        (FakeCapture(fail_at=3), FakeWriter(), FakePlan(), RuntimeError),
+        (FakeCapture(), FakeWriter(fail_at=4), FakePlan(), RuntimeError),
+        (FakeCapture(), FakeWriter(), FakePlan(fail_at=5), ValueError),
+        # 第一帧就出错，解码线程此时可能正阻塞在已满的队列上
+        (FakeCapture(frames=10 * PIPELINE_DEPTH), FakeWriter(), FakePlan(fail_at=1), ValueError),
+        (FakeCapture(), FakeWriter(), FakePlan(fail_at=3, error=KeyboardInterrupt), KeyboardInterrupt),
+    ],
+    ids=["read", "write", "mask", "mask-first-frame", "mask-interrupt"],
+)
+def test_stage_error_ends_pipeline(cap, writer, plan, error):
+    finished, result = _run(cap, writer, plan)
+    assert finished, "run_pipeline did not return after a stage raised"
+    assert isinstance(result, error)
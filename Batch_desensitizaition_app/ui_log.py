@@ -0,0 +1,40 @@
+"""
+GUI 日志的批量显示与落盘
+
+工作线程的每条日志都经 ui_queue 送到界面。逐条插入 Text 控件并滚动，在大批量
+处理时会远远落后于工作线程，控件内容也会无限增长。界面每次在时间预算内取出
+队列中的全部消息，日志合并为一次插入，进度只取最新值；控件中只保留最近
+LOG_VIEW_LINES 行，完整日志写到输出目录旁边的 <output>.log（见 log_path）。
+"""
+
+import os
+import time
+
+
+# Text 控件中保留的日志行数
+LOG_VIEW_LINES = 5000
+# 每次处理 ui_queue 的时间预算（秒），超出后先让 Tk 处理界面事件
+UI_DRAIN_BUDGET = 0.02
+# 队列中还有消息时下一次处理的间隔（毫秒）；空闲时由 _schedule_ui_queue 唤醒
+UI_BUSY_DELAY = 15
+
+
+def log_path(dst_root):
+    """完整日志文件路径：输出目录旁边（与运行日志 journal 相同位置）"""
+    return os.path.normpath(dst_root) + ".log"
+
+
+class LogFile:
+    """追加写入的完整日志；每批日志写入后立即 flush"""
+
+    def __init__(self, path):
+        self.path = path
+        self._file = open(path, "a", encoding="utf-8")
+        self._file.write(f"\n===== {time.strftime('%Y-%m-%d %H:%M:%S')} =====\n")
+
+    def write_lines(self, lines):
+        self._file.write("\n".join(lines) + "\n")
+        self._file.flush()
+
+    def close(self):
+        self._file.close()